@@ -8,9 +8,26 @@ import optparse
 import os
 import os.path
 import shutil
+import time
+import json
+import random
+import math
+import atexit
+import bisect
 from operator import itemgetter
 import collections
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# shared helpers, in ../lib/pfn_backup of both the source tree and /usr/bin
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'lib', 'pfn_backup'))
+from pfn_common import Metrics, TreeWalker, peak_rss, peak_rss_reset, \
+        SIDECAR_SUFFIX, is_sidecar
+
 
 """ Split archives into removable volumes, of fixed size
 
@@ -42,32 +59,409 @@ def custom_options(parser):
     pgroup.add_option('--wontfit-dir', help="Directory of files not fit in allowed sizes")
     pgroup.add_option('--allowed-media', help="Comma-separated list of allowed disk types")
     pgroup.add_option('--start-from', type=int, help="Number of volume to start from")
+    pgroup.add_option('--walk-jobs', type=int, default=4,
+                      help="Number of directories to list (and stat files of) in parallel")
+    pgroup.add_option('--optimize', default=False, action='store_true',
+                      help="Re-pack new volumes to need fewer (cheaper) disks than the greedy plan")
+    pgroup.add_option('--optimize-time', type=float, default=10.0,
+                      help="Seconds to spend optimizing, with --optimize")
+    pgroup.add_option('--media-cost',
+                      help="Comma-separated price per disk of media types, like dvd:0.3,bd-sl:1.5 (default: 1 each)")
+    parser.add_option_group(pgroup)
 
+    pgroup = optparse.OptionGroup(parser, "Benchmark options")
+    pgroup.add_option('--synth-files', type=int, default=0,
+                      help="Instead of scanning, distribute that many synthetic files, and time it")
+    pgroup.add_option('--bench-json', help="Write benchmark results to this JSON file")
+    pgroup.add_option('--bench-legacy', default=False, action='store_true',
+                      help="Also time the previous (quadratic) algorithm, and compare its plan")
     parser.add_option_group(pgroup)
 
-options.allow_include = 3
-options._path_options += ['output_dir', 'wontfit_dir']
-options.init(options_prepare=custom_options,
-        have_args=None,
-        config='~/.openerp/backup.conf', config_section=(),
-        defaults={ 'allowed_media':'dvd', 'output_dir': 'outgoing', 'wontfit_dir': 'wontfit',
-                  'start_from': 1})
+    pgroup = optparse.OptionGroup(parser, "Instrumentation options")
+    pgroup.add_option('--metrics-json', help="Write a JSON summary of timers and counters at exit")
+    pgroup.add_option('--metrics-prom',
+                      help="Write metrics at exit into this file, for the Prometheus textfile collector")
+    pgroup.add_option('--profile', help="Profile the run with cProfile, dump stats here")
+
+    parser.add_option_group(pgroup)
 
 
 log = logging.getLogger('main')
 
-if False:
-    rpc.openSession(**options.connect_dsn)
+MB = 1048576L
 
-    if not rpc.login():
-        raise Exception("Could not login!")
 
-if not options.args:
-    log.error("Must supply input paths")
-    sys.exit(1)
-    
+metrics = Metrics('prepare_media')
+
+
+class SizeIndex(object):
+    """Archives by size, finding the largest one up to some size in O(log n)
+
+        Archives of the same size are taken in the order they were given.
+        Distinct sizes are kept in a sorted list, each one pointing to the
+        next smaller size that still has archives (with path compression),
+        so that emptied sizes are skipped at once.
+    """
+
+    def __init__(self, entries):
+        by_size = {}
+        for entry in entries:
+            by_size.setdefault(entry[1], collections.deque()).append(entry)
+        self.sizes = sorted(by_size)
+        self._buckets = [by_size[size] for size in self.sizes]
+        self._left = range(len(self.sizes))
+        self._count = len(entries)
+
+    def __len__(self):
+        return self._count
+
+    def _find(self, i):
+        """Index of the largest size still having archives, at or below `i`, or -1
+        """
+        root = i
+        while root >= 0 and self._left[root] != root:
+            root = self._left[root]
+        while i >= 0 and self._left[i] != i:
+            self._left[i], i = root, self._left[i]
+        return root
+
+    def largest(self, max_size=None):
+        """First archive of the largest size up to `max_size`, or None
+        """
+        if max_size is None:
+            i = len(self.sizes) - 1
+        else:
+            i = bisect.bisect_right(self.sizes, max_size) - 1
+        i = self._find(i)
+        if i < 0:
+            return None
+        return self._buckets[i][0]
+
+    def pop_largest(self, max_size=None):
+        """Take the archive `largest(max_size)` would return
+        """
+        if max_size is None:
+            i = len(self.sizes) - 1
+        else:
+            i = bisect.bisect_right(self.sizes, max_size) - 1
+        i = self._find(i)
+        if i < 0:
+            return None
+        bucket = self._buckets[i]
+        entry = bucket.popleft()
+        if not bucket:
+            self._left[i] = i - 1
+        self._count -= 1
+        return entry
+
+
+class VolumeOptimizer(object):
+    """Pack archives into as few, cheap, volumes as possible, within a time budget
+
+        A plan (from `bfd_plan()`, or given) is improved by trying to empty
+        the least filled volumes, one at a time: their archives go to the
+        best fitting other volume, or are swapped with a smaller archive
+        there, which then needs a place in turn. When no volume can be
+        emptied, load is shifted from less to more filled volumes (moving
+        archives, or swapping them for smaller ones), which gathers the
+        free space into the least filled ones, and emptying is tried again.
+        Finally, each volume gets the cheapest media type it fits on.
+
+        Candidate moves and swaps are scored over all volumes and archives
+        at once, with NumPy where available.
+    """
+    log = logging.getLogger('optimizer')
+    MAX_SWAPS = 200 # per attempt to empty a volume
+
+    def __init__(self, sizes, media):
+        """
+            @param sizes list of archive sizes, padded
+            @param media list of `(dtype, capacity, cost, max_count)`
+        """
+        self.sizes = sizes
+        self.media = media
+        self._reset()
+
+    def _reset(self):
+        if numpy is not None:
+            self._np_sizes = numpy.array(self.sizes, dtype=numpy.int64)
+            self.where = numpy.full(len(self.sizes), -1, dtype=numpy.int64)
+            self.slack = numpy.zeros(0, dtype=numpy.int64)
+        else:
+            self.where = [-1] * len(self.sizes)
+            self.slack = []
+        self.bin_media = []
+        self.loads = []
+        self.members = []
+        self.alive = []
+        self._closing = None
+
+    def bfd_plan(self):
+        """Best-fit decreasing plan, opening volumes of least cost per byte
+
+            @return list of `(media index, [archive indices])`, or None if
+                the media run out
+        """
+        left = [m[3] for m in self.media]
+        bins = []
+        slacks = [] # sorted (slack, bin)
+        for i in sorted(range(len(self.sizes)), key=lambda i: -self.sizes[i]):
+            size = self.sizes[i]
+            k = bisect.bisect_left(slacks, (size, -1))
+            if k < len(slacks):
+                slack, b = slacks.pop(k)
+                bins[b][1].append(i)
+                bisect.insort(slacks, (slack - size, b))
+                continue
+            cands = [(cost / float(cap), mi) for mi, (dtype, cap, cost, max_count) in enumerate(self.media)
+                     if cap >= size and left[mi] > 0]
+            if not cands:
+                return None
+            mi = min(cands)[1]
+            left[mi] -= 1
+            bins.append((mi, [i]))
+            bisect.insort(slacks, (self.media[mi][1] - size, len(bins) - 1))
+        return bins
+
+    def set_plan(self, bins):
+        self._reset()
+        slack = []
+        for mi, items in bins:
+            b = len(self.bin_media)
+            self.bin_media.append(mi)
+            self.loads.append(sum([self.sizes[i] for i in items]))
+            self.members.append(set(items))
+            self.alive.append(True)
+            slack.append(self.media[mi][1] - self.loads[b])
+            for i in items:
+                self.where[i] = b
+        if numpy is not None:
+            self.slack = numpy.array(slack, dtype=numpy.int64)
+        else:
+            self.slack = slack
+
+    def plan(self):
+        return [(self.bin_media[b], sorted(self.members[b]))
+                for b in range(len(self.bin_media)) if self.alive[b]]
+
+    @staticmethod
+    def plan_cost(bins, media):
+        return sum([media[mi][2] for mi, items in bins])
+
+    def _update_slack(self, b):
+        if self.alive[b] and b != self._closing:
+            self.slack[b] = self.media[self.bin_media[b]][1] - self.loads[b]
+        else:
+            self.slack[b] = -1
+
+    def _move(self, i, b, journal=None):
+        old = self.where[i]
+        size = self.sizes[i]
+        if old >= 0:
+            self.loads[old] -= size
+            self.members[old].discard(i)
+            self._update_slack(old)
+        if b >= 0:
+            self.loads[b] += size
+            self.members[b].add(i)
+            self._update_slack(b)
+        self.where[i] = b
+        if journal is not None:
+            journal.append((i, old))
+
+    def _best_fit(self, size):
+        """Open volume with the least room left, that `size` fits in, or None
+        """
+        if numpy is not None:
+            cands = numpy.flatnonzero(self.slack >= size)
+            if not len(cands):
+                return None
+            return int(cands[numpy.argmin(self.slack[cands])])
+        best = None
+        for b, slack in enumerate(self.slack):
+            if slack >= size and (best is None or slack < self.slack[best]):
+                best = b
+        return best
+
+    def _best_swap(self, size):
+        """Placed archive that, swapped out for one of `size`, leaves the least room
+
+            Only smaller archives qualify, so that the ones left to place
+            get smaller with each swap.
+        """
+        if numpy is not None:
+            placed = self.where >= 0
+            after = numpy.where(placed, self.slack[self.where], -1) + self._np_sizes - size
+            cands = numpy.flatnonzero(placed & (self._np_sizes < size) & (after >= 0))
+            if not len(cands):
+                return None
+            return int(cands[numpy.argmin(after[cands])])
+        best = None
+        best_after = None
+        for j, b in enumerate(self.where):
+            if b < 0 or self.sizes[j] >= size:
+                continue
+            after = self.slack[b] + self.sizes[j] - size
+            if after >= 0 and (best is None or after < best_after):
+                best, best_after = j, after
+        return best
+
+    def _best_shift(self, i):
+        """Best move, or swap for a smaller archive, of `i` to a fuller volume
+
+            Only those carrying load from the volume of `i` to one left
+            fuller than that are considered, so that each one raises the
+            sum of squared loads, and shifting ends. Moves are preferred,
+            then the swap leaving the least room.
+
+            @return `(volume, archive swapped out or None)`, or None
+        """
+        a = self.where[i]
+        size = self.sizes[i]
+        load_a = self.loads[a]
+        if numpy is not None:
+            loads = numpy.array(self.loads, dtype=numpy.int64)
+            cands = numpy.flatnonzero((self.slack >= size) & (loads + size > load_a))
+            cands = cands[cands != a]
+            if len(cands):
+                return int(cands[numpy.argmin(self.slack[cands])]), None
+            placed = self.where >= 0
+            delta = size - self._np_sizes
+            after = numpy.where(placed, self.slack[self.where], -1) - delta
+            cands = numpy.flatnonzero(placed & (self.where != a) & (delta > 0) & (after >= 0)
+                                      & (loads[self.where] + delta > load_a))
+            if not len(cands):
+                return None
+            j = int(cands[numpy.argmin(after[cands])])
+            return int(self.where[j]), j
+        best = None
+        for b, slack in enumerate(self.slack):
+            if b != a and slack >= size and self.loads[b] + size > load_a \
+                    and (best is None or slack < self.slack[best]):
+                best = b
+        if best is not None:
+            return best, None
+        best_after = None
+        for j, b in enumerate(self.where):
+            delta = size - self.sizes[j]
+            if b < 0 or b == a or delta <= 0 or self.loads[b] + delta <= load_a:
+                continue
+            after = self.slack[b] - delta
+            if after >= 0 and (best is None or after < best_after):
+                best, best_after = j, after
+        if best is None:
+            return None
+        return self.where[best], best
+
+    def _shift_load(self, deadline):
+        """Shift archives out of the least filled volumes, into fuller ones
+
+            @return number of moves and swaps done
+        """
+        n_shifts = 0
+        for a in sorted([b for b in range(len(self.loads)) if self.alive[b]],
+                        key=lambda b: self.loads[b]):
+            for i in sorted(self.members[a], key=lambda i: -self.sizes[i]):
+                if time.time() >= deadline:
+                    return n_shifts
+                res = self._best_shift(i)
+                if res is None:
+                    continue
+                b, j = res
+                if j is not None:
+                    self._move(j, a)
+                self._move(i, b)
+                n_shifts += 1
+            if not self.members[a]:
+                self.alive[a] = False
+                self._update_slack(a)
+        return n_shifts
+
+    def _try_empty(self, e, deadline):
+        """Move all archives of volume `e` to others, keep that if it works
+        """
+        journal = []
+        self._closing = e
+        self._update_slack(e)
+        pool = list(self.members[e])
+        for i in pool:
+            self._move(i, -1, journal)
+        n_swaps = 0
+        done = True
+        while pool:
+            pool.sort(key=lambda i: self.sizes[i])
+            i = pool.pop()
+            b = self._best_fit(self.sizes[i])
+            if b is not None:
+                self._move(i, b, journal)
+                continue
+            j = None
+            if n_swaps < self.MAX_SWAPS and time.time() < deadline:
+                j = self._best_swap(self.sizes[i])
+            if j is None:
+                done = False
+                pool.append(i)
+                break
+            b = self.where[j]
+            self._move(j, -1, journal)
+            self._move(i, b, journal)
+            pool.append(j)
+            n_swaps += 1
+
+        self._closing = None
+        if done:
+            self.alive[e] = False
+            self._update_slack(e)
+            return True
+        for i, old in reversed(journal):
+            self._move(i, old)
+        self._update_slack(e)
+        return False
+
+    def improve(self, deadline):
+        """Empty volumes, least filled first, shifting load when none can be
+
+            Stops when load cannot be shifted any more, or time is up.
+
+            @return number of volumes emptied
+        """
+        n_alive = sum(self.alive)
+        while time.time() < deadline:
+            improved = True
+            while improved and time.time() < deadline:
+                improved = False
+                for b in sorted([b for b in range(len(self.loads)) if self.alive[b]],
+                                key=lambda b: self.loads[b]):
+                    if time.time() >= deadline:
+                        break
+                    if self._try_empty(b, deadline):
+                        improved = True
+                        break
+            if not self._shift_load(deadline):
+                break
+        return n_alive - sum(self.alive)
+
+    def retype(self):
+        """Move each volume to the cheapest media type it fits on, with disks left
+        """
+        left = [m[3] for m in self.media]
+        for b, mi in enumerate(self.bin_media):
+            if self.alive[b]:
+                left[mi] -= 1
+        for b in sorted(range(len(self.loads)), key=lambda b: self.loads[b]):
+            if not self.alive[b]:
+                continue
+            mi = self.bin_media[b]
+            for mi2, (dtype, cap, cost, max_count) in enumerate(self.media):
+                if left[mi2] > 0 and cap >= self.loads[b] \
+                        and (cost, cap) < (self.media[mi][2], self.media[mi][1]):
+                    mi = mi2
+            if mi != self.bin_media[b]:
+                left[self.bin_media[b]] += 1
+                left[mi] -= 1
+                self.bin_media[b] = mi
+                self._update_slack(b)
 
-MB = 1048576L
 
 class PMWorker(object):
     log = logging.getLogger('pmworker')
@@ -81,6 +475,9 @@ class PMWorker(object):
               #'bd-ql':  122072.0,
               }
     fill_factor = 99.7
+    walk_jobs = 1
+    media_costs = {} # price per disk, by type, 1.0 if not set
+    optimize_time = 10.0
     
     class DiskTypeAllowed(object):
         def __init__(self, dtype, remaining=1000):
@@ -90,6 +487,12 @@ class PMWorker(object):
             self.count = 0
             self.remaining = int(remaining)
             self.fill_factor = PMWorker.fill_factor
+
+        @property
+        def capacity(self):
+            """Bytes that fit on a new volume of this type
+            """
+            return long(self.size_bytes * self.fill_factor / 100.0)
         
         def increment(self):
             self.count += 1
@@ -105,7 +508,7 @@ class PMWorker(object):
                         'path': False,
                         'size': self.size_mb,
                         'type': self.dtype,
-                        'remaining': long(self.size_bytes * self.fill_factor / 100.0),
+                        'remaining': self.capacity,
                         'old_files': [],
                         'new_files': [],
                         'num': self.count
@@ -207,9 +610,13 @@ class PMWorker(object):
         """
         self.log.debug("Found volume dir (%s), scanning: %s", new_dest.get('type', '?'), dpath)
         tsize = 0L
-        for dirpath, dirnames, filenames in os.walk(dpath, onerror=self.walk_error):
-            for f in filenames:
-                tsize += self.size_pad(os.path.getsize(os.path.join(dirpath, f)))
+        walker = TreeWalker(self.walk_jobs, onerror=self.walk_error, metrics=metrics)
+        with metrics.timer('walk'):
+            for dirpath, dirnames, filenames, stats in walker.walk(dpath):
+                for f in filenames:
+                    if isinstance(stats[f], EnvironmentError):
+                        raise stats[f]
+                    tsize += self.size_pad(stats[f].st_size)
 
         # compute possible size:
         if 'type' not in new_dest:
@@ -238,8 +645,10 @@ class PMWorker(object):
         
         in_manifest = []
         msize = 0L
-        for dirpath, dirnames, filenames in os.walk(dpath, onerror=self.walk_error,
-                                                    followlinks=True):
+        ts = time.time()
+        walker = TreeWalker(self.walk_jobs, onerror=self.walk_error, followlinks=True,
+                            metrics=metrics)
+        for dirpath, dirnames, filenames, stats in walker.walk(dpath):
             self.log.debug("Walking: %s", dirpath)
             if not filenames:
                 continue
@@ -247,8 +656,13 @@ class PMWorker(object):
             assert dirpath.startswith(dpath), "Unexpected dirpath: %s" % dirpath
             dirpath1 = dirpath[len(dpath):].lstrip(os.sep) + os.sep
             for f in filenames:
+                if is_sidecar(f):
+                    # MD5 sum of an archive, for scan-backups.py
+                    continue
                 full_f = os.path.join(dirpath, f)
-                this_size = os.path.getsize(full_f)
+                if isinstance(stats[f], EnvironmentError):
+                    raise stats[f]
+                this_size = stats[f].st_size
                 in_manifest.append((dirpath1 + f, this_size, self.file_pos, full_f, {}))
                 self.file_pos += 1
                 if this_size < self.max_size:
@@ -259,12 +673,235 @@ class PMWorker(object):
             msize += ssize
             
         self.log.info("Located %s in %s", self.sizeof_fmt(msize), dpath)
+        metrics.add_time('walk', time.time() - ts)
+        metrics.count('files_scanned', len(in_manifest))
+        metrics.count('bytes_scanned', msize)
         self.src_manifest += in_manifest
         return True
 
+    def make_synth_manifest(self, n_files, seed=42):
+        """Fill `src_manifest` with `n_files` of synthetic sizes, not on disk
+
+            Sizes follow a log-normal distribution around 200MB, so that
+            a few files are larger than any media.
+        """
+        rnd = random.Random(seed)
+        for i in range(n_files):
+            size = long(rnd.lognormvariate(math.log(200 * MB), 1.5))
+            name = 'gpg/%04d%02d/archive-%06d.tar.gpg' % (2010 + i % 120 / 12, i % 12 + 1, i)
+            self.src_manifest.append((name, size, self.file_pos, os.path.join('/synth', name), {}))
+            self.file_pos += 1
+
+    def bench(self, method='compute'):
+        """Time `method` over the current `src_manifest`
+
+            @return dict of results, 'plan' being the resulting volumes
+        """
+        n_files = len(self.src_manifest)
+        rss_scope = peak_rss_reset() and 'stage' or 'process'
+        ts = time.time()
+        getattr(self, method)()
+        dt = time.time() - ts
+        n_placed = sum([len(mf['new_files']) for mf in self.dest_manifests])
+        return {'stage': 'PMWorker.%s' % method, 'files': n_files, 'seconds': dt,
+                'files_per_s': n_files / (dt or 1e-9),
+                'volumes': len([mf for mf in self.dest_manifests if mf['new_files']]),
+                'placed': n_placed, 'wontfit': len(self.wontfit_files),
+                'peak_rss_kb': peak_rss(), 'peak_rss_scope': rss_scope,
+                'plan': [(mf['path'], mf['type'], [nf[0] for nf in mf['new_files']])
+                         for mf in self.dest_manifests]}
+
+    def _fill(self, dest, index):
+        """Put the largest archives that fit into `dest`, while it has room
+        """
+        remaining = dest['remaining']
+        if remaining <= 0:
+            return
+        while True:
+            entry = index.pop_largest(remaining)
+            if entry is None:
+                break
+            remaining -= self.size_pad(entry[1])
+            dest['new_files'].append(entry)
+            if remaining <= 0:
+                self.log.debug("Just filled disk: %s", dest['num'])
+                break
+        dest['remaining'] = remaining
+
     def compute(self):
         """ Process, distribute source archives into dest manifests
         """
+        self._pack()
+        self._arrange_dests()
+        return True
+
+    def _new_volumes_stats(self, dests):
+        """Number, cost and wasted space of the new volumes among `dests`
+        """
+        by_type = dict([(am.dtype, am) for am in self.allowed_media])
+        ret = {'volumes': 0, 'cost': 0.0, 'wasted': 0L}
+        for mf in dests:
+            if mf['path'] or not mf['new_files']:
+                continue
+            ret['volumes'] += 1
+            ret['cost'] += self.media_costs.get(mf['type'], 1.0)
+            ret['wasted'] += by_type[mf['type']].size_bytes \
+                    - sum([self.size_pad(nf[1]) for nf in mf['new_files']])
+        return ret
+
+    def optimize(self):
+        """ Like compute(), but re-pack the new volumes to cost less
+
+            The greedy plan of compute() is taken, along with a best-fit
+            decreasing one, choosing media by cost per byte, whichever is
+            cheaper. Then, `VolumeOptimizer` tries to empty volumes for
+            `optimize_time` seconds. Existing volumes keep their files.
+
+            Results of both plans are kept in `optimize_report`.
+        """
+        media_state = [(am.count, am.remaining) for am in self.allowed_media]
+        self._pack()
+        greedy = self._new_volumes_stats(self.dest_manifests)
+        self.optimize_report = {'greedy': greedy, 'optimized': greedy}
+        new_dests = [mf for mf in self.dest_manifests if not mf['path']]
+        entries = [nf for mf in new_dests for nf in mf['new_files']]
+        if not entries:
+            self._arrange_dests()
+            return True
+
+        greedy_state = [(am.count, am.remaining) for am in self.allowed_media]
+        media_idx = dict([(am.dtype, mi) for mi, am in enumerate(self.allowed_media)])
+        media = []
+        for am, (count, remaining) in zip(self.allowed_media, media_state):
+            media.append((am.dtype, am.capacity, self.media_costs.get(am.dtype, 1.0), remaining))
+
+        ts = time.time()
+        optimizer = VolumeOptimizer([self.size_pad(nf[1]) for nf in entries], media)
+        greedy_bins = []
+        pos = 0
+        for mf in new_dests:
+            greedy_bins.append((media_idx[mf['type']], range(pos, pos + len(mf['new_files']))))
+            pos += len(mf['new_files'])
+        greedy_bins = [(mi, items) for mi, items in greedy_bins if items]
+        bins = optimizer.bfd_plan()
+        if bins is None or (VolumeOptimizer.plan_cost(bins, media), len(bins)) \
+                >= (VolumeOptimizer.plan_cost(greedy_bins, media), len(greedy_bins)):
+            bins = greedy_bins
+        optimizer.set_plan(bins)
+        n_emptied = optimizer.improve(ts + self.optimize_time)
+        optimizer.retype()
+        bins = optimizer.plan()
+        self.log.info("Optimized in %.1fs, emptied %d volumes", time.time() - ts, n_emptied)
+
+        if (VolumeOptimizer.plan_cost(bins, media), len(bins)) \
+                < (greedy['cost'], greedy['volumes']):
+            for am, (count, remaining) in zip(self.allowed_media, media_state):
+                am.count, am.remaining = count, remaining
+            opt_dests = []
+            for mi, items in bins:
+                amedia = self.allowed_media[mi]
+                new_dest = amedia.make_new()
+                new_dest['new_files'] = [entries[i] for i in items]
+                new_dest['remaining'] -= sum([self.size_pad(nf[1]) for nf in new_dest['new_files']])
+                opt_dests.append(new_dest)
+            self.dest_manifests = [mf for mf in self.dest_manifests if mf['path']] + opt_dests
+            self.optimize_report['optimized'] = self._new_volumes_stats(opt_dests)
+        else:
+            for am, (count, remaining) in zip(self.allowed_media, greedy_state):
+                am.count, am.remaining = count, remaining
+        self._arrange_dests()
+        return True
+
+    def print_optimized(self):
+        """Print volumes and space saved by optimize(), against the greedy plan
+        """
+        greedy = self.optimize_report['greedy']
+        opt = self.optimize_report['optimized']
+        print "Greedy plan:    %4d volumes, cost %8.2f, %s unused" % \
+                (greedy['volumes'], greedy['cost'], self.sizeof_fmt(greedy['wasted']))
+        print "Optimized plan: %4d volumes, cost %8.2f, %s unused" % \
+                (opt['volumes'], opt['cost'], self.sizeof_fmt(opt['wasted']))
+        wasted = greedy['wasted'] - opt['wasted']
+        print "Saved %d volumes, cost %.2f, %s %s unused space" % \
+                (greedy['volumes'] - opt['volumes'], greedy['cost'] - opt['cost'],
+                 self.sizeof_fmt(abs(wasted)), (wasted < 0) and 'more' or 'less')
+        print
+
+    def _pack(self):
+        """ Distribute source archives into dest manifests, in a greedy way
+
+            Existing volumes are filled first, least remaining space first,
+            then new ones of the first allowed type that can hold the
+            largest archive left. Each volume takes the largest archives
+            that fit, found through a `SizeIndex`.
+
+            Same plan as `_compute_legacy()`, except for archives larger
+            than the (fill factor) capacity of any media, which now go to
+            `wontfit_files` rather than open new volumes they can't fit.
+        """
+        self.src_manifest.sort(key=itemgetter(1), reverse=True)
+        pos = 0
+        while pos < len(self.src_manifest) and self.src_manifest[pos][1] > self.max_size:
+            pos += 1
+        self.wontfit_files += self.src_manifest[:pos]
+        index = SizeIndex(self.src_manifest[pos:])
+        del self.src_manifest[:]
+        max_capacity = max([am.capacity for am in self.allowed_media])
+
+        self.dest_manifests.sort(key=itemgetter('remaining'))
+        to_fill = list(self.dest_manifests)
+        max_remaining = 0L # of volumes already filled
+        warn_end_disks = True
+        while index:
+            avail_size = 0L # max avail size both in existing and allowed media
+            for am in self.allowed_media:
+                if am.remaining and am.size_bytes > avail_size:
+                    avail_size = am.size_bytes
+            avail_size = max([avail_size, max_remaining] + [mf['remaining'] for mf in to_fill])
+
+            # cleanup fast all these files that wouldn't fit
+            n_skipped = 0
+            while index and index.largest()[1] > avail_size:
+                index.pop_largest()
+                n_skipped += 1
+            if n_skipped:
+                self.log.debug("Skipping %d files > %s", n_skipped, self.sizeof_fmt(avail_size))
+
+            for mf in to_fill:
+                self._fill(mf, index)
+                max_remaining = max(max_remaining, mf['remaining'])
+            to_fill = []
+
+            if index:
+                # not all archives could fit existing destinations
+                entry = index.largest()
+                if entry[1] > max_capacity:
+                    self.wontfit_files.append(index.pop_largest())
+                    continue
+                for amedia in self.allowed_media:
+                    if amedia.capacity < entry[1]:
+                        continue
+                    new_dest = amedia.make_new()
+                    if not new_dest:
+                        continue
+                    self.dest_manifests.append(new_dest)
+                    to_fill.append(new_dest)
+                    self.log.debug("Will need new %s volume (# %d)", amedia.dtype, amedia.count)
+                    break
+                else:
+                    if warn_end_disks:
+                        log.warning("No disks left for file of size %s", self.sizeof_fmt(entry[1]))
+                        warn_end_disks = False
+                    index.pop_largest()
+
+        return True
+
+    def _compute_legacy(self):
+        """ Process, distribute source archives into dest manifests
+
+            Previous algorithm of `compute()`, scanning the list of archives
+            for each volume. Kept to benchmark against.
+        """
         self.src_manifest.sort(key=itemgetter(1), reverse=True)
         in_manifest = self.src_manifest
         warn_end_disks = True
@@ -327,7 +964,13 @@ class PMWorker(object):
                         log.warning("No disks left for file of size %s", self.sizeof_fmt(in_manifest[0][1]))
                         warn_end_disks = False
                     in_manifest.pop(0)
-                
+
+        self._arrange_dests()
+        return True
+
+    def _arrange_dests(self):
+        """Order files and volumes, name the new volumes, once they are filled
+        """
         # Second pass: sort "new_files" on each destination
         for mf in self.dest_manifests:
             mf['new_files'].sort(key=itemgetter(2))
@@ -366,8 +1009,6 @@ class PMWorker(object):
                 if not mf['name']:
                     mf['name'] = "Backup %s" % disk_num
                 disk_num += 1
-            
-        return True
 
     def move_files(self):
         n_moved = 0
@@ -388,7 +1029,14 @@ class PMWorker(object):
                     # a `move` would silently replace the existing one,
                     # better not to clobber.
                     continue
-                shutil.move(nf[3], bd)
+                with metrics.timer('move'):
+                    shutil.move(nf[3], bd)
+                if os.path.exists(nf[3] + SIDECAR_SUFFIX):
+                    # its sum is only trusted on the source tree, and the
+                    # volume is verified by reading it
+                    os.unlink(nf[3] + SIDECAR_SUFFIX)
+                metrics.count('files_moved')
+                metrics.count('bytes_moved', nf[1])
                 n_moved += 1
         self.log.info("Moved %d files to output directories", n_moved)
 
@@ -437,30 +1085,111 @@ class PMWorker(object):
         
 
 # Main flow:
-worker = PMWorker(allowed_media=options.opts.allowed_media.split(','),
-                  wontfit_dir=options.opts.wontfit_dir,
-                  start_from=options.opts.start_from)
+if __name__ == '__main__':
+    options.allow_include = 3
+    options._path_options += ['output_dir', 'wontfit_dir', 'metrics_json', 'metrics_prom', 'profile']
+    options.init(options_prepare=custom_options,
+            have_args=None,
+            config='~/.openerp/backup.conf', config_section=(),
+            defaults={ 'allowed_media':'dvd', 'output_dir': 'outgoing', 'wontfit_dir': 'wontfit',
+                      'start_from': 1})
 
-worker.use_volume_dir(options.opts.output_dir)
+    if False:
+        rpc.openSession(**options.connect_dsn)
 
-# stage 2: scan "source" folders
-for fpath in options.args:
-    worker.scan_source_dir(fpath)
+        if not rpc.login():
+            raise Exception("Could not login!")
 
-if worker.n_errors:
-    log.error("Errors encountered while scanning files. Cannot continue")
-    if not options.opts.force:
+    if not (options.args or options.opts.synth_files):
+        log.error("Must supply input paths")
         sys.exit(1)
 
+    PMWorker.walk_jobs = max(options.opts.walk_jobs or 1, 1)
+    PMWorker.optimize_time = options.opts.optimize_time
+    if options.opts.media_cost:
+        try:
+            PMWorker.media_costs = dict([(dtype.strip(), float(cost))
+                                         for dtype, cost in [mc.split(':', 1)
+                                         for mc in options.opts.media_cost.split(',')]])
+        except ValueError:
+            log.error("Invalid --media-cost: %s", options.opts.media_cost)
+            sys.exit(1)
+
+    profiler = None
+    if options.opts.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def _at_exit():
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(options.opts.profile)
+            log.info("Profile written to %s", options.opts.profile)
+        metrics.export(options.opts.metrics_json, options.opts.metrics_prom)
+
+    atexit.register(_at_exit)
+
+    worker = PMWorker(allowed_media=options.opts.allowed_media.split(','),
+                      wontfit_dir=options.opts.wontfit_dir,
+                      start_from=options.opts.start_from)
+
+    if options.opts.synth_files:
+        methods = ['compute']
+        if options.opts.bench_legacy:
+            methods.append('_compute_legacy')
+        if options.opts.optimize:
+            methods.append('optimize')
+        results = []
+        for method in methods:
+            worker = PMWorker(allowed_media=options.opts.allowed_media.split(','),
+                              wontfit_dir=options.opts.wontfit_dir,
+                              start_from=options.opts.start_from)
+            worker.volume_dir = options.opts.output_dir
+            worker.make_synth_manifest(options.opts.synth_files)
+            result = worker.bench(method)
+            print "%(stage)s: %(files)d files in %(seconds).3fs, %(files_per_s).1f files/s, " \
+                  "%(volumes)d volumes, peak RSS %(peak_rss_kb)dKB" % result
+            if method == 'optimize':
+                worker.print_optimized()
+            results.append(result)
+        if options.opts.bench_legacy:
+            same_plan = results[0]['plan'] == results[1]['plan']
+            print "Same plan: %s, speedup: %.1fx" % (same_plan and 'yes' or 'NO',
+                                                     results[1]['seconds'] / (results[0]['seconds'] or 1e-9))
+        if options.opts.bench_json:
+            for result in results:
+                del result['plan']
+            with open(options.opts.bench_json, 'wb') as fp:
+                json.dump(results, fp, indent=2)
+        sys.exit(0)
+
+    worker.use_volume_dir(options.opts.output_dir)
+
+    # stage 2: scan "source" folders
+    for fpath in options.args:
+        worker.scan_source_dir(fpath)
+
+    if worker.n_errors:
+        log.error("Errors encountered while scanning files. Cannot continue")
+        if not options.opts.force:
+            sys.exit(1)
+
 
-# stage x: write "manifest" file on each volume.
+    # stage x: write "manifest" file on each volume.
 
-worker.compute()
-worker.print_summary()
+    with metrics.timer('compute'):
+        if options.opts.optimize:
+            worker.optimize()
+        else:
+            worker.compute()
+    worker.print_summary()
+    if options.opts.optimize:
+        worker.print_optimized()
 
-if options.opts.dry_run:
-    worker.print_results()
-else:
-    worker.move_files()
+    if options.opts.dry_run:
+        worker.print_results()
+    else:
+        worker.move_files()
 
 #eof
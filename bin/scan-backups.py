@@ -21,38 +21,124 @@ from openerp_libclient.extra import options
 import threading
 import shutil
 import subprocess
-from collections import Counter, defaultdict
+import signal
+import errno
+import stat
+import atexit
+import sqlite3
+import itertools
+import zlib
+import base64
+import io
+import mmap
+import Queue
+import select
+import ctypes
+import ctypes.util
+import fcntl
+import struct
+import array
+from collections import Counter, defaultdict, deque
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+# shared helpers, in ../lib/pfn_backup of both the source tree and /usr/bin
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'lib', 'pfn_backup'))
+from pfn_common import Metrics, JobPool, TreeWalker, SIDECAR_SUFFIX, is_sidecar
 
 def custom_options(parser):
     assert isinstance(parser, optparse.OptionParser)
 
     pgroup = optparse.OptionGroup(parser, "Generation options")
-    pgroup.add_option('--mode', help="Operation mode: sources, volume or udisks2")
+    pgroup.add_option('--mode',
+                      help="Operation mode: sources, volume-dir, udisks2, or watch (new files, as written, "
+                           "with full scans every --watch-reconcile seconds). Also: move, copy-needed, "
+                           "move-needed, move-bad, move-md5-bad, cache-vacuum and test")
     pgroup.add_option('--force', default=False, action='store_true', help="Continue on errors")
     pgroup.add_option('--fast-run', default=False, action='store_true', help="Limit scanning to 10sec or 1 GB, for test runs")
 
     pgroup.add_option('--dry-run', default=False, action='store_true', help="Just print the results")
     pgroup.add_option('--small-first', default=False, action='store_true',
                       help="Sort by size, compute smaller files first")
-
+    pgroup.add_option('--disk-order', default=False, action='store_true',
+                      help="Compute files in their physical order on disk, one stream per spinning disk")
+    pgroup.add_option('-j', '--jobs', type=int, default=1,
+                      help="Number of files to compute MD5 sums for, in parallel")
+    pgroup.add_option('--dev-jobs', type=int, default=0,
+                      help="Limit parallel MD5 computations per device (0: no limit)")
+    pgroup.add_option('--digests',
+                      help="Comma-separated list of extra digests to compute, along MD5, eg. sha256,blake2b")
+    pgroup.add_option('--hash-backend', type='choice', choices=('hashlib', 'afalg'), default='hashlib',
+                      help="Compute digests with Python hashlib, or the kernel crypto API (afalg)")
+    pgroup.add_option('--block-size', type=int, default=0,
+                      help="Also compute MD5 sums of blocks of that many MB, per file (0: off)")
+    pgroup.add_option('--direct-io', default=False, action='store_true',
+                      help="Read files with O_DIRECT, bypassing the page cache")
+    pgroup.add_option('--keep-page-cache', default=False, action='store_true',
+                      help="Do not advise the kernel to drop pages of read files")
+    pgroup.add_option('--walk-jobs', type=int, default=4,
+                      help="Number of directories to list (and stat files of) in parallel")
+    pgroup.add_option('--pipeline', default=False, action='store_true',
+                      help="Start hashing while the tree is still being scanned")
+    pgroup.add_option('--pipeline-window', type=int, default=1000,
+                      help="Files to scan, filter and sort at a time, with --pipeline")
+    pgroup.add_option('--queue-batches', type=int, default=2,
+                      help="Computed batches to hold while storage is busy, hashing in the background (0: serial)")
+    pgroup.add_option('--batch-window', type=float, default=120.0,
+                      help="Max. seconds of hashing per batch, ie. work lost if interrupted")
+    pgroup.add_option('--batch-latency', type=float, default=5.0,
+                      help="Target seconds for storing (uploading) a batch, sizing it by number of files")
+    pgroup.add_option('--batch-files', type=int, default=0,
+                      help="Fixed number of files per batch, rather than adaptive (0: adapt)")
+    pgroup.add_option('--batch-mb', type=int, default=0,
+                      help="Fixed size of batch in MB, rather than adaptive (0: adapt)")
+    pgroup.add_option('--hash-cache', help="Local database of computed MD5 sums, by file inode")
+    pgroup.add_option('--no-cache', default=False, action='store_true',
+                      help="Do not use the local MD5 cache, read all files")
+    pgroup.add_option('--no-sidecars', default=False, action='store_true',
+                      help="Do not trust MD5 sums of \"<file>.md5\" sidecars, written along the archives")
+    pgroup.add_option('--cache-max-age', type=int, default=90,
+                      help="Days after which unseen cache entries are dropped, in cache-vacuum mode")
+
+    pgroup.add_option('--no-dir-digests', default=False, action='store_true',
+                      help="Do not ask storage about directory digests, send all names to filter")
     pgroup.add_option('--prefix', help="Add this (directory) prefix to scanned paths")
     pgroup.add_option('-o', '--output', help="Write output JSON file (re-use existing data)")
+    pgroup.add_option('--db', help="Use this (local) SQLite database as storage")
+    pgroup.add_option('--journal', default=False, action='store_true',
+                      help="Append results to a journal next to the output JSON file, compact it at the end")
     pgroup.add_option('--outdir', help="Directory to move checked files into")
 
     pgroup.add_option('-u', '--upload-to', help="URL of service to upload manifests onto")
     pgroup.add_option('--http-proxy', help="HTTP[s] proxy for uploading")
     pgroup.add_option('--http-no-env', default=False, action='store_true', help="Disable environment variables, for proxies and CA")
     pgroup.add_option('-b', '--cookies-file', help='Cookie jar file')
+    pgroup.add_option('--http-inflight', type=int, default=4,
+                      help="Number of filter/details requests to keep in flight")
+    pgroup.add_option('--http-retries', type=int, default=3,
+                      help="Retries of requests failing on connection errors or 5xx status")
+    pgroup.add_option('--spool', help="Directory keeping computed batches until they are uploaded")
+    pgroup.add_option('--wire', type='choice', choices=('auto', 'plain'), default='auto',
+                      help="Use compressed, compact requests if the server supports them (auto), or plain JSON")
     pgroup.add_option('-k', '--insecure', default=False, action='store_true', help="Skip SSL certificate verification")
     parser.add_option_group(pgroup)
 
-options.allow_include = 3
-options._path_options += ['output', 'cookies_file', 'outdir']
-options.init(options_prepare=custom_options,
-        have_args=None,
-        config='~/.openerp/backup.conf', config_section=(),
-        defaults={ 'cookies_file': '~/.f3_upload_cookies.txt', })
+    pgroup = optparse.OptionGroup(parser, "Watch mode options")
+    pgroup.add_option('--watch-settle', type=float, default=5.0,
+                      help="Seconds a new file must stay unmodified, before it is hashed")
+    pgroup.add_option('--watch-reconcile', type=float, default=3600.0,
+                      help="Seconds between full scans of the watched trees, for missed events (0: at start only)")
+    parser.add_option_group(pgroup)
 
+    pgroup = optparse.OptionGroup(parser, "Instrumentation options")
+    pgroup.add_option('--metrics-json', help="Write a JSON summary of timers and counters at exit")
+    pgroup.add_option('--metrics-prom',
+                      help="Write metrics at exit into this file, for the Prometheus textfile collector")
+    pgroup.add_option('--profile', help="Profile the (main thread of the) run with cProfile, dump stats here")
+    parser.add_option_group(pgroup)
 
 log = logging.getLogger('main')
 
@@ -64,15 +150,901 @@ def sizeof_fmt(num, suffix='B'):
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
 
+metrics = Metrics('scan_backups')
+
+
+def new_digest(algo):
+    """Return a hashlib object for `algo`
+
+        BLAKE2b is only available through OpenSSL (as "blake2b512") or the
+        `pyblake2` module, in Python 2
+    """
+    if algo == 'blake2b':
+        if hasattr(hashlib, 'blake2b'):
+            return hashlib.blake2b()
+        try:
+            return hashlib.new('blake2b512')
+        except ValueError:
+            import pyblake2
+            return pyblake2.blake2b()
+    return hashlib.new(algo)
+
+def digest_key(algo):
+    """Name of the manifest key holding digest `algo`, like "md5sum"
+    """
+    return algo + 'sum'
+
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    _libc = None
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+def fadvise(fd, offset, length, advice):
+    """Call `posix_fadvise()`, silently skipped where not available
+    """
+    fn = getattr(_libc, 'posix_fadvise64', None) or getattr(_libc, 'posix_fadvise', None)
+    if fn is None:
+        return
+    fn(fd, ctypes.c_int64(offset), ctypes.c_int64(length), advice)
+
+
+FS_IOC_FIEMAP = 0xC020660B
+
+def physical_offset(full_path):
+    """Locate file on its device
+
+        @return (st_dev, offset), where offset is the physical position of
+            the first extent of the file, as FIEMAP reports it. Filesystems
+            not supporting FIEMAP (or empty files) will fall back to the
+            inode number, which roughly follows allocation order.
+    """
+    fd = os.open(full_path, os.O_RDONLY)
+    try:
+        st = os.fstat(fd)
+        # struct fiemap, asking for a single struct fiemap_extent after it
+        buf = array.array('c', struct.pack('=QQIIII', 0, 0xFFFFFFFFFFFFFFFFL, 0, 0, 1, 0) + '\0' * 56)
+        try:
+            fcntl.ioctl(fd, FS_IOC_FIEMAP, buf, True)
+            if struct.unpack('=I', buf[20:24].tostring())[0]:
+                return st.st_dev, struct.unpack('=Q', buf[40:48].tostring())[0]
+        except IOError:
+            pass
+        return st.st_dev, st.st_ino
+    finally:
+        os.close(fd)
+
+
+class DeviceInfo(object):
+    """Properties of the block device under some filesystem, as found in sysfs
+    """
+    MAX_BS = 16 * 1024 * 1024
+    _cache = {}
+    _lock = threading.Lock()
+
+    def __init__(self, st_dev):
+        self.st_dev = st_dev
+        self.sys_path = '/sys/dev/block/%d:%d' % (os.major(st_dev), os.minor(st_dev))
+        self.read_ahead = self._read_int('queue/read_ahead_kb') * 1024
+        self.opt_io_size = self._read_int('queue/optimal_io_size')
+        self.rotational = bool(self._read_int('queue/rotational'))
+
+    @classmethod
+    def get(cls, st_dev):
+        with cls._lock:
+            if st_dev not in cls._cache:
+                cls._cache[st_dev] = cls(st_dev)
+            return cls._cache[st_dev]
+
+    def _read_int(self, name):
+        # partitions have no "queue", it is at their parent disk
+        for path in (os.path.join(self.sys_path, name), os.path.join(self.sys_path, '..', name)):
+            try:
+                with open(path, 'rb') as fp:
+                    return int(fp.read().strip())
+            except (EnvironmentError, ValueError):
+                continue
+        return 0
+
+    def block_size(self, min_bs):
+        """Size of reads to issue on this device, no less than `min_bs`
+        """
+        bs = max(min_bs, self.read_ahead, self.opt_io_size)
+        bs = min(bs, max(min_bs, self.MAX_BS))
+        return bs - (bs % mmap.PAGESIZE)
+
+
+class FileReader(object):
+    """Sequential reader of a file, yielding chunks of its data
+
+        Data is read into a few re-used buffers, by a background thread, so
+        that the disk keeps working while the previous chunk is digested.
+        The kernel is advised that the file is read sequentially and, unless
+        `drop_cache` is False, that the pages read will not be needed again,
+        so that scanning archives won't evict the working set of other
+        processes from the page cache.
+
+        A `length` of the file, from `offset`, can be read instead of all
+        of it.
+    """
+    N_BUFFERS = 3
+
+    def __init__(self, full_path, bs, direct=False, drop_cache=True, offset=0, length=None):
+        self.fd = -1
+        if direct and hasattr(os, 'O_DIRECT'):
+            try:
+                self.fd = os.open(full_path, os.O_RDONLY | os.O_DIRECT)
+            except OSError:
+                # not supported by this filesystem
+                pass
+        self.direct = self.fd >= 0
+        if self.fd < 0:
+            self.fd = os.open(full_path, os.O_RDONLY)
+        self.fp = io.FileIO(self.fd, 'r', closefd=True)
+        self.bs = bs
+        self.drop_cache = drop_cache and not self.direct
+        self.offset = offset
+        self.length = length
+        self._left = length
+        if offset:
+            self.fp.seek(offset)
+        self._stop = False
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        self._stop = True
+        self.fp.close()
+
+    def _new_buffer(self):
+        if self.direct:
+            # anonymous mmap is page-aligned, as O_DIRECT requires
+            return mmap.mmap(-1, self.bs)
+        return bytearray(self.bs)
+
+    def _readinto(self, buf):
+        if self._left is None:
+            return self.fp.readinto(buf)
+        if self._left <= 0:
+            return 0
+        if isinstance(buf, bytearray) and self._left < len(buf):
+            n = self.fp.readinto(memoryview(buf)[:self._left])
+        else:
+            n = min(self.fp.readinto(buf), self._left)
+        self._left -= n
+        return n
+
+    def _read_ahead(self, free_q, full_q):
+        """Thread: fill buffers from `free_q`, pass them to `full_q`
+        """
+        try:
+            while not self._stop:
+                buf = free_q.get()
+                if buf is None:
+                    break
+                n = self._readinto(buf)
+                full_q.put((buf, n))
+                if not n:
+                    break
+        except Exception:
+            full_q.put((None, sys.exc_info()))
+
+    def chunks(self):
+        """Iterate over the file data, as `buffer` objects
+
+            Each chunk is only valid until the next one is requested
+        """
+        fadvise(self.fd, self.offset, self.length or 0, POSIX_FADV_SEQUENTIAL)
+        offset = self.offset
+        if self.length is not None:
+            size = self.length
+        else:
+            size = os.fstat(self.fd).st_size - self.offset
+        if size <= self.bs:
+            # small file, no need for a thread
+            buf = self._new_buffer()
+            while True:
+                n = self._readinto(buf)
+                if not n:
+                    break
+                yield buffer(buf, 0, n)
+                offset += n
+            if self.drop_cache:
+                fadvise(self.fd, self.offset, offset - self.offset, POSIX_FADV_DONTNEED)
+            return
+
+        free_q = Queue.Queue()
+        full_q = Queue.Queue()
+        for i in range(self.N_BUFFERS):
+            free_q.put(self._new_buffer())
+        thr = threading.Thread(target=self._read_ahead, args=(free_q, full_q))
+        thr.daemon = True
+        thr.start()
+        try:
+            while True:
+                buf, n = full_q.get()
+                if buf is None:
+                    raise n[0], n[1], n[2]
+                if not n:
+                    break
+                yield buffer(buf, 0, n)
+                free_q.put(buf)
+                if self.drop_cache:
+                    fadvise(self.fd, offset, n, POSIX_FADV_DONTNEED)
+                offset += n
+        finally:
+            self._stop = True
+            free_q.put(None)
+            thr.join()
+
+
+class AFAlgHasher(object):
+    """Digests computed by the Linux kernel crypto API, over AF_ALG sockets
+
+        File data is spliced from the file into a pipe, and from there into
+        the hash socket, so that it never gets copied into user space. When
+        more than one digest is needed, the pipe is `tee()`d into one extra
+        pipe per digest.
+    """
+    log = logging.getLogger('hash.afalg')
+    AF_ALG = 38
+    SOCK_SEQPACKET = 5
+    SPLICE_F_MOVE = 1
+    SPLICE_F_MORE = 4
+    F_SETPIPE_SZ = 1031
+    F_GETPIPE_SZ = 1032
+    KERNEL_NAMES = {'blake2b': 'blake2b-512'}
+
+    _tfms = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def _get_tfm(cls, algo):
+        """Socket bound to `algo`, shared by all threads
+        """
+        with cls._lock:
+            if algo not in cls._tfms:
+                fd = _libc.socket(cls.AF_ALG, cls.SOCK_SEQPACKET, 0)
+                if fd < 0:
+                    err = ctypes.get_errno()
+                    raise OSError(err, os.strerror(err))
+                sa = struct.pack('=H14sII64s', cls.AF_ALG, 'hash', 0, 0,
+                                 cls.KERNEL_NAMES.get(algo, algo))
+                if _libc.bind(fd, sa, len(sa)) < 0:
+                    err = ctypes.get_errno()
+                    os.close(fd)
+                    raise OSError(err, os.strerror(err))
+                cls._tfms[algo] = fd
+            return cls._tfms[algo]
+
+    @classmethod
+    def is_available(cls, algos):
+        try:
+            for algo in algos:
+                cls._get_tfm(algo)
+            return True
+        except (OSError, AttributeError), e:
+            cls.log.debug("AF_ALG not available for %s: %s", ','.join(algos), e)
+            return False
+
+    @staticmethod
+    def _check(ret):
+        if ret < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return ret
+
+    def __init__(self, algos):
+        self.algos = algos
+        for name in ('splice', 'tee'):
+            fn = getattr(_libc, name)
+            fn.restype = ctypes.c_ssize_t
+        _libc.splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                                 ctypes.c_size_t, ctypes.c_uint]
+        _libc.tee.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_uint]
+
+    def digest(self, fd, bs, progress=None):
+        """Compute digests of file `fd`, from its current position to EOF
+
+            @param progress called with the number of bytes hashed so far
+            @return list of hex digests, in the order of `algos`
+        """
+        ops = []
+        pipes = []
+        try:
+            for algo in self.algos:
+                ops.append(self._check(_libc.accept(self._get_tfm(algo), None, None)))
+                pipes.append(os.pipe())
+            for pr, pw in pipes:
+                try:
+                    fcntl.fcntl(pw, self.F_SETPIPE_SZ, bs)
+                except IOError:
+                    pass # over /proc/sys/fs/pipe-max-size, keep default
+            chunk = min([fcntl.fcntl(pw, self.F_GETPIPE_SZ) for pr, pw in pipes])
+
+            r_size = 0L
+            while True:
+                n = self._check(_libc.splice(fd, None, pipes[0][1], None, chunk,
+                                             self.SPLICE_F_MOVE | self.SPLICE_F_MORE))
+                if not n:
+                    break
+                for pr, pw in pipes[1:]:
+                    # all pipes are empty here, so tee() has room for all `n`
+                    if self._check(_libc.tee(pipes[0][0], pw, n, 0)) != n:
+                        raise OSError(0, "Short tee() of pipe")
+                for (pr, pw), op in zip(pipes, ops):
+                    left = n
+                    while left:
+                        left -= self._check(_libc.splice(pr, None, op, None, left,
+                                                         self.SPLICE_F_MOVE | self.SPLICE_F_MORE))
+                r_size += n
+                if progress:
+                    progress(r_size)
+
+            ret = []
+            for op in ops:
+                # an empty send() without MSG_MORE finalizes the hash
+                self._check(_libc.send(op, None, 0, 0))
+                ret.append(os.read(op, 64).encode('hex'))
+            return ret
+        finally:
+            for op in ops:
+                os.close(op)
+            for pr, pw in pipes:
+                os.close(pr)
+                os.close(pw)
+
+
+class BatchSizer(object):
+    """Size batches of computed files, from the measured hash and store throughput
+
+        The size of a batch is bounded so that hashing it takes no more
+        than `window` seconds (the work lost on interruption), and the
+        number of files so that storing it takes about `latency` seconds.
+        Until anything is measured, the first batch is kept small.
+
+        Both rates are moving averages, updated by `hashed()` and `stored()`
+    """
+    log = logging.getLogger('batches')
+    ALPHA = 0.5         # weight of the latest measurement
+    FIRST_FILES = 500
+    FIRST_SIZE = 1 << 30
+    MIN_FILES = 50
+    MAX_FILES = 20000
+    MIN_SIZE = 16 << 20
+
+    def __init__(self, window=120.0, latency=5.0, files=0, size=0):
+        self.window = window
+        self.latency = latency
+        self.fixed_files = files
+        self.fixed_size = size
+        self.hash_rate = None       # bytes/sec
+        self.store_cost = None      # sec/entry
+
+    def _average(self, old, new):
+        if old is None:
+            return new
+        return old * (1.0 - self.ALPHA) + new * self.ALPHA
+
+    def hashed(self, num, size, dt):
+        if size and dt > 0.01:
+            self.hash_rate = self._average(self.hash_rate, size / dt)
+
+    def stored(self, num, dt):
+        if num:
+            self.store_cost = self._average(self.store_cost, dt / num)
+
+    def limits(self):
+        """Limits for the next batch, as keyword arguments of `_compute_sums()`
+        """
+        if self.fixed_files:
+            files = self.fixed_files
+        elif self.store_cost:
+            files = int(self.latency / self.store_cost)
+            files = min(max(files, self.MIN_FILES), self.MAX_FILES)
+        else:
+            files = self.FIRST_FILES
+
+        if self.fixed_size:
+            size = self.fixed_size
+        elif self.hash_rate:
+            size = max(self.hash_rate * self.window, self.MIN_SIZE)
+        else:
+            size = self.FIRST_SIZE
+
+        self.log.info("Next batch: up to %d files, %s, %.0fs (hash: %s, store: %s)",
+                      files, sizeof_fmt(size), self.window,
+                      self.hash_rate and (sizeof_fmt(self.hash_rate) + '/s') or '?',
+                      self.store_cost and ('%.2f ms/entry' % (self.store_cost * 1000.0)) or '?')
+        return {'time_limit': self.window, 'size_limit': size, 'file_limit': files}
+
+
+class ScanCanceled(Exception):
+    """Raised within computations, when the scan is canceled from another thread
+    """
+    pass
+
+
+class Inotify(object):
+    """Minimal interface to inotify(7), through ctypes
+
+        Only new files are reported: those closed after writing, or moved
+        in. Sub-directories are reported too, so that the caller can watch
+        them and look for files written before the watch was in place.
+    """
+    log = logging.getLogger('inotify')
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 04000
+    IN_CLOEXEC = 02000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MOVE_SELF | IN_ONLYDIR
+    EVENT = struct.Struct('iIII') # wd, mask, cookie, len
+
+    @classmethod
+    def is_available(cls):
+        return _libc is not None and hasattr(_libc, 'inotify_init1')
+
+    def __init__(self):
+        self.fd = _libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "Cannot use inotify: %s" % os.strerror(err))
+        self.overflow = False
+        self._paths = {} # wd -> path
+
+    def close(self):
+        os.close(self.fd)
+
+    def add(self, path):
+        wd = _libc.inotify_add_watch(self.fd, path, self.WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "Cannot watch %s: %s" % (path, os.strerror(err)))
+        self._paths[wd] = path
+
+    def add_tree(self, top, onerror=None):
+        """Watch `top` and all directories under it
+
+            @return list of the files found under `top`
+        """
+        ret = []
+        for dirpath, dirnames, filenames in os.walk(top, onerror=onerror):
+            try:
+                self.add(dirpath)
+            except OSError, e:
+                if onerror is not None:
+                    onerror(e)
+            ret += [os.path.join(dirpath, f) for f in filenames]
+        self.log.debug("Watching %d directories", len(self._paths))
+        return ret
+
+    def read(self, timeout):
+        """Wait up to `timeout` seconds for events
+
+            @return list of `(path, is_dir)`. If events have been lost,
+                `overflow` is set.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+
+        ret = []
+        pos = 0
+        while pos + self.EVENT.size <= len(data):
+            wd, mask, cookie, nlen = self.EVENT.unpack_from(data, pos)
+            pos += self.EVENT.size
+            name = data[pos:pos + nlen].rstrip('\0')
+            pos += nlen
+            if mask & self.IN_Q_OVERFLOW:
+                self.overflow = True
+            elif mask & self.IN_IGNORED:
+                self._paths.pop(wd, None)
+            elif mask & self.IN_MOVE_SELF:
+                # will be watched again under its new name, if that is in a watched tree
+                _libc.inotify_rm_watch(self.fd, wd)
+            elif wd in self._paths and name:
+                is_dir = bool(mask & self.IN_ISDIR)
+                if is_dir or not (mask & self.IN_CREATE):
+                    ret.append((os.path.join(self._paths[wd], name), is_dir))
+        return ret
+
+
+def background_iter(iterable, ahead=2, name=None):
+    """Iterate over `iterable` from a thread of its own, up to `ahead` items ahead
+
+        Exceptions of the thread are re-raised to the consumer. Closing this
+        generator stops the thread, after the item it is working on.
+    """
+    queue = Queue.Queue(max(ahead, 1))
+    stop = threading.Event()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, True, 1.0)
+                return
+            except Queue.Full:
+                pass
+
+    def _run():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                _put((True, item))
+            _put((False, None))
+        except Exception:
+            _put((False, sys.exc_info()))
+
+    thr = threading.Thread(target=_run, name=name)
+    thr.daemon = True
+    thr.start()
+    try:
+        while True:
+            try:
+                ok, item = queue.get(True, 1.0)
+            except Queue.Empty:
+                continue
+            if ok:
+                yield item
+            elif item is None:
+                return
+            else:
+                raise item[0], item[1], item[2]
+    finally:
+        stop.set()
+
+
+class HashCache(object):
+    """Local database of computed checksums, so that re-scans skip unchanged files
+
+        Files are identified by `(st_dev, st_ino, size, mtime)`. Archives are
+        never modified in place, so any of these changing means a new file.
+
+        Only valid for files of a fixed filesystem: removable discs, mounted
+        one after another, re-use device and inode numbers. Volume scans
+        do not use it.
+    """
+    log = logging.getLogger('hashcache')
+    COMMIT_INTERVAL = 5.0
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(fname, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS sums ("
+                           " dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,"
+                           " algo TEXT, digest TEXT, path TEXT, last_seen INTEGER,"
+                           " PRIMARY KEY (dev, ino, size, mtime_ns, algo))")
+        self._conn.commit()
+        self._t_commit = time.time()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    @staticmethod
+    def file_key(st):
+        """Cache key for `os.stat()` result `st`
+
+            The mtime is taken in whole seconds (kept as ns, the unit of
+            the column), since its float value may not convert to the same
+            integer on every filesystem and Python build.
+        """
+        def _int64(n):
+            # SQLite integers are signed 64-bit, inodes may not be
+            if n >= (1L << 63):
+                n -= (1L << 64)
+            return n
+        return (_int64(st.st_dev), _int64(st.st_ino), st.st_size, long(st.st_mtime) * 1000000000L)
+
+    def _maybe_commit(self):
+        # called with _lock held
+        if time.time() - self._t_commit > self.COMMIT_INTERVAL:
+            self._conn.commit()
+            self._t_commit = time.time()
+
+    def lookup(self, key, algo='md5'):
+        with self._lock:
+            row = self._conn.execute("SELECT digest FROM sums WHERE dev=? AND ino=? AND size=?"
+                                     " AND mtime_ns=? AND algo=?", key + (algo,)).fetchone()
+            if row is None:
+                self.n_misses += 1
+                return None
+            self.n_hits += 1
+            self._conn.execute("UPDATE sums SET last_seen=? WHERE dev=? AND ino=? AND size=?"
+                               " AND mtime_ns=? AND algo=?", (int(time.time()),) + key + (algo,))
+            self._maybe_commit()
+            return str(row[0])
+
+    def store(self, key, digest, path, algo='md5'):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO sums VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               key + (algo, digest, path.decode('utf-8', 'replace'),
+                                      int(time.time())))
+            self._maybe_commit()
+
+    def delete(self, key, algo):
+        with self._lock:
+            self._conn.execute("DELETE FROM sums WHERE dev=? AND ino=? AND size=?"
+                               " AND mtime_ns=? AND algo=?", key + (algo,))
+            self._maybe_commit()
+
+    def vacuum(self, max_age):
+        """Drop entries of files that are gone or changed, or not seen for `max_age` days
+        """
+        with self._lock:
+            self._conn.commit()
+            n_old = self._conn.execute("DELETE FROM sums WHERE last_seen < ?",
+                                       (int(time.time() - max_age * 86400),)).rowcount
+            stale = []
+            for row in self._conn.execute("SELECT DISTINCT dev, ino, size, mtime_ns, path FROM sums"):
+                try:
+                    if HashCache.file_key(os.stat(row[4].encode('utf-8'))) == tuple(row[:4]):
+                        continue
+                except EnvironmentError:
+                    pass
+                stale.append(tuple(row[:4]))
+            self._conn.executemany("DELETE FROM sums WHERE dev=? AND ino=? AND size=? AND mtime_ns=?",
+                                   stale)
+            self._conn.commit()
+            self._conn.execute("VACUUM")
+        self.log.info("Dropped %d old and %d stale entries from %s", n_old, len(stale), self.fname)
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+        if self.n_hits or self.n_misses:
+            self.log.info("Hash cache: %d hits, %d misses", self.n_hits, self.n_misses)
+
+
+_path_strings = {}
+
+def intern_path(path):
+    """Shared copy of `path`, so that many entries keep a single one in memory
+    """
+    if type(path) is str:
+        return intern(path)
+    elif path is None:
+        return None
+    return _path_strings.setdefault(path, path)
+
+
+class ManifestEntry(object):
+    """A file of a manifest, like the `{name, size, md5sum, base_path}` dict
+
+        It behaves like that dict, but only takes the memory of its slots:
+        the directory part of `name` and `base_path` are interned, shared
+        by all entries of a directory. Any other keys (extra digests, audit
+        results) go into `extra`, only when set.
+    """
+    __slots__ = ('dirname', 'fname', 'size', 'md5sum', 'base_path', 'extra')
+
+    def __init__(self, name, size, md5sum=None, base_path=None):
+        self.name = name
+        self.size = size
+        self.md5sum = md5sum
+        self.base_path = intern_path(base_path)
+        self.extra = None
+
+    def _get_name(self):
+        return self.dirname + self.fname
+
+    def _set_name(self, name):
+        dirname, sep, self.fname = name.rpartition(os.sep)
+        self.dirname = intern_path(dirname + sep)
+
+    name = property(_get_name, _set_name)
+
+    def __getitem__(self, key):
+        if key == 'name':
+            return self.dirname + self.fname
+        elif key == 'size':
+            return self.size
+        elif key == 'md5sum':
+            return self.md5sum
+        elif key == 'base_path':
+            if self.base_path is not None:
+                return self.base_path
+        elif self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'name':
+            self.name = value
+        elif key == 'size':
+            self.size = value
+        elif key == 'md5sum':
+            self.md5sum = value
+        elif key == 'base_path':
+            self.base_path = intern_path(value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        if key in ('name', 'size', 'md5sum'):
+            return True
+        elif key == 'base_path':
+            return self.base_path is not None
+        return self.extra is not None and key in self.extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self[key]
+        if key == 'base_path':
+            self.base_path = None
+        elif key in ('name', 'size', 'md5sum'):
+            raise TypeError("Cannot remove %s of manifest entry" % key)
+        else:
+            del self.extra[key]
+        return value
+
+    def update(self, other):
+        for key, value in other.items():
+            self[key] = value
+
+    def keys(self):
+        ret = ['name', 'size', 'md5sum']
+        if self.base_path is not None:
+            ret.append('base_path')
+        if self.extra:
+            ret += self.extra.keys()
+        return ret
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def copy(self):
+        ret = ManifestEntry(self.name, self.size, self.md5sum, self.base_path)
+        if self.extra:
+            ret.extra = self.extra.copy()
+        return ret
+
+    def as_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+
+class Manifest(list):
+    """List of `ManifestEntry`, as kept by the manifestors
+
+        Storages that serialize entries get plain dicts, from `export()`
+    """
+
+    @staticmethod
+    def export(entries):
+        """Plain dicts of `entries`
+        """
+        return [isinstance(mf, ManifestEntry) and mf.as_dict() or mf for mf in entries]
+
+
+class ChunkView(object):
+    """Chunks of `size` items of sequence `seq`, each sliced only when reached
+
+        @param func if given, chunks are lists of `func(item)`
+    """
+
+    def __init__(self, seq, size, func=None):
+        self.seq = seq
+        self.size = size
+        self.func = func
+
+    def __len__(self):
+        return (len(self.seq) + self.size - 1) // self.size
+
+    def __iter__(self):
+        for i in xrange(0, len(self.seq), self.size):
+            chunk = self.seq[i:i + self.size]
+            if self.func is not None:
+                chunk = map(self.func, chunk)
+            yield chunk
+
+
 class BaseManifestor(object):
     log = logging.getLogger('manifestor')
     BS = 1024 * 1024
+    jobs = 1
+    dev_jobs = 0
+    hash_cache = None
+    use_cache = True
+    use_sidecars = False # only trusted on source trees, see SourceManifestor
+    direct_io = False
+    drop_cache = True
+    disk_order = False
+    digests = ()  # extra ones, MD5 is always computed
+    block_size = 0
+    hash_backend = 'hashlib'
+    walk_jobs = 1
+    queue_batches = 2
+    batch_opts = {}
+    use_dir_digests = True
+    pipeline = False
+    pipeline_window = 1000
 
     def __init__(self):
         self.n_files = 0
         self.n_errors = 0
         self.use_hidden = True
         self.context = {}
+        self._devices = {}
+        self._cancel = threading.Event()
+        self.batches = BatchSizer(**self.batch_opts)
+        self._dir_listing = defaultdict(list)
+        self._known_dirs = None
+        self._stream = None
+
+    @classmethod
+    def setup_options(cls, opts):
+        """Apply command-line options to all manifestors
+        """
+        cls.jobs = max(opts.jobs or 1, 1)
+        cls.dev_jobs = max(opts.dev_jobs or 0, 0)
+        cls.direct_io = opts.direct_io
+        cls.disk_order = opts.disk_order
+        if opts.block_size:
+            cls.block_size = opts.block_size * 1024 * 1024
+        cls.hash_backend = opts.hash_backend
+        if cls.hash_backend == 'afalg' and not AFAlgHasher.is_available(('md5',) + cls.digests):
+            log.warning("Kernel crypto API (AF_ALG) not available, will use hashlib")
+        if opts.digests:
+            cls.digests = tuple([d.strip().lower() for d in opts.digests.split(',')
+                                 if d.strip() and d.strip().lower() != 'md5'])
+            for algo in cls.digests:
+                try:
+                    new_digest(algo)
+                except (ValueError, ImportError):
+                    log.error("Digest %s is not available", algo)
+                    sys.exit(1)
+        cls.drop_cache = not opts.keep_page_cache
+        if opts.no_sidecars:
+            SourceManifestor.use_sidecars = False
+        cls.queue_batches = max(opts.queue_batches or 0, 0)
+        cls.walk_jobs = max(opts.walk_jobs or 1, 1)
+        cls.use_dir_digests = not opts.no_dir_digests
+        cls.pipeline = opts.pipeline
+        cls.pipeline_window = max(opts.pipeline_window or 1, 1)
+        cls.batch_opts = {'window': opts.batch_window, 'latency': opts.batch_latency,
+                          'files': max(opts.batch_files or 0, 0),
+                          'size': max(opts.batch_mb or 0, 0) * 1024 * 1024}
+        if opts.hash_cache and not opts.no_cache:
+            try:
+                cls.hash_cache = HashCache(opts.hash_cache)
+            except sqlite3.Error, e:
+                log.warning("Cannot open hash cache %s, will not use it: %s", opts.hash_cache, e)
 
     def walk_error(self, ose):
         self.log.error("error: %s", ose)
@@ -81,33 +1053,250 @@ class BaseManifestor(object):
     def get_out_manifest(self):
         raise NotImplementedError
 
+    def _open_reader(self, full_path):
+        bs = DeviceInfo.get(os.stat(full_path).st_dev).block_size(self.BS)
+        return FileReader(full_path, bs, direct=self.direct_io, drop_cache=self.drop_cache)
+
     def md5sum(self, full_path, size_hint=0):
         """Compute MD5 sum of some file
 
             Fear not, the core of this algorithm is an OpenSSL C function,
             which can be efficient enough for large buffers of input data.
             Using 1MB of buffer, this loop has been timed to perform as
-            fast as the `md5sum` UNIX utility.
+            fast as the `md5sum` UNIX utility. Buffers may be larger, on
+            devices with a larger read-ahead.
+        """
+        return self.compute_digests(full_path, size_hint)['md5sum']
+
+    def compute_digests(self, full_path, size_hint=0):
+        """Compute MD5 and any extra `digests` of some file, in a single pass
+
+            @return dict of manifest keys, like `{'md5sum': ..., 'sha256sum': ...}`
+
+            With a `block_size`, MD5 sums of each block are also computed,
+            into 'block_md5sums', from the same data.
+
+            Results are kept in `hash_cache`, if available, and re-used
+            for the same, unmodified, file. When only MD5 is needed, the sum
+            written along the file (see `read_sidecar()`) is used, too, if
+            `use_sidecars` is set for this kind of tree.
+        """
+        algos = ('md5',) + self.digests
+        if self.use_cache and self.use_sidecars and algos == ('md5',) and not self.block_size:
+            md5sum = self.read_sidecar(full_path)
+            if md5sum:
+                metrics.count('sidecar_sums')
+                return {'md5sum': md5sum}
+
+        cache_algos = algos
+        if self.block_size:
+            cache_algos += (self._block_algo(self.block_size),)
+        reader = self._open_reader(full_path)
+
+        cache_key = None
+        if self.use_cache and self.hash_cache is not None:
+            cache_key = HashCache.file_key(os.fstat(reader.fileno()))
+            hexdigests = []
+            for algo in cache_algos:
+                digest = self.hash_cache.lookup(cache_key, algo)
+                if not digest:
+                    break
+                hexdigests.append(digest)
+            else:
+                reader.close()
+                return self._digests_dict(algos, hexdigests)
+
+        try:
+            if self.hash_backend == 'afalg' and not self.block_size \
+                    and AFAlgHasher.is_available(algos):
+                hexdigests = self._digest_afalg(reader, algos, size_hint)
+            else:
+                hexdigests = self._digest_hashlib(reader, algos, size_hint)
+            if cache_key and HashCache.file_key(os.fstat(reader.fileno())) != cache_key:
+                # modified while we were reading, don't trust this result
+                cache_key = None
+        finally:
+            reader.close()
+
+        if cache_key:
+            for algo, hexdigest in zip(cache_algos, hexdigests):
+                self.hash_cache.store(cache_key, hexdigest, full_path, algo)
+        return self._digests_dict(algos, hexdigests)
+
+    @staticmethod
+    def read_sidecar(full_path):
+        """MD5 sum of `full_path`, from its "<file>.md5" sidecar, if any
+
+            The sidecar, as written by md5tee.sh while the file was, holds a
+            line of md5sum(1) format and a "# size=<bytes> mtime=<seconds>"
+            one. The sum is only trusted while the file has that size and
+            mtime.
+        """
+        try:
+            with open(full_path + SIDECAR_SUFFIX, 'rb') as fp:
+                lines = fp.read(4096).splitlines()
+            st = os.stat(full_path)
+        except EnvironmentError:
+            return None
+
+        props = {}
+        md5sum = None
+        for line in lines:
+            if line.startswith('#'):
+                for word in line[1:].split():
+                    key, sep, value = word.partition('=')
+                    if sep and value.isdigit():
+                        props[key] = int(value)
+            elif line.strip():
+                words = line.split(None, 1)
+                if len(words) == 2 and len(words[0]) == 32 \
+                        and words[1].lstrip('*') == os.path.basename(full_path):
+                    md5sum = words[0].lower()
+        if md5sum and props.get('size') == st.st_size \
+                and props.get('mtime') == int(st.st_mtime):
+            return md5sum
+        return None
+
+    @staticmethod
+    def _block_algo(block_size):
+        """Name of block digests in `hash_cache`, where they are kept space-separated
+        """
+        return 'md5@%d' % block_size
+
+    def _digests_dict(self, algos, hexdigests):
+        ret = {}
+        for algo, hexdigest in zip(algos, hexdigests):
+            ret[digest_key(algo)] = hexdigest
+        if len(hexdigests) > len(algos):
+            ret['block_size'] = self.block_size
+            ret['block_md5sums'] = hexdigests[len(algos)].split()
+        return ret
+
+    def _digest_hashlib(self, reader, algos, size_hint):
+        """Compute `algos` over data of `reader`
+
+            @return list of hex digests, plus the (space-separated) block
+                digests when `block_size` is set
         """
         ts = time.time()
         r_size = 0L
-        fp = open(full_path, 'rb')
-
+        hashers = [new_digest(algo) for algo in algos]
+        blocks = []
+        blk = None
+        blk_left = 0
+        for data in metrics.timed_iter('read', reader.chunks()):
+            if self._cancel.is_set():
+                raise ScanCanceled()
+            r_size += len(data)
+            th = time.time()
+            for h in hashers:
+                h.update(data)
+            pos = 0
+            while self.block_size and pos < len(data):
+                if not blk_left:
+                    blk = hashlib.md5()
+                    blocks.append(blk)
+                    blk_left = self.block_size
+                take = min(len(data) - pos, blk_left)
+                if take == len(data):
+                    blk.update(data)
+                else:
+                    blk.update(buffer(data, pos, take))
+                pos += take
+                blk_left -= take
+            metrics.add_time('hash', time.time() - th)
+            if time.time() - ts > 10.0:
+                self.log.info("MD5sum compute: %s of %s", sizeof_fmt(r_size), sizeof_fmt(size_hint))
+                ts = time.time()
+        ret = [h.hexdigest() for h in hashers]
+        if self.block_size:
+            ret.append(' '.join([b.hexdigest() for b in blocks]))
+        metrics.count('files_hashed')
+        metrics.count('bytes_hashed', r_size)
+        return ret
+
+    def _block_md5sum(self, full_path, block_size, index):
+        bs = self.BS
+        if block_size % bs:
+            bs = 1024 * 1024
+        reader = FileReader(full_path, bs, direct=self.direct_io, drop_cache=self.drop_cache,
+                            offset=block_size * index, length=block_size)
         md5 = hashlib.md5()
         try:
-            while True:
-                data = fp.read(self.BS)
-                if not len(data):
-                    break
-                r_size += len(data)
+            for data in reader.chunks():
                 md5.update(data)
-                if time.time() - ts > 10.0:
-                    self.log.info("MD5sum compute: %s of %s", sizeof_fmt(r_size), sizeof_fmt(size_hint))
-                    ts = time.time()
         finally:
-            fp.close()
+            reader.close()
+        return md5.hexdigest()
 
-        return md5.digest().encode('hex')
+    def verify_blocks(self, full_path, size, block_size, ref_blocks):
+        """Compare blocks of a file against reference MD5 sums, stop at the first bad one
+
+            Blocks are independent, so that up to `jobs` of them are read in
+            parallel. Progress is kept in `hash_cache` (if `use_cache`), so
+            that an interrupted verification resumes from the last good block.
+
+            @return index of the first bad block, or None if all are good
+        """
+        n_blocks = (size + block_size - 1) // block_size
+        if len(ref_blocks) != n_blocks:
+            return min(len(ref_blocks), n_blocks)
+
+        progress_algo = 'verified-' + self._block_algo(block_size)
+        cache_key = None
+        start = 0
+        if self.use_cache and self.hash_cache is not None:
+            cache_key = HashCache.file_key(os.stat(full_path))
+            start = int(self.hash_cache.lookup(cache_key, progress_algo) or 0)
+            if start:
+                self.log.info("Resuming verification of %s from block %d/%d", full_path, start, n_blocks)
+
+        pool = None
+        if self.jobs > 1:
+            pool = JobPool(self.jobs)
+        pending = deque()
+        bad = None
+        index = start
+        interrupted = True
+        try:
+            while index < n_blocks or pending:
+                while index < n_blocks and len(pending) < max(self.jobs * 2, 1):
+                    args = (full_path, block_size, index)
+                    if pool is None:
+                        pending.append(JobPool.InlineJob(self._block_md5sum, args))
+                    else:
+                        pending.append(pool.submit(self._block_md5sum, args))
+                    index += 1
+                done = index - len(pending)
+                if pending.popleft().result() != ref_blocks[done]:
+                    bad = done
+                    break
+                if cache_key:
+                    self.hash_cache.store(cache_key, str(done + 1), full_path, progress_algo)
+            interrupted = False
+        finally:
+            if pool is not None:
+                pool.close(cancel=True, wait=not interrupted)
+            if cache_key and not interrupted:
+                # finished, either way
+                self.hash_cache.delete(cache_key, progress_algo)
+        return bad
+
+    def _digest_afalg(self, reader, algos, size_hint):
+        tsl = [time.time()]
+        def _progress(r_size):
+            if time.time() - tsl[0] > 10.0:
+                self.log.info("MD5sum compute: %s of %s", sizeof_fmt(r_size), sizeof_fmt(size_hint))
+                tsl[0] = time.time()
+
+        fadvise(reader.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+        with metrics.timer('hash'): # reads are in-kernel, too
+            ret = AFAlgHasher(algos).digest(reader.fileno(), reader.bs, progress=_progress)
+        metrics.count('files_hashed')
+        metrics.count('bytes_hashed', os.fstat(reader.fileno()).st_size)
+        if reader.drop_cache:
+            fadvise(reader.fileno(), 0, 0, POSIX_FADV_DONTNEED)
+        return ret
 
     def _scan_dir(self, dpath):
         """Scan directory `dpath` for archive files, return their manifest
@@ -115,21 +1304,35 @@ class BaseManifestor(object):
             @return manifest, aka. list of {name, size, [md5sum], base_path }
                 `base_path` is `dpath`, ie. part not participating in `name`
         """
+        return Manifest(self._iter_scan_dir(dpath))
+
+    def _iter_scan_dir(self, dpath):
+        """Scan directory `dpath`, yield manifest entries as they are found
+        """
         msize = 0L
         n_files = 0
         n_allfiles = 0
-        ret_manifest = []
-        for dirpath, dirnames, filenames in os.walk(dpath, onerror=self.walk_error):
-            self.log.debug("Walking: %s", dirpath)
-            if not filenames:
-                continue
+
+        def _rel_dirpath(dirpath):
             assert dirpath.startswith(dpath), "Unexpected dirpath: %s" % dirpath
             dirpath1 = dirpath[len(dpath):].lstrip(os.sep)
             if dirpath1:
                 dirpath1 += os.sep
+            return dirpath1
+
+        walker = TreeWalker(self.walk_jobs, onerror=self.walk_error,
+                            dir_filter=lambda dirpath: self._check_dirname(_rel_dirpath(dirpath)),
+                            file_filter=self._check_filename, metrics=metrics)
+        for dirpath, dirnames, filenames, stats in metrics.timed_iter('walk', walker.walk(dpath)):
+            self.log.debug("Walking: %s", dirpath)
+            dirpath1 = _rel_dirpath(dirpath)
             if not self._check_dirname(dirpath1):
                 self.log.debug("Skipping dir: %s", dirpath1)
                 continue
+            if self.use_dir_digests:
+                listing = self._dir_listing[dirpath1]
+            else:
+                listing = []
             for f in filenames:
                 n_allfiles += 1
                 if not self._check_filename(f):
@@ -137,34 +1340,100 @@ class BaseManifestor(object):
                     continue
                 full_f = os.path.join(dirpath, f)
                 try:
-                    this_size = os.path.getsize(full_f)
-                    ret_manifest.append({'name': dirpath1 + f, 'size': this_size, 'md5sum': None, 'base_path': dpath})
+                    st = stats[f]
+                    if isinstance(st, EnvironmentError):
+                        raise st
+                    this_size = st.st_size
+                    listing.append('%s\0%d\0%.6f\n' % (f, this_size, st.st_mtime))
                     n_files += 1
                     msize += this_size
                 except EnvironmentError, e:
                     self.log.warning("File %s cannot be stat'ed, defect on volume: %s", full_f, e)
                     self.n_errors += 1
+                    continue
                 except Exception, e:
                     self.log.warning("File %s cannot be stat'ed, defect on volume: %s", full_f, e)
                     self.n_errors += 1
+                    continue
+                yield ManifestEntry(dirpath1 + f, this_size, None, dpath)
 
         self.log.info("Located %d/%d files totalling %s in %s", n_files, n_allfiles, sizeof_fmt(msize), dpath)
+        metrics.count('files_scanned', n_files)
+        metrics.count('bytes_scanned', msize)
         self.n_files += n_files
-        return ret_manifest
 
     def _check_dirname(self, d):
         return self.use_hidden or (not d.startswith('.'))
 
     def _check_filename(self, f):
+        if is_sidecar(f):
+            return False
         return self.use_hidden or (not f.startswith('.'))
 
 
+    def _get_dev(self, dpath):
+        """Device number of `dpath`, cached
+        """
+        if dpath not in self._devices:
+            try:
+                self._devices[dpath] = os.stat(dpath).st_dev
+            except EnvironmentError:
+                self._devices[dpath] = None
+        return self._devices[dpath]
+
+    def _dev_limit(self, dev):
+        """Max number of files to read in parallel from device `dev`
+        """
+        if self.disk_order and dev is not None and DeviceInfo.get(dev).rotational:
+            # a single sequential stream, any more would seek
+            return 1
+        return self.dev_jobs
+
+    def _sort_by_disk_order(self, manifest):
+        """Sort `manifest` by physical position of files on their devices
+
+            Files of each device are sorted by their offset, then devices
+            are interleaved, so that a pool of threads will read each of
+            them sequentially, in parallel.
+        """
+        by_dev = defaultdict(list)
+        for mf in manifest:
+            try:
+                dev, offset = physical_offset(os.path.join(mf['base_path'], mf['name']))
+            except EnvironmentError:
+                dev, offset = None, 0
+            by_dev[dev].append((offset, mf))
+
+        streams = []
+        for dev in sorted(by_dev.keys()):
+            by_dev[dev].sort(key=lambda x: x[0])
+            streams.append(deque([x[1] for x in by_dev[dev]]))
+        self.log.debug("Sorted %d files in disk order, over %d devices", len(manifest), len(streams))
+
+        manifest[:] = []
+        while streams:
+            for st in streams:
+                manifest.append(st.popleft())
+            streams = [st for st in streams if st]
+
+    def _submit_md5sum(self, pool, dpath, mf):
+        args = (os.path.join(dpath, mf['name']), mf.get('size', 0L))
+        if pool is None:
+            return JobPool.InlineJob(self.compute_digests, args)
+        return pool.submit(self.compute_digests, args, dev=self._get_dev(dpath))
+
     def _compute_sums(self, in_manifest, out_manifest, prefix=False,
                       time_limit=False, size_limit=False, file_limit=False):
         """Read files from `in_manifest`, compute their MD5 sums, put in `out_manifest`
 
+            Extra `digests` are stored next to 'md5sum', like 'sha256sum'
+
             If a file is already in `out_manifest`, skip
             @param prefix   prepend this to filename before storing on `out_manifest`
+
+            When `jobs` > 1, that many files are read in parallel, but they
+            are still appended to `out_manifest` in the order of `in_manifest`.
+            On any exception, unfinished entries are put back to `in_manifest`
         """
         tp = sstime = time.time()
 
@@ -173,47 +1442,84 @@ class BaseManifestor(object):
 
         dnum = 0
         done_size = 0L
+        sub_num = 0
+        sub_size = 0L
         out_names = set([m['name'] for m in out_manifest])
-        while in_manifest:
-            t2 = time.time()
-            if time_limit and (t2 > (sstime + time_limit)):
-                self.log.debug("Stopping on deadline")
-                break
-            if size_limit and done_size > size_limit:
-                break
-            if file_limit and dnum > file_limit:
-                break
+        pos = 0 # entries of `in_manifest` taken so far
 
-            mf = in_manifest.pop(0)
-            dpath = mf.pop('base_path')
-            mf_name = mf['name']
-            if prefix:
-                mf_name = os.path.join(prefix, mf['name'])
-            if mf_name in out_names:
-                continue
+        pool = None
+        window = 1
+        if self.jobs > 1:
+            pool = JobPool(self.jobs, self._dev_limit)
+            window = self.jobs * 2
 
-            if not mf['md5sum']:
-                try:
-                    mf['md5sum'] = self.md5sum(os.path.join(dpath, mf['name']), mf.get('size', 0L))
-                except IOError, e:
-                    self.n_errors += 1
-                    self.log.warning("IOError on %s: %s", mf['name'], e)
-                    mf['md5sum'] = 'unreadable'
-                except Exception:
-                    self.n_errors += 1
-                    self.log.warning("Cannot compute %s", mf['name'], exc_info=True)
-                    mf['md5sum'] = 'unreadable'
-
-            mf['name'] = mf_name # use the one with prefix
-            out_manifest.append(mf)
-            done_size += mf['size']
-            dnum += 1
+        # entries submitted for computation: (mf, mf_name, dpath, job)
+        pending = deque()
+        try:
+            while True:
+                if self._cancel.is_set():
+                    raise ScanCanceled()
+                while pos < len(in_manifest) and len(pending) < window:
+                    if time_limit and (time.time() > (sstime + time_limit)):
+                        self.log.debug("Stopping on deadline")
+                        break
+                    if size_limit and sub_size > size_limit:
+                        break
+                    if file_limit and sub_num > file_limit:
+                        break
+
+                    mf = in_manifest[pos]
+                    pos += 1
+                    dpath = mf.pop('base_path')
+                    mf_name = mf['name']
+                    if prefix:
+                        mf_name = os.path.join(prefix, mf['name'])
+                    if mf_name in out_names:
+                        continue
+
+                    job = None
+                    if not mf['md5sum']:
+                        job = self._submit_md5sum(pool, dpath, mf)
+                    pending.append((mf, mf_name, dpath, job))
+                    sub_size += mf['size']
+                    sub_num += 1
+
+                if not pending:
+                    break
 
-            # This process is expected to be long, progress indication is essential
-            if (time.time() - tp) > 2.0:
-                self.log.info("Computed %d/%d files, %s of %s", dnum, todo_num,
-                              sizeof_fmt(done_size), sizeof_fmt(todo_size))
-                tp = time.time()
+                mf, mf_name, dpath, job = pending[0]
+                if job is not None:
+                    try:
+                        mf.update(job.result())
+                    except ScanCanceled:
+                        raise
+                    except EnvironmentError, e:
+                        self.n_errors += 1
+                        self.log.warning("IOError on %s: %s", mf['name'], e)
+                        mf['md5sum'] = 'unreadable'
+                    except Exception:
+                        self.n_errors += 1
+                        self.log.warning("Cannot compute %s", mf['name'], exc_info=True)
+                        mf['md5sum'] = 'unreadable'
+                pending.popleft()
+
+                mf['name'] = mf_name # use the one with prefix
+                out_manifest.append(mf)
+                done_size += mf['size']
+                dnum += 1
+
+                # This process is expected to be long, progress indication is essential
+                if (time.time() - tp) > 2.0:
+                    self.log.info("Computed %d/%d files, %s of %s", dnum, todo_num,
+                                  sizeof_fmt(done_size), sizeof_fmt(todo_size))
+                    tp = time.time()
+        finally:
+            if pool is not None:
+                pool.close(cancel=bool(pending))
+            for mf, mf_name, dpath, job in pending:
+                mf['base_path'] = dpath
+            # drop the taken entries at once, putting back the unfinished ones
+            in_manifest[:pos] = [p[0] for p in pending]
 
         if in_manifest:
             return False
@@ -222,18 +1528,231 @@ class BaseManifestor(object):
                               sizeof_fmt(done_size), sizeof_fmt(todo_size))
             return True
 
+    def queued_sums(self):
+        """Yield batches of `produce_sums()`, computed in a background thread, as dicts
+
+            Hashing of the next batches goes on while the consumer (storage)
+            works on the yielded one, up to `queue_batches` of them waiting.
+
+            On the first Ctrl+C, hashing is canceled, but batches already
+            computed are still yielded, then KeyboardInterrupt is raised.
+            A second Ctrl+C interrupts the consumer, too.
+            Throughput of hashing and of the consumer are logged at the end.
+        """
+        stats = {'hash_time': 0.0, 'hash_size': 0L, 'hash_num': 0,
+                 'store_time': 0.0, 'store_num': 0}
+        self._cancel.clear() # from a previous, canceled or finished, run
+        if not self.queue_batches:
+            producer = self.produce_sums()
+            while True:
+                t0 = time.time()
+                try:
+                    batch = producer.next()
+                except StopIteration:
+                    break
+                self._count_batch(stats, batch, time.time() - t0)
+                t0 = time.time()
+                yield Manifest.export(batch)
+                self._count_stored(stats, batch, time.time() - t0)
+            self._log_sum_stats(stats)
+            return
+
+        queue = Queue.Queue(self.queue_batches)
+
+        def _put(item):
+            while True:
+                try:
+                    queue.put(item, True, 1.0)
+                    return
+                except Queue.Full:
+                    if self._cancel.is_set():
+                        return  # consumer is gone
+
+        def _produce():
+            try:
+                producer = self.produce_sums()
+                while True:
+                    t0 = time.time()
+                    try:
+                        batch = producer.next()
+                    except StopIteration:
+                        break
+                    self._count_batch(stats, batch, time.time() - t0)
+                    _put(('batch', batch))
+                _put(('end', None))
+            except ScanCanceled:
+                _put(('end', None))
+            except BaseException:
+                _put(('error', sys.exc_info()))
+
+        interrupted = []
+
+        def _on_sigint(signum, frame):
+            if interrupted:
+                raise KeyboardInterrupt
+            self.log.warning("Canceling computation, will still store batches already computed")
+            interrupted.append(True)
+            self._cancel.set()
+
+        # Let the consumer finish its work on the first Ctrl+C, only stop hashing
+        old_handler = None
+        if isinstance(threading.current_thread(), threading._MainThread):
+            old_handler = signal.signal(signal.SIGINT, _on_sigint)
+
+        thr = threading.Thread(target=_produce, name='produce-sums')
+        thr.daemon = True
+        thr.start()
+        try:
+            while True:
+                try:
+                    # use a timeout, or KeyboardInterrupt would never get through
+                    kind, item = queue.get(True, 1.0)
+                except Queue.Empty:
+                    continue
+                except KeyboardInterrupt:
+                    if interrupted:
+                        raise
+                    _on_sigint(signal.SIGINT, None)
+                    continue
+                if kind == 'end':
+                    break
+                elif kind == 'error':
+                    raise item[0], item[1], item[2]
+                t0 = time.time()
+                yield Manifest.export(item)
+                self._count_stored(stats, item, time.time() - t0)
+        finally:
+            # stop hashing (if the consumer is gone), then re-arm for next runs
+            self._cancel.set()
+            while thr.is_alive():
+                thr.join(1.0)
+            self._cancel.clear()
+            if old_handler is not None:
+                signal.signal(signal.SIGINT, old_handler)
+            self._log_sum_stats(stats)
+        if interrupted:
+            raise KeyboardInterrupt
+
+    def _count_batch(self, stats, batch, dt):
+        size = sum([mf['size'] for mf in batch])
+        stats['hash_time'] += dt
+        stats['hash_num'] += len(batch)
+        stats['hash_size'] += size
+        self.batches.hashed(len(batch), size, dt)
+
+    def _count_stored(self, stats, batch, dt):
+        stats['store_time'] += dt
+        stats['store_num'] += len(batch)
+        metrics.add_time('store', dt)
+        self.batches.stored(len(batch), dt)
+
+    def _log_sum_stats(self, stats):
+        if stats['hash_time'] > 0.0:
+            self.log.info("Hashed %d files, %s in %.1fs: %s/s", stats['hash_num'],
+                          sizeof_fmt(stats['hash_size']), stats['hash_time'],
+                          sizeof_fmt(stats['hash_size'] / stats['hash_time']))
+        if stats['store_num']:
+            self.log.info("Stored %d entries in %.1fs: %.1f ms/entry", stats['store_num'],
+                          stats['store_time'], stats['store_time'] * 1000.0 / stats['store_num'])
+
+    def _query_chunks(self, storage, method, manifest, lname, chunk_size=1000):
+        """Ask `storage.<method>()` about the names of `manifest`, in chunks
+
+            @return iterator of `(chunk, result)`, in the order of `manifest`
+        """
+        results = storage.map_chunks(method, ChunkView(manifest, chunk_size, lname), self)
+        return itertools.izip(ChunkView(manifest, chunk_size), metrics.timed_iter('filter', results))
+
+    @staticmethod
+    def _dir_of(name):
+        """Directory of `name`, with a trailing separator, or '' at top level
+        """
+        dname = os.path.dirname(name)
+        if dname and not dname.endswith(os.sep):
+            dname += os.sep
+        return dname
+
+    @classmethod
+    def _parent_dir(cls, dname):
+        """Parent of directory `dname`, where both have a trailing separator
+        """
+        return cls._dir_of(dname.rstrip(os.sep))
+
+    def _dir_digests(self, prefix=None):
+        """Merkle digests of the scanned directories, by (prefixed) name
+
+            The digest of a directory covers the name, size and mtime of
+            each of its files, and the digests of its sub-directories.
+        """
+        children = defaultdict(list)
+        for dname in self._dir_listing:
+            if dname:
+                children[self._parent_dir(dname)].append(dname)
+        digests = {}
+        for dname in sorted(self._dir_listing, key=len, reverse=True):
+            h = hashlib.md5()
+            for line in sorted(self._dir_listing[dname]):
+                h.update(line)
+            for child in sorted(children[dname]):
+                h.update('%s\0%s\n' % (child, digests[child]))
+            digests[dname] = h.hexdigest()
+        if prefix:
+            return dict([(os.path.join(prefix, d), dg) for d, dg in digests.items()])
+        return digests
+
+    def _filter_dirs(self, manifest, prefix, lname, storage):
+        """Drop entries of `manifest` under directories unchanged since stored
+
+            Storage is asked which of the directory digests it knows. Those
+            directories, and all of their sub-directories, are skipped.
+        """
+        digests = self._dir_digests(prefix)
+        with metrics.timer('filter'):
+            known = set(storage.filter_dirs(sorted(digests.items()), self))
+        self._known_dirs = set()
+        for dname in sorted(digests, key=len):
+            if dname in known or self._parent_dir(dname) in self._known_dirs:
+                self._known_dirs.add(dname)
+        if not self._known_dirs:
+            return
+        n_before = len(manifest)
+        manifest[:] = [m for m in manifest
+                       if self._dir_of(lname(m)) not in self._known_dirs]
+        self.log.info("Skipping %d files in %d unchanged directories, %d left to filter",
+                      n_before - len(manifest), len(self._known_dirs), len(manifest))
+
+    def _store_dir_digests(self, storage, failed, prefix):
+        """Let storage know the digests of directories now stored
+
+            Directories with any `failed` entry (by full name), or under
+            them, are left out, to be scanned again next time.
+        """
+        if self._known_dirs is None:
+            return
+        bad = set()
+        for name in failed:
+            dname = self._dir_of(name)
+            while dname not in bad:
+                bad.add(dname)
+                if not dname or dname == os.sep:
+                    break
+                dname = self._parent_dir(dname)
+        new_dirs = [(d, dg) for d, dg in sorted(self._dir_digests(prefix).items())
+                    if d not in bad and d not in self._known_dirs]
+        if new_dirs:
+            storage.store_dirs(new_dirs, self)
+
     def _filter_in(self, manifest, prefix, storage):
         if prefix:
             lname = lambda m: os.path.join(prefix, m['name'])
         else:
             lname = lambda m: m['name']
 
-        tmp_manifest = manifest
+        if self.use_dir_digests and self._dir_listing:
+            self._filter_dirs(manifest, prefix, lname, storage)
+
         tmp_out_manifest = []
-        while tmp_manifest:
-            tmp = tmp_manifest[:1000]
-            tmp_manifest = tmp_manifest[1000:]
-            outnames = storage.filter_needed(map(lname, tmp), self)
+        for tmp, outnames in self._query_chunks(storage, 'filter_needed', manifest, lname):
             if outnames:
                 outnames = set(outnames)
                 for t in tmp:
@@ -243,15 +1762,112 @@ class BaseManifestor(object):
         # Then, apply filtered list inplace
         manifest[:] = tmp_out_manifest
 
+    def stream_from(self, dpaths, storage, prefix=None, order=None):
+        """Scan `dpaths` while hashing, instead of scan_dir() + filter_in()
+
+            Files are listed, checked against `storage` and (re)ordered in
+            chunks of `pipeline_window`, so that hashing can start as soon
+            as the first chunk is ready and memory does not grow with the
+            size of the tree. `order` may be 'size' or 'disk', it only
+            applies within each chunk.
+
+            Directory digests need the complete listing, so they are not
+            used in this mode.
+
+            @return False if any of `dpaths` is not a directory
+        """
+        ret = True
+        for dpath in dpaths:
+            if not os.path.isdir(dpath):
+                self.log.error("Input arguments must be directories. \"%s\" is not", dpath)
+                self.n_errors += 1
+                ret = False
+        self.use_dir_digests = False
+        self._stream = self._iter_stream([d for d in dpaths if os.path.isdir(d)],
+                                         storage, prefix, order)
+        return ret
+
+    @property
+    def streaming(self):
+        """True after stream_from(): computed entries are yielded, not kept
+        """
+        return self._stream is not None
+
+    def _iter_stream(self, dpaths, storage, prefix, order):
+        """Yield chunks of entries that need to be hashed, see stream_from()
+        """
+        chunk = []
+        for dpath in dpaths:
+            for mf in self._iter_scan_dir(dpath):
+                chunk.append(mf)
+                if len(chunk) >= self.pipeline_window:
+                    yield self._stream_chunk(chunk, storage, prefix, order)
+                    chunk = []
+        if chunk:
+            yield self._stream_chunk(chunk, storage, prefix, order)
+
+    def _stream_chunk(self, chunk, storage, prefix, order):
+        if storage is not None:
+            self._filter_in(chunk, prefix, storage)
+        if order == 'size':
+            chunk.sort(key=lambda x: x['size'])
+        elif order == 'disk':
+            self._sort_by_disk_order(chunk)
+        return chunk
+
+    def _produce_stream(self, prefix):
+        """Compute MD5 sums of the streamed entries, in batches like produce_sums()
+
+            Batches span chunks of the stream, within the limits of `batches`
+        """
+        chunks = background_iter(self._stream, 2, 'scan-filter')
+        in_manifest = []
+        tmp_out_manifest = []
+        try:
+            while True:
+                limits = self.batches.limits()
+                t_end = time.time() + (limits['time_limit'] or 0)
+                size = 0L
+                while True:
+                    if not in_manifest:
+                        try:
+                            in_manifest = chunks.next()
+                        except StopIteration:
+                            break
+                        continue
+                    # remaining limits of this batch; 0 means none, for _compute_sums()
+                    left = {'time_limit': limits['time_limit'] and max(t_end - time.time(), 0.001),
+                            'size_limit': limits['size_limit'] and max(limits['size_limit'] - size, 1),
+                            'file_limit': limits['file_limit'] and max(limits['file_limit'] - len(tmp_out_manifest), 1)}
+                    n_out = len(tmp_out_manifest)
+                    if not self._compute_sums(in_manifest, tmp_out_manifest, prefix=prefix, **left):
+                        break
+                    size += sum([mf['size'] for mf in tmp_out_manifest[n_out:]])
+                    if (limits['time_limit'] and time.time() >= t_end) \
+                            or (limits['size_limit'] and size > limits['size_limit']) \
+                            or (limits['file_limit'] and len(tmp_out_manifest) > limits['file_limit']):
+                        break
+
+                if not tmp_out_manifest:
+                    if not in_manifest:
+                        return
+                    continue
+                yield tmp_out_manifest
+                tmp_out_manifest = []
+        finally:
+            chunks.close()
+
 
 class SourceManifestor(BaseManifestor):
     log = logging.getLogger('manifestor.source')
+    use_sidecars = True
 
     def __init__(self, prefix=None):
         super(SourceManifestor, self).__init__()
-        self.in_manifest = []
-        self.out_manifest = []
+        self.in_manifest = Manifest()
+        self.out_manifest = Manifest()
         self.prefix = prefix
+        self.n_streamed = 0
 
 
     def scan_dir(self, dpath):
@@ -263,7 +1879,7 @@ class SourceManifestor(BaseManifestor):
         return True
 
     def get_out_manifest(self):
-        return self.out_manifest
+        return Manifest.export(self.out_manifest)
 
     def sort_by_size(self):
         """Put smaller files first
@@ -273,6 +1889,11 @@ class SourceManifestor(BaseManifestor):
         """
         self.in_manifest.sort(key=lambda x: x['size'])
 
+    def sort_by_disk_order(self):
+        """Put files in their physical order, to avoid seeking
+        """
+        self._sort_by_disk_order(self.in_manifest)
+
     def compute_sums(self, time_limit=False, size_limit=False):
         """Compute MD5 sums of `in_manifest` files into `out_manifest`
 
@@ -288,15 +1909,22 @@ class SourceManifestor(BaseManifestor):
             When number of files gets large, or size/time is large, it makes sense
             to upload every now and then
             
-            Hard-coded loop limits are:
-                time: 5min
-                size: 10GB
-                files: 2000
+            Limits of each batch (time, size, files) are set by `batches`,
+            adapting to the measured throughput.
+
+            Streamed entries are not kept in `out_manifest`, only counted
+            in `n_streamed`.
         """
+        if self._stream is not None:
+            for batch in self._produce_stream(self.prefix):
+                yield batch
+                self.n_streamed += len(batch)
+            return
+
         tmp_out_manifest = []
         while self.in_manifest:
             self._compute_sums(self.in_manifest, tmp_out_manifest, prefix=self.prefix,
-                               time_limit=300.0, size_limit=1.0e10, file_limit=2000)
+                               **self.batches.limits())
             if not tmp_out_manifest:
                 continue
             
@@ -313,6 +1941,185 @@ class SourceManifestor(BaseManifestor):
         """
         self._filter_in(self.in_manifest, self.prefix, storage)
 
+    def store_dir_digests(self, storage):
+        """After a complete scan, let `storage` know of unchanged directories
+        """
+        failed = [mf['name'] for mf in self.out_manifest if mf['md5sum'] == 'unreadable']
+        failed += [os.path.join(self.prefix or '', mf['name']) for mf in self.in_manifest]
+        self._store_dir_digests(storage, failed, self.prefix)
+
+class WatchManifestor(SourceManifestor):
+    """Register the new files of some trees, as soon as they are written
+
+        New files are noticed through inotify. Once a file has not been
+        modified for `settle` seconds, it is hashed and stored, along with
+        any others ready by then. Every `reconcile` seconds, the trees are
+        scanned in full, like the sources mode does, to catch files whose
+        events have been missed. Files that cannot be stored are tried
+        again, after a backoff.
+    """
+    log = logging.getLogger('manifestor.watch')
+    IDLE_WAIT = 60.0
+    RETRY_BACKOFF = 30.0 # sec, doubled on each failure
+    RETRY_MAX = 900.0
+
+    def __init__(self, dpaths, prefix=None, settle=5.0, reconcile=3600.0):
+        super(WatchManifestor, self).__init__(prefix)
+        self.dpaths = [os.path.normpath(d) for d in dpaths]
+        self.settle = settle
+        self.reconcile = reconcile
+        self._pending = {} # full path -> time to check it again
+        self._retries = {} # full path -> failed attempts to store it
+
+    def _base_of(self, full_path):
+        for dpath in self.dpaths:
+            if full_path.startswith(dpath + os.sep):
+                return dpath
+        return None
+
+    def _ready_files(self, now):
+        """Take pending files not modified for `settle` seconds, as a manifest
+        """
+        ret = Manifest()
+        for full_path, due in self._pending.items():
+            if due > now:
+                continue
+            try:
+                st = os.stat(full_path)
+            except EnvironmentError:
+                # temporary file, already gone
+                del self._pending[full_path]
+                self._retries.pop(full_path, None)
+                continue
+            if st.st_mtime + self.settle > now:
+                self._pending[full_path] = st.st_mtime + self.settle
+                continue
+            del self._pending[full_path]
+            dpath = self._base_of(full_path)
+            if dpath is None or not stat.S_ISREG(st.st_mode):
+                continue
+            name = full_path[len(dpath):].lstrip(os.sep)
+            parts = name.split(os.sep)
+            if not (self._check_filename(parts[-1]) and all(map(self._check_dirname, parts[:-1]))):
+                continue
+            ret.append(ManifestEntry(name, st.st_size, None, dpath))
+        return ret
+
+    def _retry(self, full_paths):
+        """Put files back to pending, to be stored again after a backoff
+        """
+        now = time.time()
+        for full_path in full_paths:
+            n_failed = self._retries.get(full_path, 0)
+            self._retries[full_path] = n_failed + 1
+            self._pending[full_path] = now + min(self.RETRY_BACKOFF * (2 ** n_failed), self.RETRY_MAX)
+
+    def _store(self, storage):
+        """Hash and store `in_manifest`, in batches
+
+            @return False if storage has failed
+        """
+        try:
+            storage.consume_manifests(self, self.queued_sums())
+        except requests.exceptions.RequestException, e:
+            self.log.warning("Cannot store files, will retry later: %s", e)
+            self.n_errors += 1
+            return False
+        return True
+
+    def _reconcile(self, storage):
+        """Scan the trees in full, store any files not stored yet
+        """
+        self._dir_listing = defaultdict(list)
+        self._known_dirs = None
+        self.in_manifest = Manifest()
+        self.out_manifest = Manifest()
+        for dpath in self.dpaths:
+            self.in_manifest += self._scan_dir(dpath)
+        try:
+            self.filter_in(storage)
+        except requests.exceptions.RequestException, e:
+            self.log.warning("Cannot filter files, will retry on next full scan: %s", e)
+            self.n_errors += 1
+            return
+
+        # files still being written are left to their events
+        settling = [mf for mf in self.in_manifest
+                    if os.path.join(mf['base_path'], mf['name']) in self._pending]
+        if settling:
+            self.in_manifest[:] = [mf for mf in self.in_manifest
+                                   if os.path.join(mf['base_path'], mf['name']) not in self._pending]
+        self._store(storage)
+        failed = [mf['name'] for mf in self.out_manifest if mf['md5sum'] == 'unreadable']
+        failed += [os.path.join(self.prefix or '', mf['name']) for mf in self.in_manifest + settling]
+        try:
+            self._store_dir_digests(storage, failed, self.prefix)
+        except requests.exceptions.RequestException, e:
+            self.log.warning("Cannot store directory digests: %s", e)
+        self._dir_listing = defaultdict(list)
+        self._known_dirs = None
+
+    def watch(self, storage):
+        """Watch the trees until interrupted
+        """
+        inotify = Inotify()
+        try:
+            for dpath in self.dpaths:
+                inotify.add_tree(dpath, onerror=self.walk_error)
+            self.log.info("Watching %s", ', '.join(self.dpaths))
+            # a full scan, now that the watches are in place
+            next_scan = time.time()
+            while True:
+                now = time.time()
+                if inotify.overflow or now >= next_scan:
+                    if inotify.overflow:
+                        self.log.warning("Events have been lost, scanning trees in full")
+                        inotify.overflow = False
+                    self._reconcile(storage)
+                    next_scan = time.time() + (self.reconcile or float('inf'))
+                    continue
+
+                self.in_manifest = self._ready_files(now)
+                self.out_manifest = Manifest()
+                if self.in_manifest:
+                    self.log.info("Storing %d new files", len(self.in_manifest))
+                    full_paths = [os.path.join(mf['base_path'], mf['name'])
+                                  for mf in self.in_manifest]
+                    try:
+                        self._filter_in(self.in_manifest, self.prefix, storage)
+                    except requests.exceptions.RequestException, e:
+                        self.log.warning("Cannot filter files, will retry later: %s", e)
+                        self.n_errors += 1
+                        self._retry(full_paths)
+                        continue
+                    if self._store(storage):
+                        for full_path in full_paths:
+                            self._retries.pop(full_path, None)
+                    else:
+                        # those stored will be filtered out, next time
+                        self._retry(full_paths)
+                    continue
+
+                timeout = min(next_scan - now, self.IDLE_WAIT)
+                if self._pending:
+                    timeout = min(timeout, min(self._pending.values()) - now)
+                events = inotify.read(max(timeout, 0.1))
+                now = time.time()
+                for path, is_dir in events:
+                    if is_dir:
+                        for fpath in inotify.add_tree(path, onerror=self.walk_error):
+                            self._pending[fpath] = now + self.settle
+                    else:
+                        self._pending[path] = now + self.settle
+                if not (events or self._pending):
+                    try:
+                        storage.flush_spool()
+                    except requests.exceptions.RequestException, e:
+                        self.log.debug("Cannot flush spool: %s", e)
+        finally:
+            inotify.close()
+
+
 class MoveManifestor(BaseManifestor):
     """This one will only read filenames, check with storage and move files away
     """
@@ -320,8 +2127,8 @@ class MoveManifestor(BaseManifestor):
 
     def __init__(self,prefix=None):
         super(MoveManifestor, self).__init__()
-        self.in_manifest = []
-        self.move_manifest = []
+        self.in_manifest = Manifest()
+        self.move_manifest = Manifest()
         self.prefix = prefix
 
 
@@ -345,12 +2152,8 @@ class MoveManifestor(BaseManifestor):
         else:
             lname = lambda m: m['name']
 
-        tmp_manifest = self.in_manifest
-        tmp_out_manifest = []
-        while tmp_manifest:
-            tmp = tmp_manifest[:1000]
-            tmp_manifest = tmp_manifest[1000:]
-            outnames = storage.filter_checked(map(lname, tmp), self)
+        tmp_out_manifest = Manifest()
+        for tmp, outnames in self._query_chunks(storage, 'filter_checked', self.in_manifest, lname):
             if outnames:
                 outnames = set(outnames)
                 for t in tmp:
@@ -379,7 +2182,9 @@ class MoveManifestor(BaseManifestor):
 
             log.info("Move %s to %s", src_fname, out_fname)
             if not dry:
-                shutil.move(src_fname, out_fname)
+                with metrics.timer('move'):
+                    shutil.move(src_fname, out_fname)
+                metrics.count('files_moved')
             n_moved += 1
 
         log.info("Moved %d files", n_moved)
@@ -388,10 +2193,11 @@ class OnlyGoodManifestor(MoveManifestor):
     """This one will fetch size+MD5SUM, move bad files away
     """
     log = logging.getLogger('manifestor.move.bad')
+    use_cache = False # this is an audit, must read the actual data
 
     def __init__(self,prefix=None):
         super(OnlyGoodManifestor, self).__init__(prefix)
-        self.scan_manifest = []
+        self.scan_manifest = Manifest()
 
     def _get_bad_sums(self):
         sums_bad = defaultdict(long)
@@ -411,18 +2217,15 @@ class OnlyGoodManifestor(MoveManifestor):
         else:
             lname = lambda m: m['name']
 
-        tmp_manifest = self.in_manifest
-        tmp_out_manifest = []
-        tmp_scan_manifest = []
-        while tmp_manifest:
-            tmp = tmp_manifest[:1000]
-            tmp_manifest = tmp_manifest[1000:]
-            ldetails = storage.get_details(map(lname, tmp), self)
-            
+        tmp_out_manifest = Manifest()
+        tmp_scan_manifest = Manifest()
+        for tmp, ldetails in self._query_chunks(storage, 'get_details', self.in_manifest, lname):
+
             fdetails = {}
             if ldetails:
-                for name, size, md5sum, policy in ldetails:
-                    fdetails[name] = (size, md5sum, policy)
+                # (name, size, md5sum, policy [, blocks])
+                for det in ldetails:
+                    fdetails[det[0]] = tuple(det[1:])
             
             for t in tmp:
                 dets = fdetails.get(lname(t), None)
@@ -436,6 +2239,9 @@ class OnlyGoodManifestor(MoveManifestor):
                     # No md5sum computed so far, most likely end up here
                     t['orig_md5sum'] = dets[1]
                     t['orig_name'] = t['name']
+                    if len(dets) > 3 and dets[3] and dets[3].get('block_md5sums'):
+                        t['ref_block_size'] = dets[3]['block_size']
+                        t['ref_blocks'] = dets[3]['block_md5sums']
                     tmp_scan_manifest.append(t)
                     continue
                 else:
@@ -449,15 +2255,78 @@ class OnlyGoodManifestor(MoveManifestor):
     def sort_by_size(self):
         """Put smaller files first
         """
-        self.scan_manifest.sort(key=lambda x: x['size'])
+        self.scan_manifest.sort(key=lambda x: x['size'])
+
+    def sort_by_disk_order(self):
+        self._sort_by_disk_order(self.scan_manifest)
+
+    def _get_ref_blocks(self, t, full_path):
+        """Reference block MD5 sums for entry `t`, as `(block_size, list)`
+
+            Either given by the storage, or found in `hash_cache`, if the
+            latter has also recorded the MD5 sum that storage knows.
+        """
+        if t.get('ref_blocks'):
+            return t['ref_block_size'], t['ref_blocks']
+        if self.block_size and self.hash_cache is not None:
+            key = HashCache.file_key(os.stat(full_path))
+            if self.hash_cache.lookup(key, 'md5') == t['orig_md5sum']:
+                blocks = self.hash_cache.lookup(key, self._block_algo(self.block_size))
+                if blocks:
+                    return self.block_size, blocks.split()
+        return None
+
+    def _verify_by_blocks(self, time_limit=False, size_limit=False):
+        """Verify `scan_manifest` entries having reference block sums
+
+            Those are checked block by block, stopping at the first bad one,
+            instead of reading the whole file. Rest remain in `scan_manifest`
+        """
+        sstime = time.time()
+        done_size = 0L
+        rest = []
+        pos = 0
+        try:
+            while pos < len(self.scan_manifest):
+                if time_limit and (time.time() > (sstime + time_limit)):
+                    break
+                if size_limit and done_size > size_limit:
+                    break
+                t = self.scan_manifest[pos]
+                full_path = os.path.join(t['base_path'], t['name'])
+                try:
+                    ref = self._get_ref_blocks(t, full_path)
+                    if not ref:
+                        rest.append(t)
+                        pos += 1
+                        continue
+                    bad = self.verify_blocks(full_path, t['size'], ref[0], ref[1])
+                except EnvironmentError, e:
+                    self.n_errors += 1
+                    self.log.warning("IOError on %s: %s", t['name'], e)
+                    bad = 0
+                pos += 1
+                done_size += t['size']
+                if bad is not None:
+                    self.log.debug("Bad block #%d in %s", bad, t['name'])
+                    t['bad'] = 'md5sum'
+                    t['bad_block'] = bad
+                    t['name'] = t.pop('orig_name')
+                    self.move_manifest.append(t)
+        finally:
+            self.scan_manifest[:pos] = rest
 
     def compute_sums(self, time_limit=False, size_limit=False):
         """Compute MD5 sums of `scan_manifest` files into `move_manifest`
         
             This step is optional. Non-md5-matching files will only be moved
             if this function is called.
+
+            Files with known block MD5 sums are verified block by block,
+            the rest are read in full.
         """
 
+        self._verify_by_blocks(time_limit=time_limit, size_limit=size_limit)
         tmp_out_manifest = []
         self._compute_sums(self.scan_manifest, tmp_out_manifest, prefix=self.prefix,
                            time_limit=time_limit, size_limit=size_limit)
@@ -494,8 +2363,8 @@ class CopyManifestor(BaseManifestor):
 
     def __init__(self,prefix=None):
         super(CopyManifestor, self).__init__()
-        self.in_manifest = []
-        self.cn_manifest = []
+        self.in_manifest = Manifest()
+        self.cn_manifest = Manifest()
         self.prefix = prefix
 
 
@@ -519,12 +2388,9 @@ class CopyManifestor(BaseManifestor):
         else:
             lname = lambda m: m['name']
 
-        tmp_manifest = self.in_manifest
-        tmp_out_manifest = []
-        while tmp_manifest:
-            tmp = tmp_manifest[:1000]
-            tmp_manifest = tmp_manifest[1000:]
-            checked = set( storage.filter_checked(map(lname, tmp), self) or [])
+        tmp_out_manifest = Manifest()
+        for tmp, checked in self._query_chunks(storage, 'filter_checked', self.in_manifest, lname):
+            checked = set(checked or [])
             for t in tmp:
                 if lname(t) not in checked:
                     tmp_out_manifest.append(t)
@@ -571,7 +2437,11 @@ class CopyManifestor(BaseManifestor):
                     tmp_size += et[1]
                 args.append(out_dir)
                 
-                subprocess.check_call(args, cwd=base_dir) # rsync call!
+                with metrics.timer('rsync'):
+                    subprocess.check_call(args, cwd=base_dir) # rsync call!
+                if not dry:
+                    metrics.count('files_copied', len(mfs))
+                    metrics.count('bytes_copied', tmp_size)
 
                 n_moved += len(mfs)
                 copied_size += tmp_size
@@ -582,16 +2452,18 @@ class CopyManifestor(BaseManifestor):
 
 class VolumeManifestor(BaseManifestor):
     log = logging.getLogger('manifestor.source')
+    use_cache = False # discs re-use device and inode numbers, must read their data
+    use_sidecars = False # a volume is scanned to verify what got written on it
 
     def __init__(self, label='', uuid=False):
         super(VolumeManifestor, self).__init__()
-        self.manifest = []
+        self.manifest = Manifest()
         self.context['vol_label'] = label
         if uuid:
             self.context['uuid'] = uuid
 
     def get_out_manifest(self):
-        return self.manifest
+        return Manifest.export(self.manifest)
 
     def scan_dir(self, dpath):
         if not os.path.isdir(dpath):
@@ -610,13 +2482,18 @@ class VolumeManifestor(BaseManifestor):
         """
         self.manifest.sort(key=lambda x: x['size'])
 
+    def sort_by_disk_order(self):
+        """Put files in their physical order, to avoid seeking
+        """
+        self._sort_by_disk_order(self.manifest)
+
     def compute_sums(self, time_limit=False, size_limit=False):
         """Compute MD5 sums of `in_manifest` files into `out_manifest`
 
             @param time_limit time (seconds) to stop after. Useful for test runs
         """
         in_manifest = self.manifest
-        out_manifest = []
+        out_manifest = Manifest()
         try:
             self._compute_sums(in_manifest, out_manifest,
                             time_limit=time_limit, size_limit=size_limit)
@@ -630,17 +2507,21 @@ class VolumeManifestor(BaseManifestor):
             When number of files gets large, or size/time is large, it makes sense
             to upload every now and then
             
-            Hard-coded loop limits are:
-                time: 5min
-                size: 10GB
-                files: 2000
+            Limits of each batch (time, size, files) are set by `batches`,
+            adapting to the measured throughput.
+
+            Streamed entries are not kept after being yielded.
         """
+        if self._stream is not None:
+            for batch in self._produce_stream(False):
+                yield batch
+            return
+
         tmp_out_manifest = []
         in_manifest = self.manifest[:]
-        out_manifest = []
+        out_manifest = Manifest()
         while in_manifest:
-            self._compute_sums(in_manifest, tmp_out_manifest,
-                               time_limit=300.0, size_limit=1.0e10, file_limit=2000)
+            self._compute_sums(in_manifest, tmp_out_manifest, **self.batches.limits())
             if not tmp_out_manifest:
                 continue
             
@@ -659,6 +2540,12 @@ class VolumeManifestor(BaseManifestor):
         """
         self._filter_in(self.manifest, False, storage)
 
+    def store_dir_digests(self, storage):
+        """After a complete scan, let `storage` know of unchanged directories
+        """
+        failed = [mf['name'] for mf in self.manifest if mf['md5sum'] == 'unreadable']
+        self._store_dir_digests(storage, failed, False)
+
 
 class BaseStorageInterface(object):
     def __init__(self, options):
@@ -687,6 +2574,15 @@ class BaseStorageInterface(object):
 
     def write_manifest(self, worker):
         raise NotImplementedError
+
+    def map_chunks(self, method, chunks, worker):
+        """Call `method` (like 'filter_needed') for each of `chunks` of names
+
+            @return iterator over results, in the order of `chunks`
+        """
+        func = getattr(self, method)
+        for chunk in chunks:
+            yield func(chunk, worker)
     
     def consume_manifests(self, worker, producer):
         """Continuously write manifests, as generated by producer
@@ -697,6 +2593,24 @@ class BaseStorageInterface(object):
         """
         raise NotImplementedError
 
+    def filter_dirs(self, dir_digests, worker):
+        """Take list of `(dirname, digest)`, return the dirnames whose digest is known
+
+            Names under known directories need not be filtered at all. By
+            default, no directory is known.
+        """
+        return []
+
+    def store_dirs(self, dir_digests, worker):
+        """Remember `(dirname, digest)` of directories, whose files are all stored
+        """
+        pass
+
+    def flush_spool(self):
+        """Store batches kept from earlier, failed, attempts (if storage keeps any)
+        """
+        pass
+
     def test(self):
         return 'OK'
 
@@ -707,6 +2621,13 @@ class DryStorage(BaseStorageInterface):
     def filter_needed(self, in_fnames, worker):
         return in_fnames
 
+    def consume_manifests(self, worker, producer):
+        # results are printed once, by write_manifest(), unless streamed
+        from pprint import pprint
+        for batch in producer:
+            if worker.streaming:
+                pprint(batch)
+
     def write_manifest(self, worker):
         print "Results:"
         from pprint import pprint
@@ -717,21 +2638,27 @@ class JSONStorage(BaseStorageInterface):
     def __init__(self, opts):
         self.fname = opts.output
         self.old_manifest = []
+        self._old_fnames = None
 
-    def filter_needed(self, in_fnames, worker):
-        """Read existing JSON file, re-using previous results
+    def _load(self):
+        """Read existing JSON file, once
         """
+        if self._old_fnames is not None:
+            return
         if os.path.exists(self.fname):
             fp = file(self.fname, 'rb')
             data = json.load(fp)
+            fp.close()
             assert isinstance(data, list), "Bad data: %s" % type(data)
             self.old_manifest = data
-            old_fnames = set([o['name'] for o in self.old_manifest])
-
             self.log.info("Old data read from %s", self.fname)
-            return filter(lambda f: f not in old_fnames, in_fnames)
-        else:
-            return in_fnames
+        self._old_fnames = set([o['name'] for o in self.old_manifest])
+
+    def filter_needed(self, in_fnames, worker):
+        """Use existing JSON file, re-using previous results
+        """
+        self._load()
+        return filter(lambda f: f not in self._old_fnames, in_fnames)
 
     def write_manifest(self, worker):
         self.old_manifest += worker.get_out_manifest()
@@ -748,13 +2675,628 @@ class JSONStorage(BaseStorageInterface):
             json.dump(self.old_manifest, fp)
             fp.close()
 
+class JournalStorage(JSONStorage):
+    """JSON storage that appends batches to a journal, rather than re-writing
+
+        Each batch is appended to "<output>.journal" as a single line of
+        JSON, with one write and fsync. Every `COMPACT_BATCHES` batches, and
+        at the end, all entries are compacted into the "<output>" file, which
+        stays the plain JSON list that JSONStorage reads.
+
+        A half-written last line of the journal (after a crash) is dropped.
+        Entries are unique by name, later ones replacing earlier.
+    """
+    log = logging.getLogger('storage.journal')
+    COMPACT_BATCHES = 100
+
+    def __init__(self, opts):
+        super(JournalStorage, self).__init__(opts)
+        self.journal_fname = self.fname + '.journal'
+        self._n_batches = 0
+        self._journaled = set() # ids of workers, whose entries are journaled
+
+    def _load(self):
+        if self._old_fnames is not None:
+            return
+        super(JournalStorage, self)._load()
+        if not os.path.exists(self.journal_fname):
+            return
+
+        n_entries = 0
+        good_size = 0
+        with open(self.journal_fname, 'rb') as fp:
+            for line in fp:
+                try:
+                    if not line.endswith('\n'):
+                        raise ValueError("incomplete line")
+                    batch = json.loads(line)
+                except ValueError, e:
+                    self.log.warning("Dropping broken journal entry at %d of %s: %s",
+                                     good_size, self.journal_fname, e)
+                    break
+                good_size += len(line)
+                self.old_manifest += batch
+                self._old_fnames.update([o['name'] for o in batch])
+                n_entries += len(batch)
+        if good_size < os.path.getsize(self.journal_fname):
+            with open(self.journal_fname, 'r+b') as fp:
+                fp.truncate(good_size)
+        self.log.info("Journal: %d entries read from %s", n_entries, self.journal_fname)
+
+    def _append(self, batch):
+        data = json.dumps(batch) + '\n'
+        fd = os.open(self.journal_fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.old_manifest += batch
+        if self._old_fnames is not None:
+            self._old_fnames.update([o['name'] for o in batch])
+        self._n_batches += 1
+
+    def compact(self):
+        """Write all entries into the JSON file, atomically, then drop the journal
+        """
+        by_name = {}
+        manifest = []
+        for o in self.old_manifest:
+            if o['name'] in by_name:
+                manifest[by_name[o['name']]] = o
+            else:
+                by_name[o['name']] = len(manifest)
+                manifest.append(o)
+        self.old_manifest = manifest
+
+        tmp_fname = self.fname + '.tmp'
+        fp = open(tmp_fname, 'wb')
+        json.dump(self.old_manifest, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+        fp.close()
+        os.rename(tmp_fname, self.fname)
+        if os.path.exists(self.journal_fname):
+            os.unlink(self.journal_fname)
+        self.log.info("Compacted %d entries into %s", len(self.old_manifest), self.fname)
+
+    def write_manifest(self, worker):
+        """Append entries of `worker`, unless consumed already, and compact
+        """
+        self._load()
+        if id(worker) in self._journaled:
+            self._journaled.discard(id(worker))
+            if not os.path.exists(self.journal_fname):
+                return
+        else:
+            self._append(worker.get_out_manifest())
+        self.compact()
+
+    def consume_manifests(self, worker, producer):
+        self._load()
+        self._journaled.add(id(worker))
+        for batch in producer:
+            self._append(batch)
+            if not (self._n_batches % self.COMPACT_BATCHES):
+                self.compact()
+        self.compact()
+
+class SQLiteStorage(BaseStorageInterface):
+    """Offline storage, keeping the catalog of archives in an SQLite database
+
+        Archives from sources go into `archives`, while files found on
+        volumes go into `volume_files`. An archive is considered "checked"
+        (safely backed) when a file of the same size and MD5 sum has been
+        found on any volume.
+
+        All lookups are indexed, costing time proportional to the batch of
+        names asked, not the size of the catalog.
+    """
+    log = logging.getLogger('storage.sqlite')
+    CHUNK = 500 # names per query, below SQLITE_MAX_VARIABLE_NUMBER
+    MAIN_KEYS = ('name', 'size', 'md5sum', 'base_path')
+
+    def __init__(self, opts):
+        self.fname = opts.db or ':memory:'
+        self._conn = sqlite3.connect(self.fname, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS archives (name TEXT PRIMARY KEY, size INTEGER,
+                md5sum TEXT, policy TEXT NOT NULL DEFAULT 'keep', extra TEXT, updated INTEGER);
+            CREATE INDEX IF NOT EXISTS archives_size ON archives(size);
+            CREATE INDEX IF NOT EXISTS archives_md5sum ON archives(md5sum);
+            CREATE TABLE IF NOT EXISTS volumes (id INTEGER PRIMARY KEY, uuid TEXT, label TEXT,
+                fstype TEXT, size INTEGER, complete INTEGER NOT NULL DEFAULT 0, updated INTEGER);
+            CREATE UNIQUE INDEX IF NOT EXISTS volumes_key ON volumes(uuid, label);
+            CREATE TABLE IF NOT EXISTS volume_files (volume_id INTEGER, name TEXT, size INTEGER,
+                md5sum TEXT, extra TEXT, PRIMARY KEY (volume_id, name));
+            CREATE INDEX IF NOT EXISTS volume_files_md5sum ON volume_files(md5sum, size);
+            CREATE TABLE IF NOT EXISTS dir_digests (volume_id INTEGER NOT NULL, name TEXT,
+                digest TEXT, updated INTEGER, PRIMARY KEY (volume_id, name));
+            """)
+        self._conn.commit()
+
+    def _chunks(self, in_fnames):
+        for i in xrange(0, len(in_fnames), self.CHUNK):
+            yield in_fnames[i:i+self.CHUNK]
+
+    @staticmethod
+    def _marks(names):
+        return ','.join('?' * len(names))
+
+    def _volume_id(self, context, create=False):
+        """Id of volume described by `context` (uuid, vol_label), or None for sources
+
+            Unlabeled volumes (empty `vol_label`) are known by their uuid.
+        """
+        uuid = context.get('uuid')
+        label = context.get('vol_label')
+        if uuid is None and label is None:
+            return None
+        if not (uuid or label):
+            raise ValueError("Volume has neither a UUID nor a label, cannot catalog it")
+        key = (uuid or '', label or '')
+        row = self._conn.execute("SELECT id FROM volumes WHERE uuid=? AND label=?", key).fetchone()
+        if row:
+            return row[0]
+        if not create:
+            return False
+        cr = self._conn.execute("INSERT INTO volumes (uuid, label, fstype, size, updated)"
+                                " VALUES (?, ?, ?, ?, ?)", key + (context.get('fstype'),
+                                context.get('size'), int(time.time())))
+        return cr.lastrowid
+
+    def filter_needed(self, in_fnames, worker):
+        known = set()
+        with self._lock:
+            vol_id = self._volume_id(worker.context)
+            for names in self._chunks(in_fnames):
+                if vol_id is None:
+                    query = "SELECT name FROM archives WHERE name IN (%s)" \
+                            " AND md5sum IS NOT NULL AND md5sum != 'unreadable'"
+                    args = names
+                elif vol_id is False:
+                    continue # unknown volume, all needed
+                else:
+                    query = "SELECT name FROM volume_files WHERE volume_id=? AND name IN (%s)"
+                    args = [vol_id] + names
+                known.update([r[0] for r in self._conn.execute(query % self._marks(names), args)])
+        return [f for f in in_fnames if f not in known]
+
+    def filter_checked(self, in_fnames, worker):
+        ret = []
+        with self._lock:
+            for names in self._chunks(in_fnames):
+                ret += [r[0] for r in self._conn.execute(
+                        "SELECT a.name FROM archives AS a WHERE a.name IN (%s)"
+                        " AND a.md5sum IS NOT NULL AND a.md5sum != 'unreadable'"
+                        " AND EXISTS (SELECT 1 FROM volume_files AS v"
+                        "    WHERE v.md5sum = a.md5sum AND v.size = a.size)" % self._marks(names),
+                        names)]
+        return ret
+
+    def get_details(self, in_fnames, worker):
+        """Return list of `(fname, size, MD5SUM, policy, blocks)` for each of `in_fnames`
+
+            `blocks`, when known, is a dict of 'block_size', 'block_md5sums'
+        """
+        ret = []
+        with self._lock:
+            for names in self._chunks(in_fnames):
+                for name, size, md5sum, policy, extra in self._conn.execute(
+                        "SELECT name, size, md5sum, policy, extra FROM archives"
+                        " WHERE name IN (%s)" % self._marks(names), names):
+                    extra = json.loads(extra or '{}')
+                    blocks = None
+                    if extra.get('block_md5sums'):
+                        blocks = {'block_size': extra['block_size'],
+                                  'block_md5sums': extra['block_md5sums']}
+                    ret.append((name, size, md5sum, policy, blocks))
+        return ret
+
+    def filter_dirs(self, dir_digests, worker):
+        """Known directories, for volumes by their volume id, for sources by 0
+        """
+        known = []
+        with self._lock:
+            vol_id = self._volume_id(worker.context)
+            if vol_id is False:
+                return []
+            by_name = dict(dir_digests)
+            names = by_name.keys()
+            for chunk in self._chunks(names):
+                for name, digest in self._conn.execute(
+                        "SELECT name, digest FROM dir_digests WHERE volume_id=? AND name IN (%s)"
+                        % self._marks(chunk), [vol_id or 0] + chunk):
+                    if by_name[name] == digest:
+                        known.append(name)
+        return known
+
+    def store_dirs(self, dir_digests, worker):
+        now = int(time.time())
+        with self._lock:
+            vol_id = self._volume_id(worker.context, create=True)
+            self._conn.executemany("INSERT OR REPLACE INTO dir_digests (volume_id, name, digest, updated)"
+                                   " VALUES (%d, ?, ?, %d)" % (vol_id or 0, now), dir_digests)
+            self._conn.commit()
+        self.log.info("Stored digests of %d directories", len(dir_digests))
+
+    def write_manifest(self, worker):
+        self.consume_manifests(worker, [worker.get_out_manifest()])
+
+    def consume_manifests(self, worker, producer):
+        for batch in producer:
+            self.store_batch(worker, batch)
+        self.finish_volume(worker)
+
+    def store_batch(self, worker, batch):
+        """Store entries of `batch`, for the source or volume of `worker`
+        """
+        now = int(time.time())
+        with self._lock:
+            vol_id = self._volume_id(worker.context, create=True)
+            rows = []
+            for mf in batch:
+                extra = dict([(k, v) for k, v in mf.items() if k not in self.MAIN_KEYS])
+                rows.append((mf['name'], mf['size'], mf['md5sum'],
+                             extra and json.dumps(extra) or None))
+            if vol_id is None:
+                self._conn.executemany("INSERT OR REPLACE INTO archives"
+                                       " (name, size, md5sum, extra, updated, policy)"
+                                       " VALUES (?, ?, ?, ?, %d, COALESCE("
+                                       "  (SELECT policy FROM archives WHERE name=?), 'keep'))" % now,
+                                       [r + (r[0],) for r in rows])
+            else:
+                self._conn.executemany("INSERT OR REPLACE INTO volume_files"
+                                       " (volume_id, name, size, md5sum, extra)"
+                                       " VALUES (%d, ?, ?, ?, ?)" % vol_id, rows)
+            self._conn.commit()
+        self.log.info("Stored %d entries", len(batch))
+
+    def finish_volume(self, worker):
+        """Mark volume of `worker` as completely scanned
+        """
+        with self._lock:
+            vol_id = self._volume_id(worker.context)
+            if vol_id:
+                self._conn.execute("UPDATE volumes SET complete=1, updated=? WHERE id=?",
+                                   (int(time.time()), vol_id))
+                self._conn.commit()
+
+    def lookup_fs(self, props):
+        with self._lock:
+            vol_id = self._volume_id(props)
+            if vol_id:
+                row = self._conn.execute("SELECT complete FROM volumes WHERE id=?", (vol_id,)).fetchone()
+                if row and row[0]:
+                    return None
+        return {'action': 'scan'}
+
+    def test(self):
+        with self._lock:
+            n_arch = self._conn.execute("SELECT COUNT(*) FROM archives").fetchone()[0]
+            n_vols = self._conn.execute("SELECT COUNT(*) FROM volumes").fetchone()[0]
+        return 'OK: %d archives, %d volumes in %s' % (n_arch, n_vols, self.fname)
+
+
+class WireFormat(object):
+    """Compact encoding of F3 requests, used where the server advertises it
+
+        - request bodies compressed, with `Content-Encoding` gzip or zstd
+        - name lists front-coded: sorted, each name as `[n, suffix]`, where
+          `n` is the length of the prefix shared with the previous name
+        - upload entries in columns, with MD5 sums packed in binary (base64)
+
+        The server advertises support in the headers of its `test` reply.
+    """
+    HDR_ENCODINGS = 'X-F3-Content-Encodings'
+    HDR_FEATURES = 'X-F3-Wire-Features'
+    NAME_MODES = ('filter-needed', 'filter-checked', 'get-details')
+
+    def __init__(self, encoding=None, features=()):
+        self.encoding = encoding
+        self.features = set(features)
+
+    @staticmethod
+    def encodings():
+        """Content encodings available here, most compact first
+        """
+        if zstandard is not None:
+            return ['zstd', 'gzip']
+        return ['gzip']
+
+    @classmethod
+    def negotiate(cls, headers):
+        """Pick the best of what the server advertises in `headers`
+        """
+        parse = lambda h: [x.strip() for x in (headers.get(h) or '').split(',') if x.strip()]
+        srv_encodings = parse(cls.HDR_ENCODINGS)
+        encoding = None
+        for enc in cls.encodings():
+            if enc in srv_encodings:
+                encoding = enc
+                break
+        return cls(encoding, parse(cls.HDR_FEATURES))
+
+    def compress(self, data):
+        if self.encoding == 'gzip':
+            cobj = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            return cobj.compress(data) + cobj.flush()
+        elif self.encoding == 'zstd':
+            return zstandard.ZstdCompressor().compress(data)
+        return data
+
+    @staticmethod
+    def decompress(data, encoding):
+        if encoding == 'gzip':
+            return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        elif encoding == 'zstd':
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=1 << 30)
+        elif encoding:
+            raise ValueError("Unknown content encoding: %s" % encoding)
+        return data
+
+    @staticmethod
+    def front_encode(names):
+        """Front-code `names`, which should be sorted
+        """
+        ret = []
+        prev = ''
+        for name in names:
+            n = len(os.path.commonprefix([prev, name]))
+            ret.append([n, name[n:]])
+            prev = name
+        return ret
+
+    @staticmethod
+    def front_decode(coded):
+        ret = []
+        prev = ''
+        for n, suffix in coded:
+            prev = prev[:n] + suffix
+            ret.append(prev)
+        return ret
+
+    @staticmethod
+    def encode_columns(batch):
+        """Upload entries as columns: names, sizes, binary MD5s and any extra keys
+        """
+        batch = sorted(batch, key=lambda mf: mf['name'])
+        md5bin = []
+        md5other = {}
+        extra = []
+        for i, mf in enumerate(batch):
+            md5 = mf.get('md5sum')
+            try:
+                bmd5 = md5.decode('hex')
+                if len(bmd5) != 16:
+                    raise ValueError(md5)
+                md5bin.append(bmd5)
+            except (AttributeError, TypeError, ValueError):
+                # None, 'unreadable' or anything else not a hex MD5
+                md5bin.append('\0' * 16)
+                md5other[str(i)] = md5
+            extra.append(dict([(k, v) for k, v in mf.items()
+                               if k not in ('name', 'size', 'md5sum')]))
+        ret = {'names': WireFormat.front_encode([mf['name'] for mf in batch]),
+               'sizes': [mf['size'] for mf in batch],
+               'md5bin': base64.b64encode(''.join(md5bin)),
+               'md5other': md5other,
+               }
+        if any(extra):
+            ret['extra'] = extra
+        return ret
+
+    @staticmethod
+    def decode_columns(cols):
+        names = WireFormat.front_decode(cols['names'])
+        md5bin = base64.b64decode(cols['md5bin'])
+        extra = cols.get('extra') or [{}] * len(names)
+        ret = []
+        for i, name in enumerate(names):
+            mf = dict(extra[i])
+            mf['name'] = name
+            mf['size'] = cols['sizes'][i]
+            if str(i) in cols['md5other']:
+                mf['md5sum'] = cols['md5other'][str(i)]
+            else:
+                mf['md5sum'] = md5bin[i*16:(i+1)*16].encode('hex')
+            ret.append(mf)
+        return ret
+
+    def encode(self, post_data):
+        """Apply compact encodings of the request, where supported
+        """
+        mode = post_data.get('mode')
+        if post_data.get('entries'):
+            if mode in self.NAME_MODES and 'front-coding' in self.features:
+                post_data = post_data.copy()
+                post_data['entries_fc'] = self.front_encode(sorted(post_data.pop('entries')))
+            elif mode == 'upload' and 'columns' in self.features:
+                post_data = post_data.copy()
+                post_data['columns'] = self.encode_columns(post_data.pop('entries'))
+        return post_data
+
+    @classmethod
+    def decode(cls, post_data):
+        """Server side: restore plain `entries` of any compact request
+        """
+        if 'entries_fc' in post_data:
+            post_data['entries'] = cls.front_decode(post_data.pop('entries_fc'))
+        elif 'columns' in post_data:
+            post_data['entries'] = cls.decode_columns(post_data.pop('columns'))
+        return post_data
+
+
+class UploadSpool(object):
+    """Directory of computed batches, kept until they are uploaded
+
+        Each batch is written (atomically) into a file of its own, named so
+        that they sort in order of production, as:
+
+            {"context": {"uuid": ...}, "entries": [...], "final": false}
+
+        and removed once uploaded. Entries are unique by volume UUID and
+        name: on replay, later ones replace earlier ones.
+
+        Names of the kept entries are read once, then kept in memory,
+        along with the batches written or removed.
+    """
+    log = logging.getLogger('storage.spool')
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path, 0700)
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._index = None # fname: (vol_key, names, final)
+        self._names = None # vol_key: Counter of names, in all pending batches
+
+    def _add_index(self, fname, vol_key, names, final):
+        self._index[fname] = (vol_key, names, final)
+        self._names.setdefault(vol_key, Counter()).update(names)
+
+    def _get_index(self):
+        """Index of pending batches, read from disk on first use
+
+            Must be called with `_lock` held
+        """
+        if self._index is None:
+            self._index = {}
+            self._names = {}
+            for fname in self.pending():
+                try:
+                    batch = self.load(fname)
+                except ValueError:
+                    continue
+                self._add_index(fname, self._vol_key(batch['context']),
+                                [mf['name'] for mf in batch['entries']], batch['final'])
+        return self._index
+
+    @staticmethod
+    def _vol_key(context):
+        return context.get('uuid') or context.get('vol_label') or ''
+
+    def put(self, context, entries, final=False):
+        """Write a batch, durably
+
+            @return file name, to pass to `done()` after the upload
+        """
+        with self._lock:
+            self._seq += 1
+            fname = '%015d-%06d-%04d.json' % (int(time.time() * 1000), os.getpid(), self._seq % 10000)
+        full_path = os.path.join(self.path, fname)
+        fp = open(full_path + '.tmp', 'wb')
+        json.dump({'context': context, 'entries': entries, 'final': final}, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+        fp.close()
+        os.rename(full_path + '.tmp', full_path)
+        with self._lock:
+            if self._index is not None:
+                self._add_index(fname, self._vol_key(context),
+                                [mf['name'] for mf in entries], final)
+        return fname
+
+    def done(self, fname):
+        try:
+            os.unlink(os.path.join(self.path, fname))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        with self._lock:
+            if self._index is not None and fname in self._index:
+                vol_key, names, final = self._index.pop(fname)
+                counts = self._names[vol_key]
+                counts.subtract(names)
+                for name in names:
+                    if counts[name] <= 0:
+                        del counts[name]
+
+    def pending(self):
+        """List file names of batches not uploaded, in order
+        """
+        return sorted([f for f in os.listdir(self.path) if f.endswith('.json')])
+
+    def load(self, fname):
+        with open(os.path.join(self.path, fname), 'rb') as fp:
+            return json.load(fp)
+
+    def batches(self):
+        """Iterate over `(fname, batch)` not uploaded, in order, without duplicate entries
+        """
+        fnames = self.pending()
+        batches = []
+        seen = set()
+        for fname in reversed(fnames):
+            try:
+                batch = self.load(fname)
+            except ValueError, e:
+                self.log.warning("Dropping broken spool file %s: %s", fname, e)
+                self.done(fname)
+                continue
+            vol_key = self._vol_key(batch['context'])
+            entries = []
+            for mf in reversed(batch['entries']):
+                if (vol_key, mf['name']) not in seen:
+                    seen.add((vol_key, mf['name']))
+                    entries.append(mf)
+            entries.reverse()
+            batch['entries'] = entries
+            batches.append((fname, batch))
+        batches.reverse()
+        return batches
+
+    def filter_kept(self, context, names):
+        """Those of `names` not kept for the volume (or source) of `context`
+        """
+        vol_key = self._vol_key(context)
+        with self._lock:
+            self._get_index()
+            kept = self._names.get(vol_key)
+            if not kept:
+                return names
+            return [n for n in names if n not in kept]
+
+    def is_complete(self, context):
+        """Tell if all of the volume of `context` has been kept, up to its final batch
+        """
+        vol_key = self._vol_key(context)
+        with self._lock:
+            for b_key, names, final in self._get_index().values():
+                if final and b_key == vol_key:
+                    return True
+        return False
+
+
 class F3Storage(BaseStorageInterface):
     log = logging.getLogger('storage.f3')
+    RETRY_STATUS = (502, 503, 504)
+    RETRY_BACKOFF = 0.5 # sec, doubled each time
+
     def __init__(self, opts):
         self.ssl_verify = True
         if opts.insecure:
             self.ssl_verify = False
+        self.inflight = max(opts.http_inflight or 1, 1)
+        self.retries = max(opts.http_retries or 0, 0)
+        self.wire_mode = opts.wire
+        self._wire = None
+        self._wire_lock = threading.Lock()
+        self._no_dirs = False
+        self.spool = None
+        self._spool_lock = threading.Lock()
+        if opts.spool:
+            try:
+                self.spool = UploadSpool(opts.spool)
+            except EnvironmentError, e:
+                self.log.warning("Cannot use spool %s, failed uploads will be lost: %s", opts.spool, e)
         self.rsession = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.inflight)
+        self.rsession.mount('http://', adapter)
+        self.rsession.mount('https://', adapter)
         if opts.http_no_env:
             self.rsession.trust_env = False
         if opts.http_proxy:
@@ -765,98 +3307,235 @@ class F3Storage(BaseStorageInterface):
         self.rsession.cookies = cj
         self.upload_url = opts.upload_to
 
-    def filter_needed(self, in_fnames, worker):
+    def _get_wire(self):
+        """Negotiate the wire format with the server, once
+        """
+        with self._wire_lock:
+            if self._wire is None:
+                self._wire = WireFormat()
+                if self.wire_mode != 'plain':
+                    try:
+                        pres = self.rsession.post(self.upload_url, data={'mode': 'test'},
+                                                  verify=self.ssl_verify)
+                        pres.raise_for_status()
+                        self._wire = WireFormat.negotiate(pres.headers)
+                    except requests.exceptions.RequestException, e:
+                        self.log.warning("Cannot negotiate wire format, will use plain JSON: %s", e)
+                self.log.debug("Wire format: encoding=%s, features: %s", self._wire.encoding,
+                               ', '.join(self._wire.features) or 'none')
+            return self._wire
+
+    def _post(self, post_data):
+        """POST `post_data` as JSON, retrying on transient errors
+
+            @return the `requests` response, successful
+        """
+        wire = self._get_wire()
         headers = {'Content-type': 'application/json', }
+        data = json.dumps(wire.encode(post_data))
+        if wire.encoding:
+            data = wire.compress(data)
+            headers['Content-Encoding'] = wire.encoding
+        attempt = 0
+        mode = post_data.get('mode')
+        while True:
+            ts = time.time()
+            try:
+                metrics.count('http_requests')
+                metrics.count('http_bytes_sent', len(data))
+                pres = self.rsession.post(self.upload_url, headers=headers,
+                                          verify=self.ssl_verify, data=data)
+                metrics.observe('http_request_seconds', mode, time.time() - ts)
+                if pres.status_code not in self.RETRY_STATUS or attempt >= self.retries:
+                    pres.raise_for_status()
+                    return pres
+                err = "HTTP %d" % pres.status_code
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout), e:
+                metrics.observe('http_request_seconds', mode, time.time() - ts)
+                metrics.count('http_errors')
+                if attempt >= self.retries:
+                    raise
+                err = e
+            metrics.count('http_retries')
+            delay = self.RETRY_BACKOFF * (2 ** attempt)
+            attempt += 1
+            self.log.warning("Request %s failed: %s, retry #%d in %.1fs",
+                             mode, err, attempt, delay)
+            time.sleep(delay)
+
+    def map_chunks(self, method, chunks, worker):
+        """Call `method` for each of `chunks`, keeping `inflight` requests in flight
+
+            Results are still yielded in the order of `chunks`
+        """
+        if self.inflight <= 1 or len(chunks) <= 1:
+            for res in super(F3Storage, self).map_chunks(method, chunks, worker):
+                yield res
+            return
+
+        func = getattr(self, method)
+        pool = JobPool(min(self.inflight, len(chunks)))
+        pending = deque()
+        try:
+            for chunk in chunks:
+                pending.append(pool.submit(func, (chunk, worker)))
+                if len(pending) >= self.inflight:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            pool.close(cancel=bool(pending))
+
+    def filter_needed(self, in_fnames, worker):
         post_data = {'mode': 'filter-needed', 'entries': in_fnames }
         for key in ('vol_label', 'uuid', 'fstype'):
             if key in worker.context:
                 post_data[key] = worker.context[key]
-        pres = self.rsession.post(self.upload_url, headers=headers,
-                                  verify=self.ssl_verify,
-                                  data=json.dumps(post_data)
-                                 )
-        pres.raise_for_status()
+        data = self._post(post_data).json()
+        assert isinstance(data, list), type(data)
+        if self.spool is not None and data:
+            data = self.spool.filter_kept(worker.context, data)
+        return data
+
+    def _post_dirs(self, mode, dir_digests, worker):
+        """POST directory digests, unless the server has told it does not support them
+        """
+        if self._no_dirs:
+            return None
+        post_data = {'mode': mode, 'entries': dir_digests}
+        for key in ('vol_label', 'uuid', 'fstype'):
+            if key in worker.context:
+                post_data[key] = worker.context[key]
+        try:
+            return self._post(post_data)
+        except requests.exceptions.HTTPError, e:
+            if e.response is None or e.response.status_code not in (400, 404, 501):
+                raise
+            self.log.info("Server does not support directory digests, will filter all names")
+            self._no_dirs = True
+            return None
+
+    def filter_dirs(self, dir_digests, worker):
+        pres = self._post_dirs('filter-dirs', dir_digests, worker)
+        if pres is None:
+            return []
         data = pres.json()
         assert isinstance(data, list), type(data)
         return data
 
+    def store_dirs(self, dir_digests, worker):
+        self._post_dirs('store-dirs', dir_digests, worker)
+
     def filter_checked(self, in_fnames, worker):
-        headers = {'Content-type': 'application/json', }
         post_data = {'mode': 'filter-checked', 'entries': in_fnames }
-        pres = self.rsession.post(self.upload_url, headers=headers,
-                                  verify=self.ssl_verify,
-                                  data=json.dumps(post_data)
-                                 )
-        pres.raise_for_status()
-        data = pres.json()
+        data = self._post(post_data).json()
         assert isinstance(data, list), type(data)
         return data
 
     def get_details(self, in_fnames, worker):
         """Return list of `(fname, size, MD5SUM, policy)` for each of `in_fnames`
         """
-        headers = {'Content-type': 'application/json', }
         post_data = {'mode': 'get-details', 'entries': in_fnames }
-        pres = self.rsession.post(self.upload_url, headers=headers,
-                                  verify=self.ssl_verify,
-                                  data=json.dumps(post_data)
-                                 )
-        pres.raise_for_status()
-        data = pres.json()
+        data = self._post(post_data).json()
         assert isinstance(data, list), type(data)
         return data
 
     def write_manifest(self, worker):
         self.consume_manifests(worker, [worker.get_out_manifest()])
 
+    def _upload(self, context, entries, final=False):
+        post_data = {'mode': 'upload', 'entries': entries, 'final': final}
+        for key in ('vol_label', 'uuid', 'fstype'):
+            if key in context:
+                post_data[key] = context[key]
+        if len(entries) == 1 and 'columns' not in self._get_wire().features:
+            # Single-item parameters get simplified in Request Params handler
+            post_data['entries'] = [entries[0], {}]
+        with metrics.timer('upload'):
+            self._post(post_data)
+        metrics.count('entries_uploaded', len(entries))
+
+    def flush_spool(self):
+        """Upload batches left in the spool, in order
+        """
+        if self.spool is None:
+            return True
+        with self._spool_lock:
+            batches = self.spool.batches()
+            if batches:
+                self.log.info("Uploading %d batches kept in spool %s", len(batches), self.spool.path)
+            for fname, batch in batches:
+                if batch['entries'] or batch['final']:
+                    self._upload(batch['context'], batch['entries'], batch['final'])
+                self.spool.done(fname)
+
     def consume_manifests(self, worker, producer):
         """Continuously write manifests, as generated by producer
         
             @param worker is used to setup storage parameters from
             @param producer a generator, which will yield lists of manifests.
                 Each list will be written as soon as it is produced
+
+            With a spool, each batch is kept there before its upload. If an
+            upload fails, the rest of the batches are still computed and
+            kept, for a later `flush_spool()`, and the error raised at the end.
+            Spool operations hold `_spool_lock`, so that a `flush_spool()` of
+            another thread never sees a batch being uploaded here.
         """
-        headers = {'Content-type': 'application/json', }
-        post_data = {'mode': 'upload', 'entries': None, 'final': False}
-        url = self.upload_url
+        context = {}
         for key in ('vol_label', 'uuid', 'fstype'):
             if key in worker.context:
-                post_data[key] = worker.context[key]
-        
+                context[key] = worker.context[key]
+
+        failed = None
+        if self.spool is not None:
+            try:
+                self.flush_spool()
+            except requests.exceptions.RequestException, e:
+                self.log.warning("Cannot upload spooled batches, will keep new ones too: %s", e)
+                failed = sys.exc_info()
+
         for batch in producer:
-            batch_len = len(batch)
-            if batch_len == 1:
-                # Single-item parameters get simplified in Request Params handler
-                batch = [batch[0], {}]
-            post2 = post_data.copy()
-            post2['entries'] = batch
-            pres = self.rsession.post(url, headers=headers,
-                                  verify=self.ssl_verify,
-                                  data=json.dumps(post2)
-                                 )
-            pres.raise_for_status()
-            self.log.info("Uploaded %d entries", batch_len)
-            
-        post2 = {'mode': 'upload', 'entries': [], 'final': True}
-        for key in ('vol_label', 'uuid', 'fstype'):
-            if key in worker.context:
-                post2[key] = worker.context[key]
-        pres = self.rsession.post(url, headers=headers,
-                                  verify=self.ssl_verify,
-                                  data=json.dumps(post2)
-                                 )
-        pres.raise_for_status()
+            if self.spool is None:
+                self._upload(context, batch)
+                self.log.info("Uploaded %d entries", len(batch))
+                continue
+            with self._spool_lock:
+                fname = self.spool.put(context, batch)
+                if failed:
+                    self.log.info("Kept %d entries in spool", len(batch))
+                    continue
+                try:
+                    self._upload(context, batch)
+                except requests.exceptions.RequestException, e:
+                    self.log.warning("Upload failed, will keep computed entries in spool %s: %s",
+                                     self.spool.path, e)
+                    failed = sys.exc_info()
+                    continue
+                self.spool.done(fname)
+            self.log.info("Uploaded %d entries", len(batch))
+
+        if self.spool is None:
+            self._upload(context, [], final=True)
+            return
+        with self._spool_lock:
+            fname = self.spool.put(context, [], final=True)
+            if failed:
+                raise failed[0], failed[1], failed[2]
+            self._upload(context, [], final=True)
+            self.spool.done(fname)
 
     def lookup_fs(self, props):
-        headers = {'Content-type': 'application/json', }
+        if self.spool is not None and self.spool.is_complete(props):
+            try:
+                self.flush_spool()
+            except requests.exceptions.RequestException, e:
+                self.log.warning("Volume %s is computed, but still in spool: %s",
+                                 props.get('vol_label'), e)
+                return None
         post_data = {'mode': 'lookup',}
         post_data.update(props)
-        pres = self.rsession.post(self.upload_url, headers=headers,
-                                  verify=self.ssl_verify,
-                                  data=json.dumps(post_data)
-                                 )
-        pres.raise_for_status()
-        return pres.json()
+        return self._post(post_data).json()
 
     def test(self):
         post_data = {'mode': 'test'}
@@ -968,6 +3647,10 @@ class UDisks2Mgr(object):
                     self._queue_lock.release()
                 
                 if task is None:
+                    try:
+                        storage.flush_spool()
+                    except requests.exceptions.RequestException, e:
+                        self.log.debug("Cannot flush spool: %s", e)
                     continue
                 try:
                     task_thr = threading.Thread(target=task.execute, args=(storage,))
@@ -1074,10 +3757,16 @@ class UDisks2Mgr(object):
             umount_opts = dbus.Dictionary({}, 'sv')
             
             try:
-                worker.scan_dir(mpoint)
-                worker.filter_in(storage)
+                if worker.pipeline:
+                    worker.stream_from([mpoint], storage, order=(worker.disk_order and 'disk' or None))
+                else:
+                    worker.scan_dir(mpoint)
+                    worker.filter_in(storage)
+                    if worker.disk_order:
+                        worker.sort_by_disk_order()
 
-                storage.consume_manifests(worker, worker.produce_sums())
+                storage.consume_manifests(worker, worker.queued_sums())
+                worker.store_dir_digests(storage)
                 time.sleep(1.0)
                 iface.Unmount(umount_opts)
             except requests.exceptions.RequestException:
@@ -1111,141 +3800,231 @@ class UDisks2Mgr(object):
                     self._work_queue.append(UDisks2Mgr.EjectTask(path, drive))
                 self._queue_lock.notifyAll()
 
-if options.opts.upload_to:
-    storage = F3Storage(options.opts)
-elif options.opts.output:
-    storage = JSONStorage(options.opts)
-elif options.opts.dry_run:
-    storage = DryStorage(options.opts)
-else:
-    log.error("Must select storage mode: dry-run, output-file or upload-to URL")
-    sys.exit(1)
-
-comp_kwargs = {}
-if options.opts.fast_run:
-    comp_kwargs['time_limit'] = 10.0 # sec
-    comp_kwargs['size_limit'] = pow(1024.0, 3)
-
-if options.opts.mode == 'sources':
-    worker = SourceManifestor(options.opts.prefix)
-    for fpath in options.args:
-        worker.scan_dir(fpath)
-
-    worker.filter_in(storage)
-    if options.opts.small_first:
-        log.debug("Sorting by size")
-        worker.sort_by_size()
-    try:
-        if options.opts.fast_run:
-            worker.compute_sums(**comp_kwargs)
-        else:
-            storage.consume_manifests(worker, worker.produce_sums())
-    except KeyboardInterrupt:
-        log.warning('Canceling MD5 scan by user request, will still save output in 2 sec')
-        time.sleep(2.0) # User can hit Ctrl+C, again, here
-
-    if worker.out_manifest:
-        storage.write_manifest(worker)
+if __name__ == '__main__':
+    options.allow_include = 3
+    options._path_options += ['output', 'cookies_file', 'outdir', 'hash_cache', 'db', 'spool',
+                               'metrics_json', 'metrics_prom', 'profile']
+    options.init(options_prepare=custom_options,
+            have_args=None,
+            config='~/.openerp/backup.conf', config_section=(),
+            defaults={ 'cookies_file': '~/.f3_upload_cookies.txt',
+                      'hash_cache': '/var/backup/hash-cache.db',
+                      'spool': '/var/backup/f3-spool', })
+
+    if options.opts.mode == 'cache-vacuum':
+        storage = None
+    elif options.opts.upload_to:
+        storage = F3Storage(options.opts)
+    elif options.opts.db:
+        storage = SQLiteStorage(options.opts)
+    elif options.opts.output and options.opts.journal:
+        storage = JournalStorage(options.opts)
+    elif options.opts.output:
+        storage = JSONStorage(options.opts)
+    elif options.opts.dry_run:
+        storage = DryStorage(options.opts)
     else:
-        log.warning("No manifest entries, nothing to save")
-
-elif options.opts.mode == 'volume-dir':
-    if len(options.args) != 3:
-        log.error("Must supply 3 arguments: $0 <Label> <path> <uuid>")
+        log.error("Must select storage mode: dry-run, output-file, database or upload-to URL")
         sys.exit(1)
-    
-    worker = VolumeManifestor(label=options.args[0], uuid=options.args[2])
-    worker.scan_dir(options.args[1])
-    worker.filter_in(storage)
-    
-    if options.opts.small_first:
-        log.debug("Sorting by size")
-        worker.sort_by_size()
-    
-    try:
-        storage.consume_manifests(worker, worker.produce_sums())
-    except KeyboardInterrupt:
-        log.warning('Canceling MD5 scan by user request, will still save output in 2 sec')
-        time.sleep(2.0) # User can hit Ctrl+C, again, here
 
+    BaseManifestor.setup_options(options.opts)
 
-elif options.opts.mode in ('udisks', 'udisks2'):
-    import dbus
-    from dbus.mainloop.glib import DBusGMainLoop, threads_init
-    import gobject
+    profiler = None
+    if options.opts.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
 
-    gobject.threads_init()
-    threads_init()
-    DBusGMainLoop(set_as_default=True)
-    
-    umgr = UDisks2Mgr()
-    umgr.main_loop(storage)
-
-elif options.opts.mode == 'move':
-    worker = MoveManifestor(options.opts.prefix)
-    for fpath in options.args:
-        worker.scan_dir(fpath)
-
-    worker.filter_in(storage)
-    if worker.move_manifest:
-        if not options.opts.outdir:
-            log.error("Move mode requested but no output dir, aborting")
-            sys.exit(1)
-        worker.move_to(options.opts.outdir, dry=options.opts.dry_run)
+    def _at_exit():
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(options.opts.profile)
+            log.info("Profile written to %s", options.opts.profile)
+        metrics.export(options.opts.metrics_json, options.opts.metrics_prom)
+
+    atexit.register(_at_exit)
+
+    comp_kwargs = {}
+    if options.opts.fast_run:
+        comp_kwargs['time_limit'] = 10.0 # sec
+        comp_kwargs['size_limit'] = pow(1024.0, 3)
+
+    if options.opts.disk_order:
+        stream_order = 'disk'
+    elif options.opts.small_first:
+        stream_order = 'size'
     else:
-        log.warning("No manifest entries, nothing to move")
+        stream_order = None
+
+    if options.opts.mode == 'sources':
+        worker = SourceManifestor(options.opts.prefix)
+        if worker.pipeline and not options.opts.fast_run:
+            worker.stream_from(options.args, storage, prefix=options.opts.prefix, order=stream_order)
+        else:
+            for fpath in options.args:
+                worker.scan_dir(fpath)
+
+            worker.filter_in(storage)
+            if options.opts.disk_order:
+                log.debug("Sorting by disk order")
+                worker.sort_by_disk_order()
+            elif options.opts.small_first:
+                log.debug("Sorting by size")
+                worker.sort_by_size()
+        try:
+            if options.opts.fast_run:
+                worker.compute_sums(**comp_kwargs)
+            else:
+                storage.consume_manifests(worker, worker.queued_sums())
+                worker.store_dir_digests(storage)
+        except KeyboardInterrupt:
+            log.warning('Canceling MD5 scan by user request, will still save output in 2 sec')
+            time.sleep(2.0) # User can hit Ctrl+C, again, here
 
-elif (options.opts.mode == 'copy-needed' or options.opts.mode == 'move-needed'):
-    worker = CopyManifestor(options.opts.prefix)
-    for fpath in options.args:
-        worker.scan_dir(fpath)
+        if worker.streaming:
+            # batches have been stored while computed, none kept
+            if not worker.n_streamed:
+                log.warning("No manifest entries, nothing to save")
+        elif worker.out_manifest:
+            storage.write_manifest(worker)
+        else:
+            log.warning("No manifest entries, nothing to save")
 
-    worker.filter_in(storage)
-    if worker.cn_manifest:
-        if not options.opts.outdir:
-            log.error("Copy-needed mode requested but no output dir, aborting")
+    elif options.opts.mode == 'volume-dir':
+        if len(options.args) != 3:
+            log.error("Must supply 3 arguments: $0 <Label> <path> <uuid>")
+            sys.exit(1)
+        if not (options.args[0] or options.args[2]):
+            log.error("Volume must have a label or a uuid")
             sys.exit(1)
-        worker.copy_to(options.opts.outdir, do_move=(options.opts.mode == 'move-needed'),
-                       dry=options.opts.dry_run)
-    else:
-        log.warning("No manifest entries, nothing to copy")
 
-elif (options.opts.mode == 'move-bad' or options.opts.mode == 'move-md5-bad'):
-    worker = OnlyGoodManifestor(options.opts.prefix)
-    for fpath in options.args:
-        worker.scan_dir(fpath)
+        worker = VolumeManifestor(label=options.args[0], uuid=options.args[2])
+        if worker.pipeline:
+            worker.stream_from([options.args[1]], storage, order=stream_order)
+        else:
+            worker.scan_dir(options.args[1])
+            worker.filter_in(storage)
 
-    worker.filter_in(storage)
-    if options.opts.mode == 'move-md5-bad':
-        if options.opts.small_first:
-            log.debug("Sorting by size")
-            worker.sort_by_size()
+            if options.opts.disk_order:
+                log.debug("Sorting by disk order")
+                worker.sort_by_disk_order()
+            elif options.opts.small_first:
+                log.debug("Sorting by size")
+                worker.sort_by_size()
 
         try:
-            worker.compute_sums(**comp_kwargs)
+            storage.consume_manifests(worker, worker.queued_sums())
+            worker.store_dir_digests(storage)
         except KeyboardInterrupt:
-            log.warning('Canceling MD5 scan by user request, will still move files in 2 sec')
+            log.warning('Canceling MD5 scan by user request, will still save output in 2 sec')
             time.sleep(2.0) # User can hit Ctrl+C, again, here
 
-    if worker.move_manifest:
-        log.info("Need to move %d entries: %s", len(worker.move_manifest), worker._get_bad_sums())
-        if not options.opts.outdir:
-            log.error("Move mode requested but no output dir, aborting")
-            worker.explain_manifest()
+
+    elif options.opts.mode in ('udisks', 'udisks2'):
+        import dbus
+        from dbus.mainloop.glib import DBusGMainLoop, threads_init
+        import gobject
+
+        gobject.threads_init()
+        threads_init()
+        DBusGMainLoop(set_as_default=True)
+
+        umgr = UDisks2Mgr()
+        umgr.main_loop(storage)
+
+    elif options.opts.mode == 'watch':
+        if not Inotify.is_available():
+            log.error("Watch mode needs inotify, not available on this system")
+            sys.exit(1)
+        for fpath in options.args:
+            if not os.path.isdir(fpath):
+                log.error("Input arguments must be directories. \"%s\" is not", fpath)
+                sys.exit(1)
+        worker = WatchManifestor(options.args, options.opts.prefix,
+                                 settle=options.opts.watch_settle,
+                                 reconcile=options.opts.watch_reconcile)
+        try:
+            worker.watch(storage)
+        except KeyboardInterrupt:
+            log.info("Stopped watching, by user request")
+
+    elif options.opts.mode == 'move':
+        worker = MoveManifestor(options.opts.prefix)
+        for fpath in options.args:
+            worker.scan_dir(fpath)
+
+        worker.filter_in(storage)
+        if worker.move_manifest:
+            if not options.opts.outdir:
+                log.error("Move mode requested but no output dir, aborting")
+                sys.exit(1)
+            worker.move_to(options.opts.outdir, dry=options.opts.dry_run)
+        else:
+            log.warning("No manifest entries, nothing to move")
+
+    elif (options.opts.mode == 'copy-needed' or options.opts.mode == 'move-needed'):
+        worker = CopyManifestor(options.opts.prefix)
+        for fpath in options.args:
+            worker.scan_dir(fpath)
+
+        worker.filter_in(storage)
+        if worker.cn_manifest:
+            if not options.opts.outdir:
+                log.error("Copy-needed mode requested but no output dir, aborting")
+                sys.exit(1)
+            worker.copy_to(options.opts.outdir, do_move=(options.opts.mode == 'move-needed'),
+                           dry=options.opts.dry_run)
+        else:
+            log.warning("No manifest entries, nothing to copy")
+
+    elif (options.opts.mode == 'move-bad' or options.opts.mode == 'move-md5-bad'):
+        worker = OnlyGoodManifestor(options.opts.prefix)
+        for fpath in options.args:
+            worker.scan_dir(fpath)
+
+        worker.filter_in(storage)
+        if options.opts.mode == 'move-md5-bad':
+            if options.opts.disk_order:
+                log.debug("Sorting by disk order")
+                worker.sort_by_disk_order()
+            elif options.opts.small_first:
+                log.debug("Sorting by size")
+                worker.sort_by_size()
+
+            try:
+                worker.compute_sums(**comp_kwargs)
+            except KeyboardInterrupt:
+                log.warning('Canceling MD5 scan by user request, will still move files in 2 sec')
+                time.sleep(2.0) # User can hit Ctrl+C, again, here
+
+        if worker.move_manifest:
+            log.info("Need to move %d entries: %s", len(worker.move_manifest), worker._get_bad_sums())
+            if not options.opts.outdir:
+                log.error("Move mode requested but no output dir, aborting")
+                worker.explain_manifest()
+                sys.exit(1)
+            worker.move_to(options.opts.outdir, dry=options.opts.dry_run)
+        else:
+            log.warning("No bad entries, nothing to move")
+
+    elif options.opts.mode == 'cache-vacuum':
+        if not BaseManifestor.hash_cache:
+            log.error("No hash cache to vacuum")
             sys.exit(1)
-        worker.move_to(options.opts.outdir, dry=options.opts.dry_run)
+        BaseManifestor.hash_cache.vacuum(options.opts.cache_max_age)
+
+    elif options.opts.mode == 'test':
+        try:
+            print storage.test()
+        except Exception, e:
+            log.error("Storage is not ready: %s", e)
+            sys.exit(3)
+
     else:
-        log.warning("No bad entries, nothing to move")
+        log.error("Invalid mode: %s", options.opts.mode)
+        sys.exit(1)
 
-elif options.opts.mode == 'test':
-    try:
-        print storage.test()
-    except Exception, e:
-        log.error("Storage is not ready: %s", e)
-        sys.exit(3)
-
-else:
-    log.error("Invalid mode: %s", options.opts.mode)
-    sys.exit(1)
+    if BaseManifestor.hash_cache:
+        BaseManifestor.hash_cache.close()
 
 #eof
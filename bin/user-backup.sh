@@ -22,9 +22,27 @@ function filter_tar {
 	return 0
 }
 
+# Create $TMP_TAR_FILE with tar and the given options. With GEN_MD5=y,
+# its MD5 sum is computed while written, into "$TMP_TAR_FILE.md5"
+function run_tar {
+	if [ "$DRY_RUN" == "y" ] ; then
+		echo $TAR -cf $TMP_TAR_FILE "$@"
+	elif [ "$GEN_MD5" == "y" ] ; then
+		$TAR -cf - "$@" | "$MD5TEE_SH" "$TMP_TAR_FILE"
+		local PIPE_EXIT=( "${PIPESTATUS[@]}" )
+		if [ "${PIPE_EXIT[1]}" != 0 ] && [ "${PIPE_EXIT[0]}" -lt 2 ] ; then
+			return 2
+		fi
+		return ${PIPE_EXIT[0]}
+	else
+		$TAR -cf $TMP_TAR_FILE "$@"
+	fi
+}
+
 TMP_TAR_OPTIONS=""
 TMP_TAR_FILE=/dev/null
 TMP_TAR_DIRS=""
+MD5TEE_SH=/usr/lib/pfn_backup/md5tee.sh
 
 while [ -n "$1" ] ; do
 
@@ -152,14 +170,10 @@ fi
 decho "Starting backup.."
 umask 0077
 
-if [ "$DRY_RUN" == "y" ] ; then
-	TMP_PRE_CMD=echo
-fi
-
 if [ -n "$TMP_NEWER" ] ; then
 	#after timestamp
 	decho $TAR -cf $TMP_TAR_FILE $TAR_DEFAULT_OPTIONS $TMP_TAR_OPTIONS $TAR_EXCLUDE_OPTIONS $TMP_NEWER "$TMP_NEWER2" -- $TMP_TAR_DIRS
-	$TMP_PRE_CMD $TAR -cf $TMP_TAR_FILE $TAR_DEFAULT_OPTIONS $TMP_TAR_OPTIONS $TAR_EXCLUDE_OPTIONS $TMP_NEWER "$TMP_NEWER2" $TMP_TAR_DIRS 
+	run_tar $TAR_DEFAULT_OPTIONS $TMP_TAR_OPTIONS $TAR_EXCLUDE_OPTIONS $TMP_NEWER "$TMP_NEWER2" $TMP_TAR_DIRS
 	TAR_EXIT=$?
 	if [ $TAR_EXIT == 0 ] ; then
 		[ -n "$BACKUP_INDEX_FILE" ] && \
@@ -179,7 +193,7 @@ if [ -n "$TMP_NEWER" ] ; then
 else
 	#full backup
 	decho $TAR -cf $TMP_TAR_FILE $TAR_DEFAULT_OPTIONS $TMP_TAR_OPTIONS $TAR_EXCLUDE_OPTIONS -- $TMP_TAR_DIRS
-	$TMP_PRE_CMD $TAR -cf $TMP_TAR_FILE $TAR_DEFAULT_OPTIONS $TMP_TAR_OPTIONS $TAR_EXCLUDE_OPTIONS $TMP_TAR_DIRS
+	run_tar $TAR_DEFAULT_OPTIONS $TMP_TAR_OPTIONS $TAR_EXCLUDE_OPTIONS $TMP_TAR_DIRS
 	TAR_EXIT=$?
 	if  [ $TAR_EXIT == 0 ]; then
 		[ -n "$BACKUP_INDEX_FILE" ] && \
@@ -0,0 +1,29 @@
+#!/bin/bash
+
+# Copy stdin into <file>, computing its MD5 sum on the way, so that the
+# file need not be read again. The sum is left in "<file>.md5", in md5sum(1)
+# format, after a "# size=<bytes> mtime=<seconds>" comment that lets
+# scan-backups.py trust it, as long as the file is not modified.
+#
+# usage: some-command | md5tee.sh <file>
+
+set -e -o pipefail
+
+if [ -z "$1" ] ; then
+	echo "usage: $0 <file>" >&2
+	exit 2
+fi
+
+OUTFILE="$1"
+rm -f "$OUTFILE.md5"
+
+MD5SUM=$(tee "$OUTFILE" | md5sum | cut -d ' ' -f 1)
+SIZE=$(stat -c '%s' "$OUTFILE")
+MTIME=$(stat -c '%Y' "$OUTFILE")
+
+{ echo "# size=$SIZE mtime=$MTIME"
+  echo "$MD5SUM  $(basename "$OUTFILE")"
+} > "$OUTFILE.md5.tmp"
+mv -f "$OUTFILE.md5.tmp" "$OUTFILE.md5"
+
+#eof
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    F3, Open Source Management Solution
+#    Copyright (C) 2016 P. Christeas <xrg@hellug.gr>
+#
+##############################################################################
+
+""" Helpers shared by scan-backups.py and prepare-media.py
+
+    Installed next to the shell helpers, in /usr/lib/pfn_backup/, from
+    where the scripts import it.
+"""
+
+import logging
+import os
+import os.path
+import sys
+import stat
+import time
+import json
+import threading
+from collections import Counter, defaultdict, deque
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = getattr(os, 'scandir', None)
+
+# "<archive>.md5" files, with the MD5 sum of the archive, see md5tee.sh
+SIDECAR_SUFFIX = '.md5'
+
+
+def is_sidecar(fname):
+    """Tell if `fname` is an MD5 sidecar (or a temporary one of md5tee.sh), not an archive
+    """
+    return fname.endswith(SIDECAR_SUFFIX) or fname.endswith(SIDECAR_SUFFIX + '.tmp')
+
+
+def peak_rss_reset():
+    """Reset the peak RSS of this process, where Linux allows it
+
+        @return True if reset, else peak_rss() will be that of the process lifetime
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        return True
+    except EnvironmentError:
+        return False
+
+
+def peak_rss():
+    """Peak resident memory (KB) of this process, since the last reset
+    """
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except EnvironmentError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Metrics(object):
+    """Phase timers, counters and latency histograms of a run
+
+        Phases are summed over all threads, so that "read" may exceed the
+        wall time when several files are read in parallel.
+        At exit, they can be written as JSON, or in the text format of
+        the Prometheus textfile collector, as `<prefix>_...` metrics.
+    """
+    log = logging.getLogger('metrics')
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    class Timer(object):
+        def __init__(self, metrics, phase):
+            self.metrics = metrics
+            self.phase = phase
+
+        def __enter__(self):
+            self.ts = time.time()
+            return self
+
+        def __exit__(self, exc_type, exc_value, tb):
+            self.metrics.add_time(self.phase, time.time() - self.ts)
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self.phases = defaultdict(float)
+        self.phase_calls = Counter()
+        self.counters = Counter()
+        self.histograms = {} # (name, label) : [counts per bucket, +Inf], sum
+
+    def timer(self, phase):
+        """Context manager, adding its time to `phase`
+        """
+        return Metrics.Timer(self, phase)
+
+    def add_time(self, phase, dt, calls=1):
+        with self._lock:
+            self.phases[phase] += dt
+            self.phase_calls[phase] += calls
+
+    def timed_iter(self, phase, iterable):
+        """Yield from `iterable`, adding the time waited for each item to `phase`
+        """
+        it = iter(iterable)
+        while True:
+            ts = time.time()
+            try:
+                item = it.next()
+            except StopIteration:
+                return
+            self.add_time(phase, time.time() - ts)
+            yield item
+
+    def count(self, name, num=1):
+        with self._lock:
+            self.counters[name] += num
+
+    def observe(self, name, label, value):
+        """Add `value` (seconds) to histogram `name`, for `label` (like the request mode)
+        """
+        with self._lock:
+            hist = self.histograms.get((name, label))
+            if hist is None:
+                hist = self.histograms[(name, label)] = [[0] * (len(self.BUCKETS) + 1), 0.0]
+            for i, le in enumerate(self.BUCKETS):
+                if value <= le:
+                    hist[0][i] += 1
+                    break
+            else:
+                hist[0][-1] += 1
+            hist[1] += value
+
+    def summary(self):
+        with self._lock:
+            ret = {'started': self.started, 'seconds': time.time() - self.started,
+                   'phases': dict([(k, {'seconds': v, 'calls': self.phase_calls[k]})
+                                   for k, v in self.phases.items()]),
+                   'counters': dict(self.counters),
+                   'histograms': {}}
+            for (name, label), (counts, hsum) in self.histograms.items():
+                ret['histograms'].setdefault(name, {})[label] = \
+                        {'buckets': list(self.BUCKETS) + ['+Inf'], 'counts': counts,
+                         'sum': hsum, 'count': sum(counts)}
+        return ret
+
+    def prometheus_text(self):
+        pfx = self.prefix
+        summary = self.summary()
+        lines = ['# TYPE %s_run_seconds gauge' % pfx,
+                 '%s_run_seconds %.3f' % (pfx, summary['seconds']),
+                 '# TYPE %s_last_run_timestamp_seconds gauge' % pfx,
+                 '%s_last_run_timestamp_seconds %d' % (pfx, time.time()),
+                 '# TYPE %s_phase_seconds_total counter' % pfx]
+        for phase, ph in sorted(summary['phases'].items()):
+            lines.append('%s_phase_seconds_total{phase="%s"} %.6f' % (pfx, phase, ph['seconds']))
+        lines.append('# TYPE %s_phase_calls_total counter' % pfx)
+        for phase, ph in sorted(summary['phases'].items()):
+            lines.append('%s_phase_calls_total{phase="%s"} %d' % (pfx, phase, ph['calls']))
+        for name, value in sorted(summary['counters'].items()):
+            lines += ['# TYPE %s_%s_total counter' % (pfx, name),
+                      '%s_%s_total %d' % (pfx, name, value)]
+        for name, by_label in sorted(summary['histograms'].items()):
+            lines.append('# TYPE %s_%s histogram' % (pfx, name))
+            for label, hist in sorted(by_label.items()):
+                cumul = 0
+                for le, num in zip(hist['buckets'], hist['counts']):
+                    cumul += num
+                    lines.append('%s_%s_bucket{mode="%s",le="%s"} %d' % (pfx, name, label, le, cumul))
+                lines.append('%s_%s_sum{mode="%s"} %.6f' % (pfx, name, label, hist['sum']))
+                lines.append('%s_%s_count{mode="%s"} %d' % (pfx, name, label, hist['count']))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _write_atomic(fname, data):
+        # textfile collector may read at any time, never let it see a partial file
+        tmp_fname = fname + '.tmp'
+        with open(tmp_fname, 'wb') as fp:
+            fp.write(data)
+        os.rename(tmp_fname, fname)
+
+    def export(self, json_fname=None, prom_fname=None):
+        try:
+            if json_fname:
+                self._write_atomic(json_fname, json.dumps(self.summary(), indent=2, sort_keys=True))
+                self.log.info("Metrics written to %s", json_fname)
+            if prom_fname:
+                self._write_atomic(prom_fname, self.prometheus_text())
+                self.log.info("Metrics written to %s", prom_fname)
+        except EnvironmentError, e:
+            self.log.warning("Cannot write metrics: %s", e)
+
+
+class JobPool(object):
+    """Pool of threads, running jobs like checksums of several files at once
+
+        hashlib releases the GIL while digesting large buffers (as does
+        waiting for the network), so that a few threads can keep more than
+        one core busy. Each job may carry the device it reads from, and no
+        more than `dev_limit(dev)` of them will be reading the same device
+        at a time (0 for no limit).
+    """
+    log = logging.getLogger('jobpool')
+
+    class Job(object):
+        def __init__(self, func, args, dev=None):
+            self.func = func
+            self.args = args
+            self.dev = dev
+            self._done = threading.Event()
+            self._result = None
+            self._exc_info = None
+
+        def run(self):
+            try:
+                self._result = self.func(*self.args)
+            except Exception:
+                self._exc_info = sys.exc_info()
+            self._done.set()
+
+        def result(self):
+            # use a timeout, or KeyboardInterrupt would never get through
+            while not self._done.wait(1.0):
+                pass
+            if self._exc_info:
+                raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+            return self._result
+
+    class InlineJob(Job):
+        """Job that is computed in the calling thread, when its result is asked
+        """
+        def result(self):
+            return self.func(*self.args)
+
+    def __init__(self, jobs, dev_limit=None):
+        self.dev_limit = dev_limit or (lambda dev: 0)
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._busy = defaultdict(int)
+        self._closed = False
+        self._threads = []
+        for i in range(jobs):
+            thr = threading.Thread(target=self._run, name='hash-%d' % i)
+            thr.daemon = True
+            thr.start()
+            self._threads.append(thr)
+
+    def submit(self, func, args, dev=None):
+        job = JobPool.Job(func, args, dev)
+        with self._cond:
+            self._pending.append(job)
+            self._cond.notify()
+        return job
+
+    def close(self, cancel=False, wait=None):
+        """Stop worker threads, after pending jobs are done
+
+            @param cancel discard pending jobs
+            @param wait for running jobs to finish, default unless `cancel`
+        """
+        with self._cond:
+            self._closed = True
+            if cancel:
+                self._pending.clear()
+            self._cond.notify_all()
+        if wait is None:
+            wait = not cancel
+        if wait:
+            for thr in self._threads:
+                thr.join()
+
+    def _next_job(self):
+        """Pick the first pending job whose device is not saturated
+
+            Must be called with `_cond` held
+        """
+        for i, job in enumerate(self._pending):
+            limit = self.dev_limit(job.dev)
+            if (not limit) or self._busy[job.dev] < limit:
+                del self._pending[i]
+                return job
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    if self._closed and not self._pending:
+                        return
+                    self._cond.wait()
+                    job = self._next_job()
+                self._busy[job.dev] += 1
+            try:
+                job.run()
+            finally:
+                with self._cond:
+                    self._busy[job.dev] -= 1
+                    self._cond.notify_all()
+
+
+class TreeWalker(object):
+    """Walk a directory tree like `os.walk()`, stat'ing files as it lists them
+
+        Yields `(dirpath, dirnames, filenames, stats)` in the very order
+        of `os.walk(top)`, where `stats` holds, for each of `filenames`
+        accepted by `file_filter(name)`, its `os.stat()` result (or the
+        EnvironmentError of it). Files of directories rejected by
+        `dir_filter(dirpath)` are not stat'ed at all, but their sub-
+        directories are still walked. As with `os.walk()`, the caller may
+        prune `dirnames`, in place.
+
+        With `scandir`, entries are told apart by their type from the
+        directory listing, and need one stat per accepted file, instead
+        of two. Directories are listed by `jobs` threads, each one as
+        soon as its parent has been yielded, so that siblings are
+        listed in parallel. Time spent stat'ing is added to the 'stat'
+        phase of `metrics`, if given.
+    """
+    log = logging.getLogger('walker')
+
+    def __init__(self, jobs=1, onerror=None, followlinks=False, dir_filter=None, file_filter=None,
+                 metrics=None):
+        self.jobs = jobs
+        self.metrics = metrics
+        self.onerror = onerror
+        self.followlinks = followlinks
+        self.dir_filter = dir_filter
+        self.file_filter = file_filter
+
+    def _list_scandir(self, dirpath, want_stats):
+        dirnames = []
+        filenames = []
+        stats = {}
+        links = set()
+        for entry in scandir(dirpath):
+            if entry.is_dir():
+                dirnames.append(entry.name)
+                if entry.is_symlink():
+                    links.add(entry.name)
+                continue
+            filenames.append(entry.name)
+            if want_stats and (self.file_filter is None or self.file_filter(entry.name)):
+                try:
+                    stats[entry.name] = entry.stat()
+                except EnvironmentError, e:
+                    stats[entry.name] = e
+        return dirnames, filenames, stats, links
+
+    def _list_plain(self, dirpath, want_stats):
+        dirnames = []
+        filenames = []
+        stats = {}
+        links = set()
+        for name in os.listdir(dirpath):
+            full_path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(full_path)
+            except EnvironmentError, e:
+                st = e
+            if not isinstance(st, EnvironmentError) and stat.S_ISDIR(st.st_mode):
+                dirnames.append(name)
+                if os.path.islink(full_path):
+                    links.add(name)
+                continue
+            filenames.append(name)
+            if want_stats and (self.file_filter is None or self.file_filter(name)):
+                stats[name] = st
+        return dirnames, filenames, stats, links
+
+    def _list(self, dirpath):
+        ts = time.time()
+        want_stats = self.dir_filter is None or self.dir_filter(dirpath)
+        if scandir is not None:
+            ret = self._list_scandir(dirpath, want_stats)
+        else:
+            ret = self._list_plain(dirpath, want_stats)
+        if self.metrics is not None:
+            self.metrics.add_time('stat', time.time() - ts, len(ret[2]))
+        return ret
+
+    def _submit(self, pool, dirpath):
+        if pool is None:
+            return JobPool.InlineJob(self._list, (dirpath,))
+        return pool.submit(self._list, (dirpath,))
+
+    def walk(self, top):
+        pool = None
+        if self.jobs > 1:
+            pool = JobPool(self.jobs)
+        stack = [(top, self._submit(pool, top))]
+        try:
+            while stack:
+                dirpath, job = stack.pop()
+                try:
+                    dirnames, filenames, stats, links = job.result()
+                except EnvironmentError, e:
+                    if self.onerror is not None:
+                        self.onerror(e)
+                    continue
+                yield dirpath, dirnames, filenames, stats
+                children = []
+                for name in dirnames:
+                    if self.followlinks or name not in links:
+                        new_path = os.path.join(dirpath, name)
+                        children.append((new_path, self._submit(pool, new_path)))
+                children.reverse()
+                stack += children
+        finally:
+            if pool is not None:
+                pool.close(cancel=True, wait=False)
+
+#eof
@@ -128,7 +128,7 @@ fi
 %attr(0755,root,root)	%{_sbindir}/*
 %attr(0755,root,root)	%config(noreplace) %{_sysconfdir}/cron.daily/multistage-backup.sh
 %attr(0755,root,root)	%config(noreplace) %{_sysconfdir}/cron.monthly/pfn-full-backup
-			%{libndir}/pfn_backup/*
+			%{libndir}/pfn_backup/*.sh
 %attr(0755,root,root)	%{_libdir}/hal/scripts/usb-rsync-callout
 %attr(0775,root,backup) %dir /var/backup
 %attr(0664,root,backup) %ghost /var/backup/index
@@ -139,6 +139,7 @@ fi
 %files online
 %attr(0755,root,backup) %{_bindir}/prepare-media.py
 %attr(0755,root,backup) %{_bindir}/scan-backups.py
+			%{libndir}/pfn_backup/*.py*
 
 
 %changelog -f %{_sourcedir}/%{name}-changelog.gitrpm.txt
@@ -7,6 +7,7 @@
 set -e
 GPG_BIN=/usr/bin/gpg
 GPG_CMD="nice -n 10 $GPG_BIN"
+MD5TEE_SH=/usr/lib/pfn_backup/md5tee.sh
 
 # run-parts from crond sets the HOME as /
 if [ "$HOME" == "/" ] ; then
@@ -45,8 +46,15 @@ encrypt_file() {
 		TMCOUNT=$(expr $TMCOUNT '+' 1)
 	done
 	
-	$GPG_CMD -o "$OUTFILE" -r ${BACKUP_GPG_KEY} -e "$1" && \
-		rm -f "$1"
+	if [ "x$GEN_MD5" == "xy" ] ; then
+		# sum of the encrypted file, computed while it is written
+		( set -o pipefail
+		  $GPG_CMD -o - -r ${BACKUP_GPG_KEY} -e "$1" | "$MD5TEE_SH" "$OUTFILE" ) && \
+			rm -f "$1" "$1.md5"
+	else
+		$GPG_CMD -o "$OUTFILE" -r ${BACKUP_GPG_KEY} -e "$1" && \
+			rm -f "$1" "$1.md5"
+	fi
 }
 
 for EXT in '.gz' '.xz' '.bz2' ; do
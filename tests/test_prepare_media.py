@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Tests of bin/prepare-media.py
+
+    The script is loaded as a module, without running. Plans are computed
+    over synthetic manifests, never touching any files. Run with:
+
+        python -m unittest discover tests
+"""
+
+import os
+import os.path
+import sys
+import imp
+import time
+import random
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin', 'prepare-media.py')
+
+
+def load_script():
+    if 'prepare_media' in sys.modules:
+        return sys.modules['prepare_media']
+    return imp.load_source('prepare_media', SCRIPT)
+
+
+class SizeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pm = load_script()
+
+    def test_pop_largest(self):
+        rnd = random.Random(1)
+        entries = [('f%d' % i, rnd.choice([10, 20, 20, 30, 50]), i) for i in range(200)]
+        index = self.pm.SizeIndex(entries)
+        left = list(entries)
+        for max_size in [rnd.randint(0, 60) for i in range(300)] + [None]:
+            fits = [e for e in left if max_size is None or e[1] <= max_size]
+            expected = fits and max(fits, key=lambda e: (e[1], -e[2])) or None
+            self.assertEqual(index.largest(max_size), expected)
+            self.assertEqual(index.pop_largest(max_size), expected)
+            if expected is not None:
+                left.remove(expected)
+            self.assertEqual(len(index), len(left))
+
+
+class ComputeTest(unittest.TestCase):
+    """The packer must give the very plan of the previous, quadratic, one
+    """
+
+    def setUp(self):
+        self.pm = load_script()
+
+    def _worker(self, media, n_files, seed, old_remaining=None):
+        worker = self.pm.PMWorker(allowed_media=media)
+        worker.volume_dir = '/vol'
+        worker.make_synth_manifest(n_files, seed)
+        if old_remaining is not None:
+            worker.dest_manifests.append({'name': 'Old', 'path': '/vol/dvd/disk01', 'type': 'dvd',
+                                          'size': worker.disk_sizes['dvd'], 'num': 1,
+                                          'remaining': old_remaining,
+                                          'old_files': [], 'new_files': []})
+        return worker
+
+    def _compare(self, media, n_files, seed, old_remaining=None):
+        plans = []
+        for method in ('compute', '_compute_legacy'):
+            worker = self._worker(media, n_files, seed, old_remaining)
+            res = worker.bench(method)
+            plans.append((res['plan'], sorted([nf[0] for nf in worker.wontfit_files])))
+        self.assertEqual(plans[0], plans[1])
+        self.assertTrue(plans[0][0])
+
+    def test_single_media(self):
+        self._compare(['dvd'], 500, 1)
+
+    def test_mixed_media(self):
+        for seed in (2, 3):
+            self._compare(['dvd', 'bd-sl'], 800, seed)
+
+    def test_old_volume(self):
+        self._compare(['cd', 'dvd'], 300, 4, old_remaining=1500 * self.pm.MB)
+
+
+class VolumeOptimizerTest(unittest.TestCase):
+
+    # best-fit decreasing needs 11 volumes of 1000, while 9 are enough:
+    # 6 x (510, 260, 230) and 3 x (270, 270, 230, 230)
+    SIZES = [510] * 6 + [270] * 6 + [260] * 6 + [230] * 12
+    MEDIA = [('dvd', 1000, 1.0, 100)]
+
+    def setUp(self):
+        self.pm = load_script()
+
+    def _check(self, plan):
+        self.assertEqual(sorted([i for mi, items in plan for i in items]), range(len(self.SIZES)))
+        for mi, items in plan:
+            self.assertTrue(sum([self.SIZES[i] for i in items]) <= self.MEDIA[mi][1])
+
+    def _improve(self):
+        optimizer = self.pm.VolumeOptimizer(self.SIZES, self.MEDIA)
+        bins = optimizer.bfd_plan()
+        self.assertEqual(len(bins), 11)
+        optimizer.set_plan(bins)
+        self.assertEqual(optimizer.improve(time.time() + 10.0), 2)
+        plan = optimizer.plan()
+        self._check(plan)
+        self.assertEqual(len(plan), 9)
+
+    def test_improve(self):
+        self._improve()
+
+    def test_improve_plain(self):
+        numpy = self.pm.numpy
+        self.pm.numpy = None
+        try:
+            self._improve()
+        finally:
+            self.pm.numpy = numpy
+
+    def test_retype(self):
+        media = [('bd', 1000, 3.0, 100), ('dvd', 500, 1.0, 100)]
+        optimizer = self.pm.VolumeOptimizer([400, 450, 300], media)
+        optimizer.set_plan([(0, [0]), (0, [1, 2])])
+        optimizer.retype()
+        self.assertEqual(optimizer.plan(), [(1, [0]), (0, [1, 2])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+"""Tests of bin/scan-backups.py
+
+    The script is loaded as a module, without running any mode. Run with:
+
+        python -m unittest discover tests
+"""
+
+import os
+import os.path
+import sys
+import imp
+import json
+import shutil
+import tempfile
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin', 'scan-backups.py')
+
+
+def load_script():
+    if 'scan_backups' in sys.modules:
+        return sys.modules['scan_backups']
+    return imp.load_source('scan_backups', SCRIPT)
+
+
+class StorageOptions(object):
+    """Stands for the parsed options, as storages read them
+    """
+    def __init__(self, **kwargs):
+        self.output = None
+        self.db = None
+        self.__dict__.update(kwargs)
+
+
+class TreeTestCase(unittest.TestCase):
+    """Builds a small tree of archives, in a temporary directory
+    """
+    def setUp(self):
+        self.sb = load_script()
+        self.tmpdir = tempfile.mkdtemp(prefix='scan-backups-test-')
+        self.gpg_dir = os.path.join(self.tmpdir, 'gpg', '201601')
+        os.makedirs(self.gpg_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_file(self, name, data):
+        fname = os.path.join(self.gpg_dir, name)
+        with open(fname, 'wb') as fp:
+            fp.write(data)
+        return fname
+
+
+class QueuedSumsTest(TreeTestCase):
+
+    def setUp(self):
+        super(QueuedSumsTest, self).setUp()
+        for i in range(3):
+            self.write_file('archive-%d.tar.gpg' % i, 'data %d' % i * 1000)
+
+    def _run_twice(self, queue_batches):
+        sb = self.sb
+        worker = sb.SourceManifestor()
+        worker.queue_batches = queue_batches
+        for n_run in range(2):
+            worker.scan_dir(self.tmpdir)
+            names = []
+            for batch in worker.queued_sums():
+                names += [mf['name'] for mf in batch]
+            self.assertEqual(len(names), 3, "run %d: %r" % (n_run, names))
+            self.assertFalse(worker._cancel.is_set())
+
+    def test_serial_twice(self):
+        self._run_twice(0)
+
+    def test_background_twice(self):
+        self._run_twice(2)
+
+    def test_background_then_serial(self):
+        worker = self.sb.SourceManifestor()
+        worker.queue_batches = 2
+        worker.scan_dir(self.tmpdir)
+        list(worker.queued_sums())
+        worker.scan_dir(self.tmpdir)
+        worker.out_manifest = self.sb.Manifest()
+        worker.compute_sums()
+        self.assertEqual(len(worker.out_manifest), 3)
+
+
+class ManifestEntryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sb = load_script()
+
+    def test_as_dict(self):
+        mf = self.sb.ManifestEntry('gpg/201601/archive.tar.gpg', 10, base_path='/backup')
+        d = {'name': 'gpg/201601/archive.tar.gpg', 'size': 10, 'md5sum': None, 'base_path': '/backup'}
+        self.assertEqual(mf.as_dict(), d)
+        mf['md5sum'] = 'a' * 32
+        mf['sha256sum'] = 'b' * 64
+        d.update(md5sum='a' * 32, sha256sum='b' * 64)
+        self.assertEqual(dict(mf.items()), d)
+        self.assertEqual(sorted(mf), sorted(d))
+        self.assertEqual(len(mf), 5)
+        self.assertTrue('sha256sum' in mf)
+        self.assertEqual(mf.get('sha1sum', 'none'), 'none')
+        self.assertRaises(KeyError, lambda: mf['sha1sum'])
+
+        self.assertEqual(mf.pop('base_path'), '/backup')
+        self.assertFalse('base_path' in mf)
+        self.assertRaises(KeyError, mf.pop, 'base_path')
+        self.assertEqual(mf.pop('base_path', None), None)
+        self.assertRaises(TypeError, mf.pop, 'size')
+
+    def test_shared_dirname(self):
+        mf1 = self.sb.ManifestEntry('gpg/201601/a.tar.gpg', 1)
+        mf2 = self.sb.ManifestEntry('gpg/201601/' + 'b.tar.gpg', 2)
+        self.assertTrue(mf1.dirname is mf2.dirname)
+        mf2['name'] = 'top.tar.gpg'
+        self.assertEqual((mf2.dirname, mf2['name']), ('', 'top.tar.gpg'))
+
+    def test_copy_export(self):
+        mf = self.sb.ManifestEntry('gpg/201601/a.tar.gpg', 1, 'c' * 32)
+        mf['verified'] = True
+        mf2 = mf.copy()
+        mf2['verified'] = False
+        self.assertEqual(mf['verified'], True)
+        exported = self.sb.Manifest.export([mf, {'name': 'plain'}])
+        self.assertEqual(exported, [{'name': 'gpg/201601/a.tar.gpg', 'size': 1,
+                                     'md5sum': 'c' * 32, 'verified': True}, {'name': 'plain'}])
+        self.assertEqual(type(exported[0]), dict)
+
+
+class DiskOrderTest(TreeTestCase):
+
+    def test_sort_keeps_entries(self):
+        worker = self.sb.SourceManifestor()
+        for i in range(5):
+            self.write_file('archive-%d.tar.gpg' % i, 'data %d' % i * 1000)
+        worker.scan_dir(self.tmpdir)
+        # one that vanished since the scan, must still be kept
+        worker.in_manifest.append(self.sb.ManifestEntry('gpg/201601/gone.tar.gpg', 10,
+                                                          base_path=self.tmpdir))
+        before = sorted(mf['name'] for mf in worker.in_manifest)
+        worker.sort_by_disk_order()
+        self.assertEqual(sorted(mf['name'] for mf in worker.in_manifest), before)
+
+        offsets = [self.sb.physical_offset(os.path.join(self.tmpdir, mf['name']))
+                   for mf in worker.in_manifest if not mf['name'].endswith('gone.tar.gpg')]
+        self.assertEqual(offsets, sorted(offsets))
+
+
+class JournalTest(TreeTestCase):
+
+    def setUp(self):
+        super(JournalTest, self).setUp()
+        self.output = os.path.join(self.tmpdir, 'manifest.json')
+        self.worker = self.sb.SourceManifestor()
+
+    def _storage(self):
+        return self.sb.JournalStorage(StorageOptions(output=self.output))
+
+    def _batch(self, first, num):
+        return [{'name': 'gpg/201601/a%d.tar.gpg' % i, 'size': i, 'md5sum': '%032x' % i}
+                for i in range(first, first + num)]
+
+    def test_replay_partial(self):
+        storage = self._storage()
+        storage.consume_manifests(self.worker, iter([self._batch(0, 3)]))
+        self.assertFalse(os.path.exists(storage.journal_fname))
+        storage._append(self._batch(3, 2))
+        # a crash, in the middle of the next line
+        with open(storage.journal_fname, 'ab') as fp:
+            fp.write(json.dumps(self._batch(5, 2))[:20])
+
+        storage = self._storage()
+        names = ['gpg/201601/a%d.tar.gpg' % i for i in range(8)]
+        self.assertEqual(storage.filter_needed(names, self.worker), names[5:])
+        with open(storage.journal_fname, 'rb') as fp:
+            self.assertEqual(fp.read(), json.dumps(self._batch(3, 2)) + '\n')
+
+        storage.write_manifest(self.worker)
+        with open(self.output, 'rb') as fp:
+            self.assertEqual(len(json.load(fp)), 5)
+        self.assertFalse(os.path.exists(storage.journal_fname))
+
+    def test_replay_replaces(self):
+        storage = self._storage()
+        storage._append(self._batch(0, 2))
+        batch = self._batch(1, 1)
+        batch[0]['md5sum'] = 'f' * 32
+        storage._append(batch)
+
+        storage = self._storage()
+        storage.filter_needed([], self.worker)
+        storage.compact()
+        with open(self.output, 'rb') as fp:
+            data = json.load(fp)
+        self.assertEqual([o['md5sum'] for o in data], ['%032x' % 0, 'f' * 32])
+
+
+class SQLiteStorageTest(TreeTestCase):
+
+    def setUp(self):
+        super(SQLiteStorageTest, self).setUp()
+        self.storage = self.sb.SQLiteStorage(StorageOptions())
+        self.source = self.sb.SourceManifestor()
+        self.volume = self.sb.VolumeManifestor(label='test')
+
+    def test_same_as_journal(self):
+        journal = self.sb.JournalStorage(StorageOptions(output=os.path.join(self.tmpdir, 'manifest.json')))
+        batches = [[{'name': 'gpg/201601/a%d.tar.gpg' % i, 'size': i, 'md5sum': '%032x' % i}
+                    for i in range(first, first + 3)] for first in (0, 3, 10)]
+        for storage in (self.storage, journal):
+            storage.consume_manifests(self.source, iter(batches))
+        names = ['gpg/201601/a%d.tar.gpg' % i for i in range(15)]
+        self.assertEqual(self.storage.filter_needed(names, self.source),
+                         journal.filter_needed(names, self.source))
+        self.assertEqual(len(self.storage.filter_needed(names, self.source)), 6)
+
+    def test_checked(self):
+        self.storage.store_batch(self.source, [
+                {'name': 'gpg/201601/good.tar.gpg', 'size': 10, 'md5sum': 'a' * 32},
+                {'name': 'gpg/201601/lost.tar.gpg', 'size': 10, 'md5sum': 'b' * 32},
+                {'name': 'gpg/201601/bad.tar.gpg', 'size': 20, 'md5sum': 'unreadable'}])
+        self.storage.store_batch(self.volume, [
+                {'name': 'gpg/201601/good.tar.gpg', 'size': 10, 'md5sum': 'a' * 32},
+                {'name': 'gpg/201601/other.tar.gpg', 'size': 20, 'md5sum': 'unreadable'}])
+        names = ['gpg/201601/%s.tar.gpg' % n for n in ('good', 'lost', 'bad')]
+        self.assertEqual(self.storage.filter_checked(names, self.source), names[:1])
+        self.assertEqual(self.storage.filter_needed(names, self.source), names[2:])
+
+
+class WireFormatTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sb = load_script()
+        self.WireFormat = self.sb.WireFormat
+        self.names = ['gpg/201601/archive-%03d.tar.gpg' % i for i in range(50)] + \
+                     ['gpg/201602/archive.tar.gpg', 'other', u'gpg/\u03b1\u03b2.tar.gpg']
+
+    def _compression(self, encoding):
+        data = json.dumps(self.names)
+        wire = self.WireFormat(encoding)
+        coded = wire.compress(data)
+        self.assertTrue(len(coded) < len(data))
+        self.assertEqual(self.WireFormat.decompress(coded, encoding), data)
+
+    def test_gzip(self):
+        self._compression('gzip')
+
+    def test_zstd(self):
+        if self.sb.zstandard is None:
+            self.skipTest("zstandard module is not installed")
+        self._compression('zstd')
+
+    def test_front_coding(self):
+        names = sorted(self.names)
+        coded = self.WireFormat.front_encode(names)
+        self.assertEqual(coded[1], [len('gpg/201601/archive-00'), '1.tar.gpg'])
+        self.assertEqual(self.WireFormat.front_decode(coded), names)
+
+    def test_columns(self):
+        batch = [{'name': name, 'size': i, 'md5sum': '%032x' % i}
+                 for i, name in enumerate(self.names)]
+        batch[3]['md5sum'] = 'unreadable'
+        batch[4]['md5sum'] = None
+        batch[5]['sha256sum'] = 'e' * 64
+        cols = json.loads(json.dumps(self.WireFormat.encode_columns(batch)))
+        self.assertEqual(self.WireFormat.decode_columns(cols),
+                         sorted(batch, key=lambda mf: mf['name']))
+
+    def test_requests(self):
+        wire = self.WireFormat('gzip', ['front-coding', 'columns'])
+        batch = [{'name': name, 'size': 1, 'md5sum': 'a' * 32} for name in self.names]
+        for post_data in ({'mode': 'filter-needed', 'entries': self.names},
+                          {'mode': 'upload', 'entries': batch, 'final': True}):
+            coded = wire.encode(post_data)
+            self.assertNotIn('entries', coded)
+            body = wire.compress(json.dumps(coded))
+            decoded = self.WireFormat.decode(json.loads(self.WireFormat.decompress(body, 'gzip')))
+            self.assertEqual(sorted(decoded.pop('entries')), sorted(post_data['entries']))
+            self.assertEqual(decoded, dict([(k, v) for k, v in post_data.items() if k != 'entries']))
+
+
+class UploadSpoolTest(TreeTestCase):
+
+    def setUp(self):
+        super(UploadSpoolTest, self).setUp()
+        self.path = os.path.join(self.tmpdir, 'spool')
+        self.vol = {'uuid': 'vol-uuid', 'vol_label': 'VOL'}
+
+    def _entries(self, names, md5sum='a' * 32):
+        return [{'name': n, 'size': 1, 'md5sum': md5sum} for n in names]
+
+    def test_dedupe(self):
+        spool = self.sb.UploadSpool(self.path)
+        spool.put({}, self._entries(['a', 'b']))
+        spool.put(self.vol, self._entries(['a']))
+        spool.put({}, self._entries(['b', 'c'], 'b' * 32), final=True)
+        batches = [batch for fname, batch in spool.batches()]
+        self.assertEqual([[(mf['name'], mf['md5sum'][0]) for mf in b['entries']] for b in batches],
+                         [[('a', 'a')], [('a', 'a')], [('b', 'b'), ('c', 'b')]])
+        self.assertEqual([b['final'] for b in batches], [False, False, True])
+
+    def test_resume(self):
+        spool = self.sb.UploadSpool(self.path)
+        first = spool.put(self.vol, self._entries(['a', 'b']))
+        spool.put(self.vol, self._entries(['c']), final=True)
+        spool.put({}, self._entries(['d']))
+        # a broken one, never renamed into place
+        with open(os.path.join(self.path, 'partial.json.tmp'), 'wb') as fp:
+            fp.write('{"context"')
+
+        spool = self.sb.UploadSpool(self.path)
+        self.assertEqual(spool.filter_kept(self.vol, ['a', 'c', 'd', 'e']), ['d', 'e'])
+        self.assertEqual(spool.filter_kept({}, ['a', 'd']), ['a'])
+        self.assertTrue(spool.is_complete(self.vol))
+        self.assertEqual(len(spool.batches()), 3)
+
+        spool.done(first)
+        self.assertEqual(spool.filter_kept(self.vol, ['a', 'c']), ['a'])
+        self.assertEqual(len(self.sb.UploadSpool(self.path).batches()), 2)
+
+
+class TreeWalkerTest(TreeTestCase):
+
+    def setUp(self):
+        super(TreeWalkerTest, self).setUp()
+        for i in range(3):
+            os.makedirs(os.path.join(self.tmpdir, 'gpg', '2016%02d' % (i + 2), 'sub%d' % i))
+            for j in range(4):
+                self.write_file('../2016%02d/archive-%d.tar.gpg' % (i + 2, j), 'data')
+        self.write_file('archive.tar.gpg', 'data')
+        os.symlink(self.gpg_dir, os.path.join(self.tmpdir, 'gpg', 'linked'))
+        os.symlink('missing', os.path.join(self.tmpdir, 'gpg', 'dangling'))
+        self.pfn_common = sys.modules['pfn_common']
+
+    def _compare(self, jobs, followlinks=False):
+        walker = self.sb.TreeWalker(jobs=jobs, followlinks=followlinks,
+                                    file_filter=lambda name: name.endswith('.gpg'))
+        got = []
+        for dirpath, dirnames, filenames, stats in walker.walk(self.tmpdir):
+            got.append((dirpath, dirnames, filenames))
+            self.assertEqual(sorted(stats), sorted([f for f in filenames if f.endswith('.gpg')]))
+            for name, st in stats.items():
+                self.assertEqual(st.st_size, os.stat(os.path.join(dirpath, name)).st_size)
+        self.assertEqual(got, list(os.walk(self.tmpdir, followlinks=followlinks)))
+
+    def test_walk(self):
+        for jobs in (1, 4):
+            self._compare(jobs)
+            self._compare(jobs, followlinks=True)
+
+    def test_walk_plain(self):
+        old_scandir = self.pfn_common.scandir
+        self.pfn_common.scandir = None
+        try:
+            self._compare(1)
+            self._compare(4, followlinks=True)
+        finally:
+            self.pfn_common.scandir = old_scandir
+
+    def test_prune(self):
+        walker = self.sb.TreeWalker(jobs=4)
+        visited = []
+        for dirpath, dirnames, filenames, stats in walker.walk(self.tmpdir):
+            visited.append(os.path.relpath(dirpath, self.tmpdir))
+            dirnames[:] = [d for d in dirnames if not d.startswith('sub')]
+        self.assertFalse([d for d in visited if 'sub' in d])
+        self.assertTrue(os.path.join('gpg', '201602') in visited)
+
+
+class SidecarTest(TreeTestCase):
+
+    def setUp(self):
+        super(SidecarTest, self).setUp()
+        self.archive = self.write_file('archive.tar.gpg', 'archive data' * 1000)
+        st = os.stat(self.archive)
+        # a sum that is not the one of the data, to tell where it came from
+        self.write_file('archive.tar.gpg.md5', '# size=%d mtime=%d\n%s  archive.tar.gpg\n'
+                        % (st.st_size, int(st.st_mtime), 'f' * 32))
+        self.write_file('other.tar.gpg.md5.tmp', '')
+
+    def test_scan_skips_sidecars(self):
+        for worker in (self.sb.SourceManifestor(), self.sb.VolumeManifestor(label='test')):
+            names = [mf['name'] for mf in worker._scan_dir(self.tmpdir)]
+            self.assertEqual(names, ['gpg/201601/archive.tar.gpg'])
+
+    def test_source_uses_sidecar(self):
+        worker = self.sb.SourceManifestor()
+        self.assertEqual(worker.md5sum(self.archive), 'f' * 32)
+
+    def test_volume_reads_data(self):
+        worker = self.sb.VolumeManifestor(label='test')
+        self.assertNotEqual(worker.md5sum(self.archive), 'f' * 32)
+
+    def test_modified_archive(self):
+        with open(self.archive, 'ab') as fp:
+            fp.write('more')
+        worker = self.sb.SourceManifestor()
+        self.assertNotEqual(worker.md5sum(self.archive), 'f' * 32)
+
+
+if __name__ == '__main__':
+    unittest.main()
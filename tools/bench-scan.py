@@ -0,0 +1,529 @@
+#!/usr/bin/python -W ignore
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    F3, Open Source Management Solution
+#    Copyright (C) 2016 P. Christeas <xrg@hellug.gr>
+#
+##############################################################################
+
+""" Benchmarks of scan-backups.py, kept out of the installed script
+
+    Usage: bench-scan.py <benchmark> [options] [paths]
+
+    where benchmark is one of:
+      - digests:  cost of MD5 and each of --digests, on files of paths
+      - backends: hashlib vs. kernel (AF_ALG) hashing, on files of paths
+      - filter:   serial vs. pipelined filter requests of paths, against a
+                  stand-in F3 serving the --db catalog
+      - e2e:      each mode of scan-backups.py against a stand-in F3, on a
+                  synthetic tree
+      - suite:    throughput and peak RSS of each stage, on synthetic trees
+"""
+
+import logging
+import os
+import os.path
+import sys
+import imp
+import time
+import json
+import optparse
+import shutil
+import subprocess
+import random
+import tempfile
+import copy
+from openerp_libclient.extra import options
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'bin')
+SCAN_BACKUPS = os.path.join(BIN_DIR, 'scan-backups.py')
+
+scan_backups = imp.load_source('scan_backups', SCAN_BACKUPS)
+from scan_backups import BaseManifestor, SourceManifestor, Manifest, DeviceInfo, FileReader, \
+        AFAlgHasher, SQLiteStorage, F3Storage, new_digest, sizeof_fmt
+from pfn_common import peak_rss, peak_rss_reset # in sys.path, through scan-backups.py
+import f3_standin
+from f3_standin import F3StandIn
+
+BENCHMARKS = ('digests', 'backends', 'filter', 'e2e', 'suite')
+
+
+def custom_options(parser):
+    scan_backups.custom_options(parser)
+    f3_standin.standin_options(parser)
+
+    pgroup = optparse.OptionGroup(parser, "Benchmark options")
+    pgroup.add_option('--synth-files', type=int, default=2000,
+                      help="Number of files in the synthetic trees of e2e and suite benchmarks")
+    pgroup.add_option('--synth-mb', type=int, default=200,
+                      help="Total size (MB) of the synthetic trees of e2e and suite benchmarks")
+    pgroup.add_option('--bench-json', help="Write results of the suite benchmark to this JSON file")
+    parser.add_option_group(pgroup)
+
+
+class DigestBenchmark(BaseManifestor):
+    """Measure the cost of MD5 and each extra digest, computed in a single pass
+
+        Files are read once, every chunk is fed to all digests, timing each
+        of them separately. Results are per byte of input.
+    """
+    log = logging.getLogger('bench.digests')
+    use_cache = False
+
+    def __init__(self):
+        super(DigestBenchmark, self).__init__()
+        self.manifest = Manifest()
+
+    def scan_dir(self, dpath):
+        if not os.path.isdir(dpath):
+            self.log.error("Input arguments must be directories. \"%s\" is not", dpath)
+            self.n_errors += 1
+            return False
+        self.manifest += self._scan_dir(dpath)
+        return True
+
+    def run(self):
+        algos = ('md5',) + self.digests
+        t_update = dict.fromkeys(algos, 0.0)
+        t_read = 0.0
+        n_bytes = 0L
+        cpu_start = os.times()
+        t_start = time.time()
+        for mf in self.manifest:
+            reader = self._open_reader(os.path.join(mf['base_path'], mf['name']))
+            hashers = [(algo, new_digest(algo)) for algo in algos]
+            try:
+                chunks = reader.chunks()
+                while True:
+                    t0 = time.time()
+                    try:
+                        data = chunks.next()
+                    except StopIteration:
+                        break
+                    t_read += time.time() - t0
+                    n_bytes += len(data)
+                    for algo, h in hashers:
+                        t0 = time.time()
+                        h.update(data)
+                        t_update[algo] += time.time() - t0
+            finally:
+                reader.close()
+        t_wall = time.time() - t_start
+        cpu_end = os.times()
+
+        print "Read %d files, %s in %.2fs, %s/s (waited %.2fs for data)" % \
+                (len(self.manifest), sizeof_fmt(n_bytes), t_wall,
+                 sizeof_fmt(n_bytes / (t_wall or 1.0)), t_read)
+        print "CPU: %.2fs user, %.2fs system" % (cpu_end[0] - cpu_start[0], cpu_end[1] - cpu_start[1])
+        print "%-12s %12s %10s" % ('digest', 'speed', 'ns/byte')
+        for algo in algos:
+            print "%-12s %10s/s %10.3f" % (algo, sizeof_fmt(n_bytes / (t_update[algo] or 1e-9)),
+                                          t_update[algo] * 1e9 / (n_bytes or 1))
+        extra = sum([t_update[algo] for algo in self.digests])
+        if self.digests:
+            print "Extra digests cost %.3f ns/byte, %.0f%% over MD5 alone" % \
+                (extra * 1e9 / (n_bytes or 1), extra * 100.0 / (t_update['md5'] or 1e-9))
+
+    def run_backends(self):
+        """Compare hashlib against the kernel (AF_ALG) backend, on the same files
+        """
+        algos = ('md5',) + self.digests
+        backends = [('hashlib', self._digest_hashlib)]
+        if AFAlgHasher.is_available(algos):
+            backends.append(('afalg', self._digest_afalg))
+        else:
+            print "AF_ALG is not available for: %s" % ', '.join(algos)
+
+        print "%-8s %10s %12s %8s %8s %10s" % ('backend', 'time', 'speed', 'user', 'system', 'CPU ns/B')
+        results = {}
+        for name, func in backends:
+            n_bytes = 0L
+            cpu_start = os.times()
+            t_start = time.time()
+            for mf in self.manifest:
+                reader = self._open_reader(os.path.join(mf['base_path'], mf['name']))
+                try:
+                    results.setdefault(mf['name'], {})[name] = func(reader, algos, mf['size'])
+                finally:
+                    reader.close()
+                n_bytes += mf['size']
+            t_wall = time.time() - t_start
+            cpu_end = os.times()
+            t_user = cpu_end[0] - cpu_start[0]
+            t_sys = cpu_end[1] - cpu_start[1]
+            print "%-8s %9.2fs %10s/s %7.2fs %7.2fs %10.3f" % (name, t_wall,
+                    sizeof_fmt(n_bytes / (t_wall or 1e-9)), t_user, t_sys,
+                    (t_user + t_sys) * 1e9 / (n_bytes or 1))
+
+        for fname, res in results.items():
+            if len(set(map(tuple, res.values()))) > 1:
+                self.log.error("Backends disagree on %s: %r", fname, res)
+                self.n_errors += 1
+
+
+class FilterBenchmark(BaseManifestor):
+    """Time filter requests of a tree, serial vs. pipelined, against a stand-in F3
+
+        The stand-in serves `catalog` locally, adding `latency` to each
+        request, to simulate a distant server.
+    """
+    log = logging.getLogger('bench.filter')
+
+    def __init__(self):
+        super(FilterBenchmark, self).__init__()
+        self.manifest = Manifest()
+
+    def scan_dir(self, dpath):
+        if not os.path.isdir(dpath):
+            self.log.error("Input arguments must be directories. \"%s\" is not", dpath)
+            self.n_errors += 1
+            return False
+        self.manifest += self._scan_dir(dpath)
+        return True
+
+    def run(self, catalog, opts, latency):
+        standin = F3StandIn(catalog, latency=latency)
+        standin.start()
+        spool_dir = tempfile.mkdtemp(prefix='bench-filter-')
+        try:
+            print "Filtering %d names against %s, with %.0fms latency" % \
+                    (len(self.manifest), standin.url, latency * 1000)
+            print "%-10s %10s %10s %10s" % ('inflight', 'requests', 'time', 'req/s')
+            results = []
+            for inflight in sorted(set([1, opts.http_inflight])):
+                sopts = copy.copy(opts)
+                sopts.upload_to = standin.url
+                sopts.http_inflight = inflight
+                sopts.http_no_env = True
+                sopts.cookies_file = None
+                sopts.spool = spool_dir
+                storage = F3Storage(sopts)
+                manifest = self.manifest[:]
+                n_req = standin.n_requests
+                ts = time.time()
+                self._filter_in(manifest, opts.prefix, storage)
+                dt = time.time() - ts
+                n_req = standin.n_requests - n_req
+                print "%-10d %10d %9.2fs %10.1f" % (inflight, n_req, dt, n_req / (dt or 1e-9))
+                results.append([m['name'] for m in manifest])
+            if results and any([r != results[0] for r in results]):
+                self.log.error("Pipelined results differ from serial ones!")
+                self.n_errors += 1
+        finally:
+            standin.stop()
+            shutil.rmtree(spool_dir, ignore_errors=True)
+
+
+class EndToEndBenchmark(object):
+    """Run each mode of scan-backups.py against a stand-in F3, on a synthetic tree
+
+        The tree looks like our archives: monthly directories of files,
+        of random (but repeatable) sizes. Modes run in separate processes,
+        in an order where each one has work to do, ending with "move",
+        which empties the tree.
+    """
+    log = logging.getLogger('bench.e2e')
+    MODES = ('sources', 'volume-dir', 'copy-needed', 'move-md5-bad', 'move')
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.tmpdir = tempfile.mkdtemp(prefix='bench-e2e-')
+        self.tree = os.path.join(self.tmpdir, 'tree')
+        self.n_files = 0
+        self.size = 0L
+
+    def cleanup(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def make_tree(self, n_files, total_size, seed=42):
+        """Write `n_files` of random data, `total_size` bytes in all, in monthly dirs
+        """
+        rnd = random.Random(seed)
+        mean_size = float(total_size) / max(n_files, 1)
+        for i in range(n_files):
+            month = i * 120 / max(n_files, 1)
+            dpath = os.path.join(self.tree, 'gpg', '%04d%02d' % (2010 + month / 12, month % 12 + 1))
+            if not os.path.isdir(dpath):
+                os.makedirs(dpath)
+            size = int(rnd.expovariate(1.0 / mean_size)) if mean_size >= 1 else 0
+            with open(os.path.join(dpath, 'archive-%06d.tar.gpg' % i), 'wb') as fp:
+                left = size
+                while left > 0:
+                    fp.write(os.urandom(min(left, 1 << 20)))
+                    left -= 1 << 20
+            self.n_files += 1
+            self.size += size
+
+    def _mode_args(self, mode):
+        opts = self.opts
+        args = ['--mode', mode, '-u', self.url, '--http-no-env', '--no-cache',
+                '--spool', os.path.join(self.tmpdir, 'spool'),
+                '-b', os.path.join(self.tmpdir, 'cookies.txt'),
+                '--jobs', str(opts.jobs), '--http-inflight', str(opts.http_inflight),
+                '--wire', opts.wire]
+        if mode == 'volume-dir':
+            return args + ['BENCH', self.tree, 'bench-uuid']
+        elif mode in ('copy-needed', 'move-md5-bad', 'move'):
+            args += ['--outdir', os.path.join(self.tmpdir, 'out-' + mode)]
+        return args + [self.tree]
+
+    def run(self):
+        opts = self.opts
+        ts = time.time()
+        self.make_tree(opts.synth_files, opts.synth_mb * 1024 * 1024)
+        self.log.info("Synthetic tree of %d files, %s written in %.1fs", self.n_files,
+                      sizeof_fmt(self.size), time.time() - ts)
+
+        catalog = SQLiteStorage(copy.copy(opts))
+        standin = F3StandIn(catalog, latency=opts.latency / 1000.0,
+                            bandwidth=opts.bandwidth * 1024, error_rate=opts.error_rate)
+        standin.start()
+        self.url = standin.url
+        results = []
+        try:
+            for mode in self.MODES:
+                logname = os.path.join(self.tmpdir, mode + '.log')
+                n_req, by_mode = standin.stats()
+                ts = time.time()
+                with open(logname, 'wb') as logfp:
+                    ret = subprocess.call([sys.executable, SCAN_BACKUPS] +
+                                          self._mode_args(mode), stdout=logfp, stderr=subprocess.STDOUT)
+                dt = time.time() - ts
+                n_req2, by_mode2 = standin.stats()
+                by_mode2.subtract(by_mode)
+                if ret:
+                    self.log.error("Mode %s failed with %d:\n%s", mode, ret, open(logname, 'rb').read()[-2000:])
+                results.append((mode, ret, dt, n_req2 - n_req,
+                                ', '.join(['%s:%d' % (k, v) for k, v in sorted(by_mode2.items()) if v])))
+        finally:
+            standin.stop()
+
+        print "%d files, %s, latency %.0fms, bandwidth %s, error rate %.2f" % \
+                (self.n_files, sizeof_fmt(self.size), opts.latency,
+                 opts.bandwidth and ('%dKB/s' % opts.bandwidth) or 'unlimited', opts.error_rate)
+        print "%-14s %4s %9s %10s %10s %8s  %s" % ('mode', 'ret', 'time', 'files/s', 'MB/s',
+                                                   'req/s', 'requests')
+        for mode, ret, dt, n_req, by_mode in results:
+            dt = dt or 1e-9
+            print "%-14s %4d %8.2fs %10.1f %10.2f %8.1f  %s" % (mode, ret, dt, self.n_files / dt,
+                    self.size / dt / (1024 * 1024), n_req / dt, by_mode)
+
+
+
+class BenchSuite(object):
+    """Throughput and peak RSS of each stage, over synthetic trees
+
+        Trees are of many small files, a few huge ones, and a deep
+        hierarchy. For each, `_scan_dir`, `_filter_in` (against an
+        in-memory catalog holding half of the names) and `_compute_sums`
+        are timed. `md5sum` is timed at several buffer sizes, on the huge
+        files, next to the `md5sum` utility. `PMWorker.compute` is timed by
+        prepare-media.py, in a process of its own.
+
+        Results are printed and, with `--bench-json`, written as JSON, for
+        comparing versions.
+    """
+    log = logging.getLogger('bench.suite')
+    BUFFER_SIZES = (64 << 10, 256 << 10, 1 << 20, 4 << 20, 16 << 20)
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.tmpdir = tempfile.mkdtemp(prefix='bench-suite-')
+        self.results = []
+        self.n_errors = 0
+
+    def cleanup(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    @staticmethod
+    def _write_file(fpath, size):
+        with open(fpath, 'wb') as fp:
+            left = size
+            while left > 0:
+                fp.write(os.urandom(min(left, 1 << 20)))
+                left -= 1 << 20
+
+    def make_tree(self, kind):
+        """Write a synthetic tree of `kind`: 'small', 'huge' or 'deep'
+
+            @return path of the tree
+        """
+        opts = self.opts
+        rnd = random.Random(42)
+        tree = os.path.join(self.tmpdir, kind)
+        os.makedirs(tree)
+        if kind == 'small':
+            for i in range(opts.synth_files * 5):
+                dpath = os.path.join(tree, 'wal', '%03d' % (i / 1000))
+                if not os.path.isdir(dpath):
+                    os.makedirs(dpath)
+                self._write_file(os.path.join(dpath, 'wal-%06d' % i), rnd.randint(0, 4096))
+        elif kind == 'huge':
+            for i in range(4):
+                self._write_file(os.path.join(tree, 'huge-%d.tar.gpg' % i),
+                                 opts.synth_mb * 1024 * 1024 / 4)
+        elif kind == 'deep':
+            for i in range(opts.synth_files):
+                parts = ['d%d' % ((i >> (2 * level)) % 4) for level in range(12)]
+                dpath = os.path.join(tree, *parts)
+                if not os.path.isdir(dpath):
+                    os.makedirs(dpath)
+                self._write_file(os.path.join(dpath, 'f-%06d' % i), rnd.randint(0, 64 << 10))
+        else:
+            raise ValueError(kind)
+        return tree
+
+    def _record(self, stage, tree, dt, files=0, size=0, **kwargs):
+        res = {'stage': stage, 'tree': tree, 'seconds': dt, 'files': files, 'bytes': size,
+               'files_per_s': files / (dt or 1e-9),
+               'mb_per_s': size / (dt or 1e-9) / (1024 * 1024),
+               'peak_rss_kb': peak_rss(), 'peak_rss_scope': self._rss_scope}
+        res.update(kwargs)
+        self.results.append(res)
+        print "%-16s %-6s %8.3fs %10.1f files/s %9.2f MB/s %8dKB %s" % \
+                (stage, tree, dt, res['files_per_s'], res['mb_per_s'], res['peak_rss_kb'],
+                 ' '.join(['%s=%s' % kv for kv in sorted(kwargs.items())]))
+        return res
+
+    def _stage_start(self):
+        self._rss_scope = peak_rss_reset() and 'stage' or 'process'
+        return time.time()
+
+    def _new_worker(self):
+        worker = SourceManifestor()
+        worker.use_cache = False
+        worker.use_dir_digests = False
+        return worker
+
+    def bench_tree(self, kind, tree):
+        worker = self._new_worker()
+        ts = self._stage_start()
+        manifest = worker._scan_dir(tree)
+        n_files = len(manifest)
+        size = sum([m['size'] for m in manifest])
+        self._record('_scan_dir', kind, time.time() - ts, n_files)
+
+        sopts = copy.copy(self.opts)
+        sopts.db = None # in memory
+        catalog = SQLiteStorage(sopts)
+        catalog.store_batch(worker, [{'name': m['name'], 'size': m['size'], 'md5sum': '0' * 32}
+                                     for m in manifest[::2]])
+        fmanifest = [m.copy() for m in manifest]
+        ts = self._stage_start()
+        worker._filter_in(fmanifest, False, catalog)
+        self._record('_filter_in', kind, time.time() - ts, n_files, needed=len(fmanifest))
+
+        out_manifest = []
+        in_manifest = [m.copy() for m in manifest]
+        ts = self._stage_start()
+        worker._compute_sums(in_manifest, out_manifest)
+        self._record('_compute_sums', kind, time.time() - ts, len(out_manifest), size,
+                     jobs=worker.jobs)
+
+    def bench_md5sum(self, tree):
+        fpaths = sorted([os.path.join(tree, f) for f in os.listdir(tree)])
+        size = sum([os.path.getsize(f) for f in fpaths])
+        for bs in (None,) + self.BUFFER_SIZES:
+            worker = self._new_worker()
+            if bs is None:
+                # as chosen for the device
+                bs = DeviceInfo.get(os.stat(tree).st_dev).block_size(worker.BS)
+                bs_name = 'auto'
+            else:
+                worker._open_reader = lambda fpath, bs=bs: FileReader(fpath, bs, direct=worker.direct_io,
+                                                                      drop_cache=worker.drop_cache)
+                bs_name = str(bs)
+            ts = self._stage_start()
+            for fpath in fpaths:
+                worker.md5sum(fpath)
+            self._record('md5sum', 'huge', time.time() - ts, len(fpaths), size,
+                         bs=bs_name, effective_bs=bs)
+        try:
+            ts = self._stage_start()
+            subprocess.check_call(['md5sum'] + fpaths, stdout=open(os.devnull, 'wb'))
+            self._record('md5sum(1)', 'huge', time.time() - ts, len(fpaths), size)
+        except (OSError, subprocess.CalledProcessError), e:
+            self.log.warning("Cannot time the md5sum utility: %s", e)
+
+    def bench_pmworker(self):
+        script = os.path.join(BIN_DIR, 'prepare-media.py')
+        json_fname = os.path.join(self.tmpdir, 'prepare-media.json')
+        try:
+            subprocess.check_call([sys.executable, script, '--synth-files', str(self.opts.synth_files),
+                                   '--allowed-media', 'dvd,bd-sl', '--bench-json', json_fname,
+                                   '--output-dir', self.tmpdir])
+            with open(json_fname, 'rb') as fp:
+                for res in json.load(fp):
+                    res['tree'] = 'synth'
+                    self.results.append(res)
+        except (OSError, ValueError, subprocess.CalledProcessError), e:
+            self.log.warning("Cannot time PMWorker.compute: %s", e)
+            self.n_errors += 1
+
+    def run(self):
+        for kind in ('small', 'huge', 'deep'):
+            ts = time.time()
+            tree = self.make_tree(kind)
+            self.log.info("Wrote %s tree in %.1fs", kind, time.time() - ts)
+            self.bench_tree(kind, tree)
+            if kind == 'huge':
+                self.bench_md5sum(tree)
+        self.bench_pmworker()
+
+        if self.opts.bench_json:
+            with open(self.opts.bench_json, 'wb') as fp:
+                json.dump({'time': time.time(), 'host': os.uname()[1],
+                           'python': sys.version.split()[0],
+                           'options': {'jobs': self.opts.jobs, 'synth_files': self.opts.synth_files,
+                                       'synth_mb': self.opts.synth_mb},
+                           'results': self.results}, fp, indent=2, sort_keys=True)
+            self.log.info("Results written to %s", self.opts.bench_json)
+
+
+if __name__ == '__main__':
+    options.allow_include = 3
+    options._path_options += ['output', 'cookies_file', 'hash_cache', 'db', 'bench_json']
+    options.init(options_prepare=custom_options, have_args=None)
+
+    log = logging.getLogger('main')
+
+    if not options.args or options.args[0] not in BENCHMARKS:
+        log.error("Must select a benchmark: %s", ', '.join(BENCHMARKS))
+        sys.exit(1)
+    bench_name = options.args.pop(0)
+    if bench_name == 'filter' and not options.opts.db:
+        log.error("The filter benchmark needs a catalog database, use --db")
+        sys.exit(1)
+
+    BaseManifestor.setup_options(options.opts)
+
+    if bench_name in ('digests', 'backends'):
+        worker = DigestBenchmark()
+        for fpath in options.args:
+            worker.scan_dir(fpath)
+        if bench_name == 'digests':
+            worker.run()
+        else:
+            worker.run_backends()
+
+    elif bench_name == 'filter':
+        worker = FilterBenchmark()
+        for fpath in options.args:
+            worker.scan_dir(fpath)
+        worker.run(SQLiteStorage(options.opts), options.opts, options.opts.latency / 1000.0)
+
+    else:
+        if bench_name == 'e2e':
+            bench = EndToEndBenchmark(options.opts)
+        else:
+            bench = BenchSuite(options.opts)
+        try:
+            bench.run()
+        finally:
+            bench.cleanup()
+
+    if BaseManifestor.hash_cache:
+        BaseManifestor.hash_cache.close()
+
+#eof
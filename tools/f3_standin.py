@@ -0,0 +1,214 @@
+#!/usr/bin/python -W ignore
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    F3, Open Source Management Solution
+#    Copyright (C) 2016 P. Christeas <xrg@hellug.gr>
+#
+##############################################################################
+
+""" Local stand-in for the F3 upload service, for tests and benchmarks
+
+    Used by bench-scan.py, or run on its own, serving an SQLite catalog
+    (in memory, unless --db is given) to scan-backups.py:
+
+        f3_standin.py --listen 127.0.0.1:8069 [--db catalog.db] [--latency ms]
+        scan-backups.py -u http://127.0.0.1:8069/ --mode sources <paths>
+"""
+
+import logging
+import os
+import os.path
+import sys
+import imp
+import time
+import json
+import optparse
+import random
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from collections import Counter
+from openerp_libclient.extra import options
+
+SCAN_BACKUPS = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'bin', 'scan-backups.py')
+
+scan_backups = sys.modules.get('scan_backups') or imp.load_source('scan_backups', SCAN_BACKUPS)
+from scan_backups import WireFormat, SQLiteStorage
+
+
+def standin_options(parser):
+    """Options of the stand-in service, shared with bench-scan.py
+    """
+    pgroup = optparse.OptionGroup(parser, "Stand-in F3 options")
+    pgroup.add_option('--latency', type=float, default=0.0,
+                      help="Delay (ms) added to each request, by the stand-in F3 service")
+    pgroup.add_option('--bandwidth', type=int, default=0,
+                      help="Limit (KB/s) of the stand-in F3 service, on each request (0: no limit)")
+    pgroup.add_option('--error-rate', type=float, default=0.0,
+                      help="Fraction of requests the stand-in F3 service fails, with HTTP 503")
+    parser.add_option_group(pgroup)
+
+
+def custom_options(parser):
+    assert isinstance(parser, optparse.OptionParser)
+
+    pgroup = optparse.OptionGroup(parser, "Service options")
+    pgroup.add_option('--listen', default='127.0.0.1:8069', help="Address to serve at")
+    pgroup.add_option('--db', help="SQLite database to serve (default: a new one, in memory)")
+    parser.add_option_group(pgroup)
+    standin_options(parser)
+
+
+class F3StandIn(object):
+    """Local stand-in for the F3 upload service, serving an offline catalog
+
+        Speaks the same JSON protocol as F3Storage, answering from another
+        storage (normally SQLiteStorage). It is meant for tests and
+        benchmarks: `latency` (seconds) is added to every request, the
+        transfer of each request and reply is limited to `bandwidth`
+        (bytes/sec), and `error_rate` of the requests fail with HTTP 503.
+        Unless `compact` is False, it advertises (and accepts) the compact
+        WireFormat encodings.
+    """
+    log = logging.getLogger('standin')
+
+    class RemoteWorker(object):
+        """Stands for the worker at the client side, carrying its context
+        """
+        def __init__(self, post_data):
+            self.context = {}
+            for key in ('vol_label', 'uuid', 'fstype'):
+                if key in post_data:
+                    self.context[key] = post_data[key]
+
+    def __init__(self, storage, address=('127.0.0.1', 0), latency=0.0, compact=True,
+                 bandwidth=0, error_rate=0.0):
+        self.storage = storage
+        self.latency = latency
+        self.compact = compact
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.n_requests = 0
+        self.bytes_in = 0
+        self.by_mode = Counter()
+        self._stats_lock = threading.Lock()
+        standin = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # keep-alive
+
+            def do_POST(self):
+                standin._handle(self)
+
+            def log_message(self, format, *args):
+                standin.log.debug(format, *args)
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.httpd = Server(address, Handler)
+
+    @property
+    def url(self):
+        return 'http://%s:%d/' % self.httpd.server_address
+
+    def start(self):
+        """Serve from a background thread
+        """
+        thr = threading.Thread(target=self.httpd.serve_forever)
+        thr.daemon = True
+        thr.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def stats(self):
+        """Return number of requests so far, and a copy of their counts per mode
+        """
+        with self._stats_lock:
+            return self.n_requests, self.by_mode.copy()
+
+    def _handle(self, req):
+        body = req.rfile.read(int(req.headers.get('Content-Length') or 0))
+        with self._stats_lock:
+            self.bytes_in += len(body)
+        if req.headers.get('Content-Type', '').startswith('application/json'):
+            body = WireFormat.decompress(body, req.headers.get('Content-Encoding'))
+            post_data = WireFormat.decode(json.loads(body))
+        else:
+            post_data = dict([(k, v[0]) for k, v in urlparse.parse_qs(body).items()])
+        if self.latency:
+            time.sleep(self.latency)
+        with self._stats_lock:
+            self.n_requests += 1
+            self.by_mode[post_data.get('mode')] += 1
+        if self.error_rate and random.random() < self.error_rate:
+            code, ctype, data = 503, 'text/plain', 'Injected error'
+        else:
+            try:
+                code, ctype, data = self._dispatch(post_data)
+            except Exception, e:
+                self.log.warning("Cannot serve %s: %s", post_data.get('mode'), e, exc_info=True)
+                code, ctype, data = 500, 'text/plain', str(e)
+        if self.bandwidth:
+            time.sleep(float(len(body) + len(data)) / self.bandwidth)
+        req.send_response(code)
+        if post_data.get('mode') == 'test' and self.compact:
+            req.send_header(WireFormat.HDR_ENCODINGS, ', '.join(WireFormat.encodings()))
+            req.send_header(WireFormat.HDR_FEATURES, 'front-coding, columns')
+        req.send_header('Content-Type', ctype)
+        req.send_header('Content-Length', str(len(data)))
+        req.end_headers()
+        req.wfile.write(data)
+
+    def _dispatch(self, post_data):
+        mode = post_data.get('mode')
+        worker = F3StandIn.RemoteWorker(post_data)
+        if mode == 'test':
+            return 200, 'text/plain', 'OK'
+        elif mode == 'lookup':
+            props = dict([(k, v) for k, v in post_data.items() if k != 'mode'])
+            res = self.storage.lookup_fs(props)
+        elif mode == 'filter-needed':
+            res = self.storage.filter_needed(post_data['entries'], worker)
+        elif mode == 'filter-checked':
+            res = self.storage.filter_checked(post_data['entries'], worker)
+        elif mode == 'get-details':
+            res = self.storage.get_details(post_data['entries'], worker)
+        elif mode == 'filter-dirs':
+            res = self.storage.filter_dirs(post_data['entries'], worker)
+        elif mode == 'store-dirs':
+            self.storage.store_dirs(post_data['entries'], worker)
+            res = True
+        elif mode == 'upload':
+            # single entries are padded with an empty dict
+            entries = [e for e in post_data.get('entries') or [] if e]
+            if entries:
+                self.storage.store_batch(worker, entries)
+            if post_data.get('final') in (True, 'True', 'true', '1'):
+                self.storage.finish_volume(worker)
+            res = True
+        else:
+            return 400, 'text/plain', 'Unknown mode: %s' % mode
+        return 200, 'application/json', json.dumps(res)
+
+
+if __name__ == '__main__':
+    options._path_options += ['db']
+    options.init(options_prepare=custom_options, have_args=None)
+
+    log = logging.getLogger('main')
+
+    storage = SQLiteStorage(options.opts)
+    host, port = options.opts.listen.rsplit(':', 1)
+    standin = F3StandIn(storage, (host, int(port)), latency=options.opts.latency / 1000.0,
+                        bandwidth=options.opts.bandwidth * 1024, error_rate=options.opts.error_rate)
+    log.info("Serving %s at %s", storage.fname, standin.url)
+    try:
+        standin.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+#eof